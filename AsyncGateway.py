@@ -0,0 +1,450 @@
+'''
+asyncio versions of the Orthanc and Splunk gateways, for workloads with thousands of requests
+in flight (remote queries, tag fetches, HEC posts) on one event loop instead of a thread each.
+Requires Python 3.5+ and aiohttp, so only import this module where it is used.
+'''
+
+import asyncio
+import collections
+import json
+import logging
+import pprint
+import weakref
+from posixpath import join as urljoin
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from IDSet import IDSet, id_batches, id_intersection, id_difference, id_union
+from RateControl import get_rate_control
+from Serializers import get_serializer
+from SplunkQuery import CHUNK_SIZE, DEFAULT_INDEX_NAMES, PAGE_SIZE, SEARCH_WORKERS, SUBSET_THRESHOLD, \
+    id_query, time_terms
+from StructuredTags import simplify_tags, extract_dose_report, get_projection, epoch
+from Trace import span
+
+# Requests in flight to any one host, shared by every session talking to it
+HOST_LIMIT = 32
+
+# Open connections per session, across all hosts
+POOL_SIZE = 256
+
+# Non-200/201 responses, in place of the requests.Response the blocking session returns
+Error = collections.namedtuple('Error', ['status_code', 'content'])
+
+# Host semaphores for each loop, dropped with the loop
+_host_limits = weakref.WeakKeyDictionary()
+
+
+def is_error(r):
+    return isinstance(r, Error)
+
+
+def host_semaphore(endpoint, limit=HOST_LIMIT):
+    # Semaphores belong to a loop, so there is one per (loop, host)
+    limits = _host_limits.setdefault(asyncio.get_event_loop(), {})
+    if endpoint not in limits:
+        limits[endpoint] = asyncio.Semaphore(limit)
+    return limits[endpoint]
+
+
+async def throttle(control, body_size=0):
+    '''
+    RateControl.request's schedule and token buckets, waiting on the loop rather than
+    sleeping the thread.  Returns the schedule's scale for the download.  The AIMD limiter
+    blocks threads, so it is left out; the host semaphore bounds concurrency instead.
+    '''
+
+    scale = control.schedule.factor() if control.schedule else 1.0
+    while scale <= 0:
+        logging.debug('Paused by schedule')
+        await asyncio.sleep(60)
+        scale = control.schedule.factor()
+
+    if control.requests:
+        await asyncio.sleep(control.requests.reserve(1, scale))
+    if control.bandwidth and body_size:
+        await asyncio.sleep(control.bandwidth.reserve(body_size, scale))
+    return scale
+
+
+class AsyncSession(object):
+    '''
+    aiohttp counterpart of SessionWrapper.Session, with its do_* calls as coroutines.
+    Connections are pooled for the life of the session, and a per-host semaphore bounds
+    the requests in flight to each server.  Requests share the endpoint's RateControl
+    with the blocking sessions.  The client is created on first use, so the session must
+    be used from a single event loop.
+    '''
+
+    def __init__(self, address, serializer=None, limit=HOST_LIMIT, pool_size=POOL_SIZE):
+
+        self.address = address
+        p = urlsplit(self.address)
+        self.scheme = p.scheme
+        self.hostname = p.hostname
+        self.port = p.port
+        self.path = p.path
+
+        self.headers = {}
+        self.auth = None
+        if p.username == "Splunk":
+            self.headers = {'Authorization': 'Splunk {0}'.format(p.password)}
+        elif p.username:
+            self.auth = aiohttp.BasicAuth(p.username, p.password or '')
+
+        self.endpoint = "{0}:{1}".format(p.hostname, p.port)
+        self.logger = logging.getLogger("{0} async API".format(self.endpoint))
+        self.logger.info('Created an async session for %s' % address)
+
+        self.serializer = serializer or get_serializer()
+        self.limit = limit
+        self.pool_size = pool_size
+        self.client = None
+
+    def get_url(self, *loc):
+        return urljoin("{0}://{1}:{2}".format(self.scheme, self.hostname, self.port), self.path, *loc)
+
+    def open(self):
+        if self.client is None or self.client.closed:
+            # ssl=False to match the blocking session's verify=False
+            connector = aiohttp.TCPConnector(limit=self.pool_size, limit_per_host=self.limit, ssl=False)
+            self.client = aiohttp.ClientSession(connector=connector, auth=self.auth, headers=self.headers)
+        return self.client
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.close()
+            self.client = None
+
+    async def request(self, method, loc, **kwargs):
+        client = self.open()
+
+        control = get_rate_control(self.endpoint)
+        if control:
+            data = kwargs.get('data')
+            scale = await throttle(control, len(data) if isinstance(data, (bytes, str)) else 0)
+
+        async with host_semaphore(self.endpoint, self.limit):
+            async with client.request(method, self.get_url(loc), **kwargs) as r:
+                ret = await self.do_return(r)
+                size = r.content_length
+
+        # Downloads count against the same bandwidth budget, paid after the fact
+        if control and control.bandwidth and size:
+            await asyncio.sleep(control.bandwidth.reserve(size, scale))
+        return ret
+
+    async def do_return(self, r):
+
+        content = await r.read()
+        if r.status != 200 and r.status != 201:
+            self.logger.warn('Session returned error %s', r.status)
+            return Error(r.status, content)
+
+        # Return dict if possible, but content otherwise (for image data)
+        if r.content_type == 'application/json':
+            try:
+                return json.loads(content.decode('utf-8'))
+            except ValueError:
+                self.logger.warn('Session returned malformed json')
+        return content
+
+    async def do_get(self, loc, params=None):
+        return await self.request('GET', loc, params=params)
+
+    async def do_post_form(self, loc, fields):
+        # aiohttp form-encodes a dict body
+        return await self.request('POST', loc, data=fields)
+
+    async def do_delete(self, loc, params=None):
+        return await self.request('DELETE', loc, params=params)
+
+    async def do_post(self, loc, data, headers=None):
+
+        headers = dict(headers or {})
+
+        if isinstance(data, dict):
+            headers['content-type'] = self.serializer.content_type
+            with span('json_encode'):
+                data = self.serializer.dumps(data)
+        elif isinstance(data, str):
+            headers.setdefault('content-type', 'text/plain')
+
+        return await self.request('POST', loc, data=data, headers=headers)
+
+
+async def run_search(session, q, poll=1):
+    '''SplunkQuery.run_search, reading every page of results at once'''
+
+    r = await session.do_post_form('services/search/jobs', {'search': q, 'output_mode': 'json'})
+    sid = r['sid']
+
+    with span('splunk_search', sid=sid):
+        while True:
+            await asyncio.sleep(poll)
+            r = await session.do_get('services/search/jobs/{0}'.format(sid), params={'output_mode': 'json'})
+            if r['entry'][0]['content']['isDone']:
+                break
+    n = r['entry'][0]['content']['resultCount']
+
+    pages = await asyncio.gather(*[
+        session.do_get('services/search/jobs/{0}/results'.format(sid),
+                       params={'output_mode': 'csv', 'count': PAGE_SIZE, 'offset': offset})
+        for offset in range(0, n, PAGE_SIZE)])
+
+    results = []
+    for page in pages:
+        results = results + page.decode('utf-8').replace('"', '').splitlines()[1:]
+    return results
+
+
+class AsyncGateway(object):
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncGateway, self).__init__()
+        self.session = AsyncSession(kwargs.get('address'), limit=kwargs.get('limit', HOST_LIMIT))
+
+    async def ListItems(self, condition=None, *args, **kwargs):
+        raise NotImplementedError
+
+    async def GetItem(self, *args, **kwargs):
+        raise NotImplementedError
+
+    async def GetItems(self, items, dtype='tags', projection=None):
+        # [(item, data)], every request in flight at once up to the host limit
+        items = list(items)
+        data = await asyncio.gather(*[self.GetItem(item, dtype, projection=projection) for item in items])
+        return list(zip(items, data))
+
+    async def AddItem(self, item, *args, **kwargs):
+        raise NotImplementedError
+
+    async def Flush(self):
+        # IDs of items that could not be delivered, as for Gateway.Flush
+        return []
+
+    def Projection(self):
+        return None
+
+    async def IndexedSubset(self, candidates, field='ID', *args, **kwargs):
+        return id_intersection(candidates, await self.ListItems(field=field))
+
+    async def close(self):
+        await self.session.close()
+
+
+class AsyncOrthancGateway(AsyncGateway):
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncOrthancGateway, self).__init__(**kwargs)
+        # Active level
+        self.level = kwargs.get('level')
+
+    async def QueryRemote(self, remote, query=None, *args, **kwargs):
+        data = {'Level': self.level,
+                'Query': query}
+        return await self.session.do_post('modalities/{0}/query'.format(remote), data=data)
+
+    async def RetrieveFromRemote(self, remote, resources=None):
+        data = {'Level': self.level,
+                'Resources': resources}
+        logging.debug(pprint.pformat(data))
+        return await self.session.do_post('modalities/{0}/move'.format(remote), data=data)
+
+    async def ListItems(self, condition=None, *args, **kwargs):
+
+        if condition:
+            raise NotImplementedError
+
+        r = await self.session.do_get(self.level)
+        logging.info("Found {0} candidate {1}.".format(len(r), self.level))
+        return r
+
+    async def DeleteItem(self, item):
+        return await self.session.do_delete('{0}/{1}'.format(self.level, item))
+
+    async def GetItem(self, item, dtype="tags", projection=None):
+
+        r = None
+        if dtype == "tags" or dtype == "dose":
+            if self.level == 'instances' or dtype == "dose":
+                loc = '{0}/{1}/tags?simplify'.format(self.level, item)
+            else:
+                loc = '{0}/{1}/shared-tags?simplify'.format(self.level, item)
+            with span('orthanc_get', id=item, dtype=dtype):
+                r = await self.session.do_get(loc)
+            if is_error(r):
+                return r
+
+            if dtype == "tags":
+                with span('simplify_tags', id=item):
+                    r = simplify_tags(r, projection)
+            else:
+                with span('extract_dose_report', id=item):
+                    r = extract_dose_report(r, projection=projection)
+            # Add item ID for later reference
+            r['ID'] = item
+
+        elif dtype == "info":
+            with span('orthanc_get', id=item, dtype=dtype):
+                r = await self.session.do_get('{0}/{1}'.format(self.level, item))
+
+        elif dtype == "file":
+            with span('orthanc_get', id=item, dtype=dtype):
+                r = await self.session.do_get('{0}/{1}/file'.format(self.level, item))
+        return r
+
+    async def AddItem(self, item, *args, **kwargs):
+        if self.level != "instances":
+            raise NotImplementedError
+        headers = {'content-type': 'application/dicom'}
+        return await self.session.do_post('instances', data=item, headers=headers)
+
+
+class AsyncSplunkGateway(AsyncGateway):
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncSplunkGateway, self).__init__(**kwargs)
+        self.hec_address = kwargs.get('hec_address')
+        if self.hec_address:
+            self.hec = AsyncSession(self.hec_address, limit=kwargs.get('hec_limit', HOST_LIMIT))
+        # Active index name
+        self.index = kwargs.get('index')
+        # Same options as SplunkGateway
+        self.index_names = kwargs.get('index_names', DEFAULT_INDEX_NAMES)
+        self.projections = kwargs.get('projections', {})
+        self.tstats = kwargs.get('tstats', False)
+        self.summary_indices = kwargs.get('summary_indices', {})
+
+    def Projection(self):
+        for role, name in self.index_names.items():
+            if name == self.index and role in self.projections:
+                return get_projection(self.projections[role])
+
+    async def ListItems(self, condition=None, field='ID', earliest=None, latest=None, *args, **kwargs):
+
+        if not condition or isinstance(condition, dict):
+            terms = [time_terms(earliest, latest)]
+            for key, values in (condition or {}).items():
+                if not isinstance(values, list):
+                    values = [values]
+                terms.append('(' + ' OR '.join('{0}="{1}"'.format(key, v) for v in values) + ')')
+            condition = "search index={0} {1} | spath {2} | dedup {2} | table {2}".format(
+                self.index, ' '.join(t for t in terms if t), field)
+
+        return await run_search(self.session, condition)
+
+    async def IndexedSubset(self, candidates, field='ID', earliest=None, latest=None, *args, **kwargs):
+        '''SplunkQuery.indexed_subset, with up to SEARCH_WORKERS chunk searches on the loop at once'''
+
+        query = {'earliest': earliest, 'latest': latest, 'tstats': self.tstats,
+                 'summary_index': self.summary_indices.get(self.index)}
+
+        async def listing():
+            found = await run_search(self.session, id_query(self.index, field, **query))
+            try:
+                return IDSet(found)
+            except ValueError:
+                return set(found)
+
+        async def search(chunk):
+            return id_intersection(chunk, await run_search(self.session, id_query(self.index, field, chunk, **query)))
+
+        listed = None
+        if hasattr(candidates, '__len__') and len(candidates) > SUBSET_THRESHOLD:
+            listed = await listing()
+
+        found = []
+        searching = set()
+        n = 0
+        for chunk in id_batches(candidates, CHUNK_SIZE):
+            n = n + len(chunk)
+            if listed is None and n > SUBSET_THRESHOLD:
+                listed = await listing()
+            if listed is not None:
+                found.append(id_intersection(chunk, listed))
+                continue
+            searching.add(asyncio.ensure_future(search(chunk)))
+            if len(searching) >= SEARCH_WORKERS:
+                done, searching = await asyncio.wait(searching, return_when=asyncio.FIRST_COMPLETED)
+                found.extend(task.result() for task in done)
+        if searching:
+            done, _ = await asyncio.wait(searching)
+            found.extend(task.result() for task in done)
+        return id_union(found)
+
+    async def AddItem(self, item, *args, **kwargs):
+
+        src = kwargs.get('src')
+        host = kwargs.get('host', '{0}:{1}'.format(src.session.hostname, src.session.port))
+
+        data = collections.OrderedDict([('time', epoch(item['InstanceCreationDateTime'])),
+                                        ('host', host),
+                                        ('sourcetype', '_json'),
+                                        ('index', self.index),
+                                        ('event', item)])
+        with span('hec_post', id=item.get('ID')):
+            return await self.hec.do_post('services/collector/event', data=data)
+
+    async def close(self):
+        await super(AsyncSplunkGateway, self).close()
+        if self.hec_address:
+            await self.hec.close()
+
+
+async def CopyItems(src, dest, items, dtype='tags'):
+    '''Gateway.CopyItems with every item fetched and added concurrently'''
+
+    if not items:
+        logging.info('Nothing to copy')
+        return
+
+    projection = dest.Projection()
+
+    async def copy(item):
+        data = await src.GetItem(item, dtype, projection)
+        if is_error(data):
+            logging.warn('Could not get {0}'.format(item))
+            return
+        await dest.AddItem(data, src=src)
+
+    await asyncio.gather(*[copy(item) for item in items])
+    return await dest.Flush()
+
+
+async def CopyNewItems(src, dest, items, dtype='tags'):
+    indexed = await dest.IndexedSubset(items)
+    await CopyItems(src, dest, list(id_difference(items, indexed)), dtype)
+
+
+class SyncGateway(object):
+    '''
+    Blocking facade over an async gateway, so code written against Gateway (e.g.,
+    Gateway.CopyItems) can use it unchanged.  Each coroutine call runs to completion
+    on the wrapper's own event loop.
+    '''
+
+    def __init__(self, gateway):
+        object.__setattr__(self, 'gateway', gateway)
+        object.__setattr__(self, 'loop', asyncio.new_event_loop())
+
+    def run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def __getattr__(self, name):
+        attr = getattr(self.gateway, name)
+        if not asyncio.iscoroutinefunction(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            return self.run(attr(*args, **kwargs))
+        return call
+
+    def __setattr__(self, name, value):
+        # e.g., gateway.level = 'series'
+        setattr(self.gateway, name, value)
+
+    def close(self):
+        self.run(self.gateway.close())
+        self.loop.close()
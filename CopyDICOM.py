@@ -1,59 +1,65 @@
+import time
+# CLI startup is timed from here, see check_startup
+_t0 = time.time() if __name__ == "__main__" else None
+
 import logging
 import argparse
 import collections
-from SessionWrapper import Session
-from StructuredTags import simplify_tags
-from bs4 import BeautifulSoup
+from SessionWrapper import Session, is_error, get_endpoint
+from StructuredTags import simplify_tags, extract_dose_report, get_projection, epoch
 from hashlib import md5
-import time
 import pprint
+import Trace
+from Trace import span
 
+# Optional subsystems (NumPy ID sets, journals, HEC pipelining, thread pools, rate control)
+# are imported inside the sub-commands that use them, so short cron runs only pay for what
+# they need.  Seconds allowed from loading this script to the first request:
+STARTUP_BUDGET = {'replicate': 0.5,
+                  'index_tags': 0.5}
 
-def indexed_instances(index, index_name, q=None):
 
-    def poll_until_done(sid):
-        isDone = False
-        i = 0
-        while not isDone:
-            i = i + 1
-            time.sleep(1)
-            r = index.do_get('services/search/jobs/{0}'.format(sid), params={'output_mode': 'json'})
-            isDone = r['entry'][0]['content']['isDone']
-            status = r['entry'][0]['content']['dispatchState']
-            if i % 5 == 1:
-                logging.debug('Waiting to finish {0} ({1})'.format(i, status))
-        return r['entry'][0]['content']['resultCount']
+# Instances whose destinations are looked up together in transfer_instances
+TARGET_BATCH = 1000
+
+
+def check_startup(name):
+    global _t0
+    if _t0 is None:
+        return
+    elapsed = time.time() - _t0
+    _t0 = None
+    budget = STARTUP_BUDGET.get(name)
+    if budget and elapsed > budget:
+        logging.warn('Startup for {0} took {1:.0f} ms, over the {2:.0f} ms budget'.format(
+            name, elapsed * 1000, budget * 1000))
+    else:
+        logging.debug('Startup for {0} took {1:.0f} ms'.format(name, elapsed * 1000))
+
+
+def indexed_instances(index, index_name, q=None):
+    from SplunkQuery import run_search
 
     if not q:
         q = "search index={0} | spath ID | dedup ID | table ID".format(index_name)
 
-    r = index.do_post('services/search/jobs', data="search={0}".format(q))
+    return run_search(index, q)
 
-    soup = BeautifulSoup(r, 'xml')
-    sid = soup.find('sid').string
 
-    n = poll_until_done(sid)
-    offset = 0
-    instances = []
-    i = 0
-    while offset < n:
-        count = 50000
-        offset = 0 + count*i
-        r = index.do_get('services/search/jobs/{0}/results'.format(sid), params={'output_mode': 'csv', 'count': count, 'offset': offset})
-        instances = instances + r.replace('"', '').splitlines()[1:]
-        i = i+1
-
-    return instances
+def already_indexed(index, index_name, candidates, opts, earliest=None, latest=None):
+    # Only ask the index about the candidates, within --earliest/--latest if given
+    from SplunkQuery import indexed_subset
+    return indexed_subset(index, index_name, candidates,
+                          earliest=earliest or getattr(opts, 'earliest', None),
+                          latest=latest or getattr(opts, 'latest', None),
+                          tstats=opts.tstats, summary_index=opts.summary_index)
 
 
 def index_dose_tags(opts):
+    from IDSet import id_difference
+    from SplunkQuery import date_range_bounds
     logging.info('Replicating dose report tags to index.')
 
-    # Time has to be absent, or passed in as epoch to be a valid request
-    def epoch(dt):
-        tt = dt.timetuple()
-        return time.mktime(tt)
-
     src = Session(opts.src)
     # all_series = src.do_get('series')
 
@@ -74,18 +80,22 @@ def index_dose_tags(opts):
 
     index = Session(opts.index)
 
-    _indexed_instances = indexed_instances(index, opts.index_name)
+    # Dose reports are created on the day of the study, so only search those days
+    earliest, latest = date_range_bounds(opts.study_dates)
+    _indexed_instances = already_indexed(index, opts.index_name, _instances, opts, earliest, latest)
     logging.info("Found {0} instances already indexed.".format(len(_indexed_instances)))
 
-    instances = set(_instances) - set(_indexed_instances)
+    instances = id_difference(_instances, _indexed_instances)
     logging.info("Found {0} new instances to index.".format(len(instances)))
 
-    # HEC uses strange token authorization
-    hec = Session(opts.hec)
+    hec, pipeline = open_hec(opts)
+    projection = get_projection(opts.projection)
 
     for instance in instances:
-        tags = src.do_get('instances/{0}/simplified-tags'.format(instance))
-        simplified_tags = simplify_tags(tags)
+        with span('fetch_tags', id=instance):
+            tags = src.do_get('instances/{0}/simplified-tags'.format(instance))
+        with span('extract_dose_report', id=instance):
+            simplified_tags = extract_dose_report(tags, projection=projection)
         # Add Orthanc ID for future reference
         simplified_tags['ID'] = instance
         data = collections.OrderedDict([('time', epoch(simplified_tags['InstanceCreationDateTime'])),
@@ -94,40 +104,54 @@ def index_dose_tags(opts):
                                         ('index', 'dicom'),
                                         ('event', simplified_tags )])
         # logging.debug(pformat(data))
-        hec.do_post('services/collector/event', data=data)
+        with span('send_event', id=instance):
+            send_event(hec, pipeline, data, instance)
 
+    flush_hec(pipeline)
 
 
 def index_tags(opts):
+    from IDSet import id_difference
+    from Journal import resume_or_plan
+    check_startup('index_tags')
     logging.info('Replicating tags to index.')
 
-    # Time has to be absent, or passed in as epoch to be a valid request
-    def epoch(dt):
-        tt = dt.timetuple()
-        return time.mktime(tt)
-
     src = Session(opts.src)
-    _instances = src.do_get(opts.qlevel)
-    logging.info("Found {0} candidate {1}.".format(len(_instances), opts.qlevel))
+    journal = open_journal(opts)
 
-    index = Session(opts.index)
+    def plan():
+        _instances = in_shard(src.do_get(opts.qlevel), opts)
+        logging.info("Found {0} candidate {1}.".format(len(_instances), opts.qlevel))
+
+        index = Session(opts.index)
+
+        _indexed_instances = already_indexed(index, opts.index_name, _instances, opts)
+        logging.info("Found {0} {1} already indexed.".format(len(_indexed_instances), opts.qlevel))
 
-    _indexed_instances = indexed_instances(index, opts.index_name)
-    logging.info("Found {0} {1} already indexed.".format(len(_indexed_instances), opts.qlevel))
+        return id_difference(_instances, _indexed_instances)
 
-    instances = set(_instances) - set(_indexed_instances)
+    instances = resume_or_plan(journal, plan)
     logging.info("Found {0} new {1} to index.".format(len(instances), opts.qlevel))
 
-    # HEC uses strange token authorization
-    hec = Session(opts.hec)
+    hec, pipeline = open_hec(opts, journal)
+    projection = get_projection(opts.projection)
 
-    for instance in instances:
-        if opts.qlevel != "instances":
-            tags = src.do_get('{0}/{1}/shared-tags?simplify'.format(opts.qlevel, instance))
-        else:
-            tags = src.do_get('{0}/{1}/tags?simplify'.format(opts.qlevel, instance))
+    def fetch_tags():
+        if opts.qlevel == "instances":
+            # One request per series rather than per instance
+            from Gateway import instance_tags_by_series
+            for instance, tags in instance_tags_by_series(src, instances):
+                yield instance, tags
+            return
 
-        simplified_tags = simplify_tags(tags)
+        for instance in instances:
+            with span('fetch_tags', id=instance):
+                tags = src.do_get('{0}/{1}/shared-tags?simplify'.format(opts.qlevel, instance))
+            yield instance, tags
+
+    for instance, tags in fetch_tags():
+        with span('simplify_tags', id=instance):
+            simplified_tags = simplify_tags(tags, projection)
 
         # Add Orthanc ID for future reference
         simplified_tags['ID'] = instance
@@ -140,44 +164,381 @@ def index_tags(opts):
                                         ('index', opts.index_name),
                                         ('event', simplified_tags )])
         # logging.debug(pformat(data))
-        hec.do_post('services/collector/event', data=data)
+        with span('send_event', id=instance):
+            send_event(hec, pipeline, data, instance, journal)
 
+    flush_hec(pipeline, journal)
 
-def copy_instances(src, dest, _instances):
 
-    def get_instance(instance, anonymize=False):
-        if not anonymize:
-            return src.do_get('instances/{0}/file'.format(instance))
-        else:
-            # Have to hash the accession number and patient id
-            tags = src.do_get('instances/{0}/simplified-tags'.format(instance))
+def open_hec(opts, journal=None):
+
+    # HEC uses strange token authorization
+    hec = Session(opts.hec, gzip_min_size=opts.hec_gzip)
+    if not opts.hec_ack:
+        return hec, None
+
+    from HECPipeline import HECPipeline
+
+    def on_ack(instances):
+        # Only journal what the indexers have confirmed
+        if journal:
+            for instance in instances:
+                journal.record(instance)
+
+    pipeline = HECPipeline(hec, batch_size=opts.hec_batch, window=opts.hec_window, on_ack=on_ack)
+    return hec, pipeline
+
+
+def flush_hec(pipeline, journal=None):
+    # Keep the journal if anything failed, so a rerun retries just those items
+    failed = pipeline.flush() if pipeline else []
+    if failed:
+        logging.error('{0} events were never acknowledged, rerun with the same journal to retry them'.format(
+            len(failed)))
+    elif journal:
+        journal.finish()
+    return failed
+
+
+def send_event(hec, pipeline, data, instance, journal=None):
+    if pipeline:
+        pipeline.add(data, instance)
+        return
+    r = hec.do_post('services/collector/event', data=data)
+    if journal and not is_error(r):
+        journal.record(instance)
+
+
+def in_shard(items, opts):
+    # With --shard i/N, only this worker's part of the ID space
+    if not getattr(opts, 'shard', None):
+        return items
+    from Shard import shard_subset
+    items = shard_subset(items, *opts.shard)
+    logging.info('Shard {0}/{1} has {2} candidates.'.format(opts.shard[0], opts.shard[1], len(items)))
+    return items
+
 
-            if tags.get('PatientIdentityRemoved') == "YES":
-                # Already anonymized, return file
-                return src.do_get('instances/{0}/file'.format(instance))
-            else:
-                # Anonymize with hashed PID and AID
-                anon_pid = md5.new(tags['PatientID']).hexdigest()[:8]
-                anon_aid = md5.new(tags['AccessionNumber']).hexdigest()[:8]
-                anon_iid = md5.new(instance).hexdigest()[:8]
-
-                return src.do_post('instances/{0}/anonymize'.format(instance),
-                                    data={'Replace': {'PatientID': anon_pid,
-                                                      'PatientName': anon_pid,
-                                                      'AccessionNumber': anon_aid,
-                                                      'DeidentificationMethod': 'Anonymized from ID {0}'.format(anon_iid)},
-                                          'Keep':    ['StudyDescription',
-                                                      'SeriesDescription']})
+def shard_arg(spec):
+    # Only --shard pays for importing Shard (and NumPy) while parsing
+    from Shard import parse_shard
+    return parse_shard(spec)
 
+
+def run(opts):
+    # Sharded jobs run once per shard this worker ends up holding, see Shard.run_sharded
+    if getattr(opts, 'shard', None):
+        from Shard import run_sharded
+        return run_sharded(opts, opts.func)
+    return opts.func(opts)
+
+
+def open_journal(opts):
+    if not getattr(opts, 'journal', None):
+        return None
+    from Journal import Journal
+    return Journal(opts.journal)
+
+
+def new_instances(dest, _instances):
+    from IDSet import id_difference
     # TODO: Also need to include the list of "Anonymized from" instances as polynyms
     dest_instances = dest.do_get('instances')
-    instances = set(_instances) - set(dest_instances)
+    instances = id_difference(_instances, dest_instances)
     logging.debug('Found {0} new instances out of {1}'.format(len(instances), len(_instances)))
+    return instances
+
+
+def plan_fanout(dests, _instances, needs):
+    # Diff against each destination separately, needs collects the per-destination sets
+    instances = None
+    for dest in dests:
+        dest_needs = new_instances(dest, _instances)
+        needs.append(dest_needs)
+        instances = dest_needs if instances is None else instances | dest_needs
+    logging.info('Found {0} instances needed by {1} destinations'.format(len(instances), len(dests)))
+    return instances
 
-    for instance in instances:
-        dicom = get_instance(instance)
-        headers = {'content-type': 'application/dicom'}
-        dest.do_post('instances', data=dicom, headers=headers)
+
+def copy_instances(src, dests, _instances, journal=None):
+    from Journal import resume_or_plan
+    if not isinstance(dests, list):
+        dests = [dests]
+    needs = []
+    instances = resume_or_plan(journal, lambda: plan_fanout(dests, _instances, needs))
+    transfer_instances(src, dests, instances, journal, needs)
+
+
+def get_instance(src, instance, anonymize=False):
+    if not anonymize:
+        return src.do_get('instances/{0}/file'.format(instance))
+    else:
+        # Have to hash the accession number and patient id
+        tags = src.do_get('instances/{0}/simplified-tags'.format(instance))
+
+        if tags.get('PatientIdentityRemoved') == "YES":
+            # Already anonymized, return file
+            return src.do_get('instances/{0}/file'.format(instance))
+        else:
+            # Anonymize with hashed PID and AID
+            anon_pid = md5.new(tags['PatientID']).hexdigest()[:8]
+            anon_aid = md5.new(tags['AccessionNumber']).hexdigest()[:8]
+            anon_iid = md5.new(instance).hexdigest()[:8]
+
+            return src.do_post('instances/{0}/anonymize'.format(instance),
+                                data={'Replace': {'PatientID': anon_pid,
+                                                  'PatientName': anon_pid,
+                                                  'AccessionNumber': anon_aid,
+                                                  'DeidentificationMethod': 'Anonymized from ID {0}'.format(anon_iid)},
+                                      'Keep':    ['StudyDescription',
+                                                  'SeriesDescription']})
+
+
+def post_instance(dests, dicom, pool=None, encoding=None):
+    headers = {'content-type': 'application/dicom'}
+    if encoding:
+        # Already compressed for the wire, e.g., by Transcode.Fetcher
+        headers['content-encoding'] = encoding
+
+    def post(dest):
+        return dest.do_post('instances', data=dicom, headers=headers)
+
+    if pool and len(dests) > 1:
+        results = pool.map(post, dests)
+    else:
+        results = [post(dest) for dest in dests]
+
+    return not any(is_error(r) for r in results)
+
+
+def transfer_instances(src, dests, instances, journal=None, needs=None, fetch=None, workers=1, encoding=None):
+    '''
+    Fetch each instance once and post it to every destination that needs it, in parallel.
+    Without needs (e.g., resuming from a journal) every destination gets every instance,
+    which is harmless since Orthanc ignores instances it already stores.  fetch(instance)
+    returns the file, by default from src, and workers > 1 copies that many at once.
+    encoding is the content-encoding of what fetch returns, if it compresses.
+    '''
+
+    from multiprocessing.pool import ThreadPool
+    from IDSet import id_batches, id_mask
+
+    if not isinstance(dests, list):
+        dests = [dests]
+    if not fetch:
+        fetch = lambda instance: get_instance(src, instance)
+
+    pool = ThreadPool(len(dests)) if len(dests) > 1 else None
+
+    def planned():
+        # Which destinations need each instance, looked up a batch at a time rather than per instance
+        for batch in id_batches(instances, TARGET_BATCH):
+            if not needs:
+                for instance in batch:
+                    yield instance, dests
+                continue
+            masks = [id_mask(dest_needs, batch) for dest_needs in needs]
+            for i, instance in enumerate(batch):
+                yield instance, [dest for dest, mask in zip(dests, masks) if mask[i]]
+
+    def transfer(job):
+        instance, targets = job
+
+        with span('fetch_instance', id=instance):
+            dicom = fetch(instance)
+        with span('post_instance', id=instance, destinations=len(targets)):
+            ok = post_instance(targets, dicom, pool, encoding)
+        return instance, ok
+
+    copiers = ThreadPool(workers) if workers > 1 else None
+    if copiers:
+        results = copiers.imap_unordered(transfer, planned())
+    else:
+        results = (transfer(job) for job in planned())
+
+    for instance, ok in results:
+        if journal and ok:
+            journal.record(instance)
+
+    for p in [pool, copiers]:
+        if p:
+            p.close()
+            p.join()
+    if journal:
+        journal.finish()
+
+
+def search_stream(index, q):
+    # The export endpoint streams results while the search is still running
+    lines = index.do_stream('services/search/jobs/export', data={'search': q, 'output_mode': 'csv'})
+    for line in lines:
+        item = line.replace('"', '').strip()
+        # Skip the csv header
+        if item and item != 'ID':
+            yield item
+
+
+def pipelined_replicate(src, dests, index, q, journal=None, workers=4, batch_size=100, lookup_threshold=1000,
+                        fetch=None, encoding=None):
+    '''
+    Overlap the Splunk search, the destination diff and the copy:
+
+    - a search thread streams IDs from the export endpoint in batches
+    - a diff thread checks each batch against the destinations and queues what's missing
+    - copy workers fetch and post instances as soon as they are queued
+
+    Each batch is checked with per-ID lookups as soon as it arrives.  Once more than
+    lookup_threshold candidates have arrived, each destination is also listed in the
+    background, and batches after that listing completes are diffed against it instead.
+
+    If the search or the diff fails, every stage stops and the error is raised here.  The
+    journal is only finished if every instance was copied.
+    '''
+
+    from IDSet import IDSet, id_mask
+    from multiprocessing.pool import ThreadPool
+    import threading
+    try:
+        from Queue import Queue, Empty, Full
+    except ImportError:
+        from queue import Queue, Empty, Full
+
+    candidates = Queue(maxsize=64)
+    work = Queue(maxsize=workers * 4)
+    lookups = ThreadPool(workers)
+    # A previous streamed run of this job may have finished some already
+    finished = journal.done() if journal else IDSet()
+    stop = threading.Event()
+    errors = []
+    failed = []
+
+    def put(queue, item):
+        # Give up once another stage has failed, rather than block on a queue nobody reads
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def get(queue):
+        # None once the producer is done, or another stage has failed
+        while not stop.is_set():
+            try:
+                return queue.get(timeout=1)
+            except Empty:
+                pass
+        return None
+
+    def stage(f):
+        def run():
+            try:
+                f()
+            except Exception as e:
+                logging.error('Stopping the pipeline, {0} failed: {1}'.format(f.__name__, e))
+                errors.append(e)
+                stop.set()
+        return run
+
+    def search():
+        batch = []
+        for item in search_stream(index, q):
+            batch.append(item)
+            if len(batch) >= batch_size:
+                if not put(candidates, batch):
+                    return
+                batch = []
+        if batch:
+            put(candidates, batch)
+        put(candidates, None)
+
+    def lookup(dest, items):
+        found = lookups.map(lambda item: not is_error(dest.do_get('instances/{0}'.format(item))), items)
+        return set(item for item, f in zip(items, found) if f)
+
+    listings = []
+    listed = threading.Event()
+
+    def list_destinations():
+        try:
+            for dest in dests:
+                r = dest.do_get('instances')
+                if is_error(r):
+                    raise RuntimeError(r)
+                listings.append(IDSet(r))
+            listed.set()
+        except Exception as e:
+            logging.warn('Could not list destinations, looking up every candidate: {0}'.format(e))
+
+    def enqueue(batch, present):
+        masks = [id_mask(p, batch) for p in present]
+        for i, instance in enumerate(batch):
+            targets = [dest for dest, mask in zip(dests, masks) if not mask[i]]
+            if targets and not put(work, (instance, targets)):
+                return
+
+    def diff():
+        try:
+            seen = 0
+            listing = None
+            while True:
+                batch = get(candidates)
+                if batch is None:
+                    break
+                seen = seen + len(batch)
+                if listing is None and seen > lookup_threshold:
+                    logging.debug('More than {0} candidates, listing destinations'.format(lookup_threshold))
+                    listing = threading.Thread(target=list_destinations)
+                    listing.daemon = True
+                    listing.start()
+                batch = [item for item, done in zip(batch, id_mask(finished, batch)) if not done]
+                if not batch:
+                    continue
+                if listed.is_set():
+                    enqueue(batch, listings)
+                else:
+                    enqueue(batch, [lookup(dest, batch) for dest in dests])
+        finally:
+            for i in range(workers):
+                put(work, None)
+
+    def copy():
+        while True:
+            job = get(work)
+            if job is None:
+                return
+            instance, targets = job
+            ok = False
+            try:
+                with span('fetch_instance', id=instance):
+                    dicom = fetch(instance) if fetch else get_instance(src, instance)
+                if not is_error(dicom):
+                    with span('post_instance', id=instance, destinations=len(targets)):
+                        ok = post_instance(targets, dicom, encoding=encoding)
+            except Exception as e:
+                # Keep draining the queue so the other stages can't block on a dead worker
+                logging.error('Failed to copy {0}: {1}'.format(instance, e))
+            if not ok:
+                failed.append(instance)
+            elif journal:
+                journal.record(instance)
+
+    threads = [threading.Thread(target=stage(search)), threading.Thread(target=stage(diff))] + \
+              [threading.Thread(target=copy) for i in range(workers)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+
+    lookups.close()
+    if errors:
+        raise errors[0]
+    if failed:
+        logging.error('Failed to copy {0} instances, keeping the journal to retry them'.format(len(failed)))
+    elif journal:
+        journal.finish()
 
 
 def index_remote_tags(src, remote, index):
@@ -201,32 +562,159 @@ def index_remote_tags(src, remote, index):
 
 
 def conditional_replicate(opts):
+    from Journal import resume_or_plan
 
     src = Session(opts.src)
-    dest = Session(opts.dest)
-    index = Session(opts.index)
-    instances = indexed_instances(index, q=opts.query)
-    # TODO: Confirm those instances exist on src
-    copy_instances(src, dest, instances)
+    dests = [Session(dest) for dest in opts.dest]
+    journal = open_journal(opts)
+    needs = []
+    fetch = open_fetcher(src, opts)
+
+    if opts.pipeline and not (journal and journal.resuming()):
+        pipelined_replicate(src, dests, Session(opts.index), opts.query, journal,
+                            workers=opts.workers, batch_size=opts.batch_size,
+                            lookup_threshold=opts.lookup_threshold,
+                            fetch=fetch, encoding=fetch.encoding)
+        fetch.stats.report()
+        return
+
+    def plan():
+        index = Session(opts.index)
+        instances = indexed_instances(index, None, q=opts.query)
+        # TODO: Confirm those instances exist on src
+        return plan_fanout(dests, instances, needs)
+
+    instances = resume_or_plan(journal, plan)
+    transfer_instances(src, dests, instances, journal, needs, fetch=fetch, encoding=fetch.encoding)
+    fetch.stats.report()
+
+
+def open_fetcher(src, opts):
+    # Counts bytes stored against bytes sent, and compresses with --transcode and --gzip
+    from Transcode import Fetcher
+    return Fetcher(src, syntax=opts.transcode, gzip=opts.gzip, measure_stored=opts.measure_stored)
 
 
 def replicate(opts):
+    from Journal import resume_or_plan
+    check_startup('replicate')
+    src = Session(opts.src)
+    dests = [Session(dest) for dest in opts.dest]
+    journal = open_journal(opts)
+    needs = []
+    instances = resume_or_plan(journal, lambda: plan_fanout(dests, in_shard(src.do_get('instances'), opts), needs))
+    fetch = open_fetcher(src, opts)
+    transfer_instances(src, dests, instances, journal, needs, fetch=fetch, encoding=fetch.encoding)
+    fetch.stats.report()
+
+
+def ingest(opts):
+    from Gateway import FileGateway
+    from IDSet import IDSet
+    from Journal import resume_or_plan
+
+    files = FileGateway(address=opts.path, workers=opts.scanners)
+    dests = [Session(dest) for dest in opts.dest]
+    journal = open_journal(opts)
+    needs = []
+
+    # Resumed jobs read the ID to path mapping back from the journal, rather than parse every header
+    saved = journal.load_files() if journal and journal.resuming() else None
+    if saved:
+        files.files, files.unparsed = saved
+    else:
+        files.ListItems()
+        if journal:
+            journal.save_files(files.files, files.unparsed)
+    instances = resume_or_plan(journal, lambda: plan_fanout(dests, IDSet(files.files.keys()), needs))
+    transfer_instances(None, dests, instances, journal, needs,
+                       fetch=lambda instance: files.GetItem(instance, 'file'), workers=opts.workers)
+
+    # Files without a readable header can't be diffed, so Orthanc gets to sort them out
+    if files.unparsed:
+        logging.info('Uploading {0} files whose header could not be read'.format(len(files.unparsed)))
+        for fn in files.unparsed:
+            post_instance(dests, files.read(fn))
+
+
+def compact_journal(opts):
+    journal = open_journal(opts)
+    if not journal.resuming():
+        logging.info('No job in journal {0}.'.format(opts.journal))
+        return
+    instances = journal.compact()
+    journal.close()
+    logging.info('Journal {0} has {1} items remaining.'.format(opts.journal, len(instances)))
+
+
+def purge(opts):
+    import Retention
+
+    src = Session(opts.src)
+    dests = [Session(dest) for dest in opts.replicated_to or []]
+    verified_on = [Session(dest) for dest in opts.verified_on or []]
+    items = Retention.select(src, opts.level, older_than=opts.older_than, label=opts.label,
+                             replicated_to=dests, verified_on=verified_on, workers=opts.workers)
+    Retention.purge(src, opts.level, items, workers=opts.workers, bulk=opts.bulk, dry_run=opts.dry_run)
+
+
+def verify(opts):
+    import Verify
+
     src = Session(opts.src)
-    dest = Session(opts.dest)
-    instances = src.do_get('instances')
-    copy_instances(src, dest, instances)
+    dests = [Session(dest) for dest in opts.dest]
+    r = Verify.verify(src, dests, rate=opts.sample, salt=opts.salt, workers=opts.workers)
+    if opts.recopy:
+        Verify.write_recopy(opts.recopy, r['recopy'])
+
+
+def configure_rate_control(opts):
+
+    if not (opts.max_rps or opts.max_mbps or opts.target_latency or opts.schedule):
+        return
+
+    import RateControl
 
+    endpoint = opts.throttle
+    if not endpoint and getattr(opts, 'src', None):
+        endpoint = get_endpoint(opts.src)
 
-def parse_args(args):
+    RateControl.configure(endpoint or '*',
+                          requests_per_sec=opts.max_rps,
+                          bytes_per_sec=opts.max_mbps * 1024 * 1024 if opts.max_mbps else None,
+                          target_latency=opts.target_latency,
+                          max_concurrency=opts.max_concurrency,
+                          schedule=opts.schedule)
+
+
+def parse_args(args=None):
 
     # create the top-level parser
     parser = argparse.ArgumentParser(prog='CopyDICOM')
+    parser.add_argument('--throttle', help="Endpoint (host:port) to rate control, defaults to the --src host")
+    parser.add_argument('--max_rps', type=float, help="Requests per second to the throttled endpoint")
+    parser.add_argument('--max_mbps', type=float, help="Megabytes per second to and from the throttled endpoint")
+    parser.add_argument('--target_latency', type=float,
+                        help="Back off concurrency when p95 latency at the throttled endpoint exceeds this (sec)")
+    parser.add_argument('--max_concurrency', type=int, default=32, help="Upper bound for adaptive concurrency")
+    parser.add_argument('--schedule', help="Time-of-day rate multipliers, e.g. '07:00-19:00=0.25,19:00-07:00=1'")
+    parser.add_argument('--trace', help="Write per-item stage timings to this file as Chrome trace-event json")
+    parser.add_argument('--profile', help="Write cProfile stats for the run to this file")
     subparsers = parser.add_subparsers()
 
     parser_a = subparsers.add_parser('replicate',
                                      help='Copy non-redundant images from one Orthanc to another.')
     parser_a.add_argument('--src')
-    parser_a.add_argument('--dest')
+    parser_a.add_argument('--dest', action='append', help="Destination Orthanc, repeat to fan out to several")
+    parser_a.add_argument('--journal', help="Progress journal file for resuming interrupted jobs")
+    parser_a.add_argument('--shard', type=shard_arg, help="Only copy this worker's part of the instances, i/N")
+    parser_a.add_argument('--lease', help="SQLite file of shard leases shared by the workers")
+    parser_a.add_argument('--lease_ttl', type=float, default=60, help="Seconds without a heartbeat before a shard is taken over")
+    parser_a.add_argument('--transcode', choices=['jpeg-ls', 'jpeg2000', 'jpeg-lossless', 'deflate'],
+                          help="Have the source send a lossless compressed transfer syntax")
+    parser_a.add_argument('--gzip', action='store_true', help="Gzip files on the way to the destinations")
+    parser_a.add_argument('--measure_stored', action='store_true',
+                          help="Look up each transcoded file's stored size for the transfer stats")
     parser_a.set_defaults(func=replicate)
 
     parser_b = subparsers.add_parser('index_tags',
@@ -236,6 +724,20 @@ def parse_args(args):
     parser_b.add_argument('--index', help="Splunk API address")
     parser_b.add_argument('--index_name', help="Splunk index name")
     parser_b.add_argument('--hec',   help="Splunk HEC address")
+    parser_b.add_argument('--hec_gzip', type=int, help="Gzip HEC events at least this many bytes long")
+    parser_b.add_argument('--hec_ack', action='store_true', help="Confirm delivery with HEC indexer acknowledgement")
+    parser_b.add_argument('--hec_window', type=int, default=8, help="Batches awaiting acknowledgement at once")
+    parser_b.add_argument('--hec_batch', type=int, default=100, help="Events per HEC batch")
+    parser_b.add_argument('--journal', help="Progress journal file for resuming interrupted jobs")
+    parser_b.add_argument('--projection', default='none', choices=['none', 'full', 'series', 'instances'],
+                          help="Tags to keep in each event (see StructuredTags.PROJECTIONS)")
+    parser_b.add_argument('--earliest', help="Only look for indexed events since, e.g., -30d@d")
+    parser_b.add_argument('--latest', help="Only look for indexed events until")
+    parser_b.add_argument('--tstats', action='store_true', help="Look up IDs with tstats (ID is an indexed field)")
+    parser_b.add_argument('--summary_index', help="Look up IDs in this summary index instead of raw events")
+    parser_b.add_argument('--shard', type=shard_arg, help="Only index this worker's part of the items, i/N")
+    parser_b.add_argument('--lease', help="SQLite file of shard leases shared by the workers")
+    parser_b.add_argument('--lease_ttl', type=float, default=60, help="Seconds without a heartbeat before a shard is taken over")
     parser_b.set_defaults(func=index_tags)
 
     parser_c = subparsers.add_parser('index_dose_tags',
@@ -245,6 +747,14 @@ def parse_args(args):
     parser_c.add_argument('--index', help="Splunk API address")
     parser_c.add_argument('--index_name', help="Splunk index name")
     parser_c.add_argument('--hec',   help="Splunk HEC address")
+    parser_c.add_argument('--hec_gzip', type=int, help="Gzip HEC events at least this many bytes long")
+    parser_c.add_argument('--hec_ack', action='store_true', help="Confirm delivery with HEC indexer acknowledgement")
+    parser_c.add_argument('--hec_window', type=int, default=8, help="Batches awaiting acknowledgement at once")
+    parser_c.add_argument('--hec_batch', type=int, default=100, help="Events per HEC batch")
+    parser_c.add_argument('--projection', default='none', choices=['none', 'full', 'dose'],
+                          help="Tags to keep in each event (see StructuredTags.PROJECTIONS)")
+    parser_c.add_argument('--tstats', action='store_true', help="Look up IDs with tstats (ID is an indexed field)")
+    parser_c.add_argument('--summary_index', help="Look up IDs in this summary index instead of raw events")
     parser_c.set_defaults(func=index_dose_tags)
 
     parser_d = subparsers.add_parser('conditional_replicate',
@@ -252,7 +762,18 @@ def parse_args(args):
     parser_d.add_argument('--src')
     parser_d.add_argument('--index')
     parser_d.add_argument('--query')
-    parser_d.add_argument('--dest')
+    parser_d.add_argument('--dest', action='append', help="Destination Orthanc, repeat to fan out to several")
+    parser_d.add_argument('--journal', help="Progress journal file for resuming interrupted jobs")
+    parser_d.add_argument('--pipeline', action='store_true', help="Overlap the search, diff and copy")
+    parser_d.add_argument('--workers', type=int, default=4, help="Copy workers in pipelined mode")
+    parser_d.add_argument('--batch_size', type=int, default=100, help="Search results per diff batch")
+    parser_d.add_argument('--lookup_threshold', type=int, default=1000,
+                          help="List destinations in the background once past this many candidates")
+    parser_d.add_argument('--transcode', choices=['jpeg-ls', 'jpeg2000', 'jpeg-lossless', 'deflate'],
+                          help="Have the source send a lossless compressed transfer syntax")
+    parser_d.add_argument('--gzip', action='store_true', help="Gzip files on the way to the destinations")
+    parser_d.add_argument('--measure_stored', action='store_true',
+                          help="Look up each transcoded file's stored size for the transfer stats")
     parser_d.set_defaults(func=conditional_replicate)
 
     parser_e = subparsers.add_parser('index_remote_tags',
@@ -264,6 +785,45 @@ def parse_args(args):
     parser_e.add_argument('--hec',   help="Splunk HEC address")
     parser_e.set_defaults(func=index_remote_tags)
 
+    parser_i = subparsers.add_parser('ingest',
+                                     help='Copy non-redundant DICOM files from a directory tree to Orthanc.')
+    parser_i.add_argument('--path', help="Directory to walk")
+    parser_i.add_argument('--dest', action='append', help="Destination Orthanc, repeat to fan out to several")
+    parser_i.add_argument('--journal', help="Progress journal file for resuming interrupted jobs")
+    parser_i.add_argument('--workers', type=int, default=8, help="Concurrent uploads")
+    parser_i.add_argument('--scanners', type=int, help="Header parsing processes (defaults to one per cpu)")
+    parser_i.set_defaults(func=ingest)
+
+    parser_f = subparsers.add_parser('compact_journal',
+                                     help='Fold completed items into the work list of an interrupted job journal')
+    parser_f.add_argument('--journal')
+    parser_f.set_defaults(func=compact_journal)
+
+    parser_g = subparsers.add_parser('purge',
+                                     help='Delete resources matching every given retention rule from an Orthanc')
+    parser_g.add_argument('--src')
+    parser_g.add_argument('--level', default='studies', choices=['patients', 'studies', 'series', 'instances'])
+    parser_g.add_argument('--older_than', type=float, help="Not updated in this many days")
+    parser_g.add_argument('--label', help="Carrying this Orthanc label")
+    parser_g.add_argument('--replicated_to', action='append',
+                          help="Every instance already stored on this Orthanc, repeat for several")
+    parser_g.add_argument('--verified_on', action='append',
+                          help="Every instance stored on this Orthanc with a matching MD5, repeat for several")
+    parser_g.add_argument('--workers', type=int, default=8, help="Concurrent delete requests")
+    parser_g.add_argument('--bulk', action='store_true', help="Delete in batches with tools/bulk-delete")
+    parser_g.add_argument('--dry_run', action='store_true', help="Only report what would be deleted")
+    parser_g.set_defaults(func=purge)
+
+    parser_h = subparsers.add_parser('verify',
+                                     help='Compare stored MD5s of source instances with their copies on other Orthancs')
+    parser_h.add_argument('--src')
+    parser_h.add_argument('--dest', action='append', help="Replica Orthanc, repeat to check several")
+    parser_h.add_argument('--sample', type=float, default=1.0, help="Fraction of instances to check")
+    parser_h.add_argument('--salt', default='', help="Changes which instances are sampled, e.g., today's date")
+    parser_h.add_argument('--workers', type=int, default=8, help="Series checked at once")
+    parser_h.add_argument('--recopy', help="Write missing and mismatched instance IDs to this file")
+    parser_h.set_defaults(func=verify)
+
     return parser.parse_args(args)
 
 
@@ -272,4 +832,15 @@ if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
     opts = parse_args()
     logging.debug(opts)
-    opts.func(opts)
+    configure_rate_control(opts)
+
+    if opts.trace:
+        Trace.enable(opts.trace)
+    try:
+        if opts.profile:
+            import cProfile
+            cProfile.runctx('run(opts)', globals(), locals(), opts.profile)
+        else:
+            run(opts)
+    finally:
+        Trace.save()
@@ -0,0 +1,154 @@
+'''Just enough of a DICOM Part 10 parser to compute an instance's Orthanc ID from its header'''
+
+import hashlib
+import mmap
+from struct import unpack_from, error as StructError
+
+IMPLICIT_VR_LE = '1.2.840.10008.1.2'
+EXPLICIT_VR_BE = '1.2.840.10008.1.2.2'
+DEFLATED_VR_LE = '1.2.840.10008.1.2.1.99'
+
+TRANSFER_SYNTAX_UID = 0x00020010
+SPECIFIC_CHARACTER_SET = 0x00080005
+SOP_INSTANCE_UID = 0x00080018
+PATIENT_ID = 0x00100020
+STUDY_INSTANCE_UID = 0x0020000D
+SERIES_INSTANCE_UID = 0x0020000E
+
+UNDEFINED_LENGTH = 0xFFFFFFFF
+
+# Python codecs for the single-byte and multi-byte Specific Character Set terms.  Orthanc
+# decodes with the same set, falling back to Latin-1 (its default encoding) for anything else,
+# and hashes the UTF-8 result.
+CHARACTER_SETS = {'': 'ascii', 'ISO_IR 6': 'ascii',
+                  'ISO_IR 100': 'latin_1', 'ISO_IR 101': 'iso8859_2', 'ISO_IR 109': 'iso8859_3',
+                  'ISO_IR 110': 'iso8859_4', 'ISO_IR 144': 'iso8859_5', 'ISO_IR 127': 'iso8859_6',
+                  'ISO_IR 126': 'iso8859_7', 'ISO_IR 138': 'iso8859_8', 'ISO_IR 148': 'iso8859_9',
+                  'ISO_IR 203': 'iso8859_15', 'ISO_IR 13': 'shift_jis', 'ISO_IR 166': 'tis_620',
+                  'ISO_IR 192': 'utf_8', 'GB18030': 'gb18030', 'GBK': 'gbk'}
+
+# Explicit VRs with a 2-byte reserved field and 4-byte length
+LONG_VRS = set([b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV', b'UC', b'UN', b'UR', b'UT', b'UV'])
+
+# Item, item delimiter and sequence delimiter tags carry no VR in any syntax
+ITEM = 0xFFFEE000
+ITEM_DELIMITER = 0xFFFEE00D
+SEQUENCE_DELIMITER = 0xFFFEE0DD
+
+
+def element(buf, pos, explicit):
+    '''Returns (tag, header length, value length) of the data element at pos'''
+
+    group, elem = unpack_from('<HH', buf, pos)
+    tag = (group << 16) | elem
+    if group == 0xFFFE or not explicit:
+        return tag, 8, unpack_from('<I', buf, pos + 4)[0]
+    vr = bytes(buf[pos + 4:pos + 6])
+    if vr in LONG_VRS:
+        return tag, 12, unpack_from('<I', buf, pos + 8)[0]
+    return tag, 8, unpack_from('<H', buf, pos + 6)[0]
+
+
+def skip_undefined(buf, pos, explicit):
+    '''
+    Skip the contents of an undefined-length sequence or item, returning the position just
+    past its delimiter.  Nested undefined-length sequences and items are skipped recursively.
+    '''
+
+    while True:
+        tag, header, length = element(buf, pos, explicit)
+        pos = pos + header
+        if tag == ITEM_DELIMITER or tag == SEQUENCE_DELIMITER:
+            return pos
+        if length == UNDEFINED_LENGTH:
+            pos = skip_undefined(buf, pos, explicit)
+        else:
+            pos = pos + length
+
+
+def raw(buf, pos, length):
+    return bytes(buf[pos:pos + length]).strip(b' \x00')
+
+
+def text(value, charset=None):
+    '''Decode a raw value in charset, the first term of its Specific Character Set'''
+    try:
+        return value.decode(CHARACTER_SETS.get(charset, 'latin_1'))
+    except UnicodeDecodeError:
+        return value.decode('latin_1')
+
+
+def read_ids(buf):
+    '''
+    (PatientID, StudyInstanceUID, SeriesInstanceUID, SOPInstanceUID) from the start of a
+    Part 10 file.  Stops at the first element past SeriesInstanceUID, so only the first few
+    pages of a memory-mapped file are ever touched.  Returns None for anything that isn't
+    cheap to parse (no preamble, deflated or big endian data sets, truncated headers).
+    '''
+
+    if len(buf) < 132 or bytes(buf[128:132]) != b'DICM':
+        return None
+
+    values = {}
+    try:
+        # File meta information is always explicit VR little endian
+        pos = 132
+        while unpack_from('<H', buf, pos)[0] == 0x0002:
+            tag, header, length = element(buf, pos, True)
+            if tag == TRANSFER_SYNTAX_UID:
+                values[tag] = text(raw(buf, pos + header, length))
+            pos = pos + header + length
+
+        syntax = values.get(TRANSFER_SYNTAX_UID)
+        if syntax in [EXPLICIT_VR_BE, DEFLATED_VR_LE]:
+            return None
+        explicit = syntax != IMPLICIT_VR_LE
+
+        while pos + 8 <= len(buf):
+            tag, header, length = element(buf, pos, explicit)
+            if tag > SERIES_INSTANCE_UID:
+                break
+            pos = pos + header
+            if length == UNDEFINED_LENGTH:
+                pos = skip_undefined(buf, pos, explicit)
+                continue
+            if tag in [SPECIFIC_CHARACTER_SET, SOP_INSTANCE_UID, PATIENT_ID, STUDY_INSTANCE_UID,
+                       SERIES_INSTANCE_UID]:
+                values[tag] = raw(buf, pos, length)
+            pos = pos + length
+
+    except StructError:
+        return None
+
+    if not all(values.get(tag) for tag in [SOP_INSTANCE_UID, STUDY_INSTANCE_UID, SERIES_INSTANCE_UID]):
+        return None
+
+    # Only the first term matters, later ones are ISO 2022 code extensions
+    charset = text(values.get(SPECIFIC_CHARACTER_SET, b'')).split('\\')[0].strip()
+    return tuple(text(values.get(tag, b''), charset)
+                 for tag in [PATIENT_ID, STUDY_INSTANCE_UID, SERIES_INSTANCE_UID, SOP_INSTANCE_UID])
+
+
+def orthanc_id(*uids):
+    '''Orthanc's ID for a resource, the SHA-1 of its identifying tags joined with "|"'''
+    h = hashlib.sha1('|'.join(uids).encode('utf-8')).hexdigest()
+    return '-'.join(h[i:i + 8] for i in range(0, 40, 8))
+
+
+def instance_id(fn):
+    '''(fn, Orthanc instance ID) for a DICOM file, or (fn, None) if its header can't be read'''
+
+    try:
+        with open(fn, 'rb') as fp:
+            buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError):
+        # ValueError for empty files, which can't be mapped
+        return fn, None
+
+    try:
+        ids = read_ids(buf)
+        return fn, orthanc_id(*ids) if ids else None
+    except (UnicodeError, LookupError):
+        return fn, None
+    finally:
+        buf.close()
@@ -0,0 +1,202 @@
+'''Columnar, vectorized summaries of CT dose reports for ACR dose audits'''
+
+import argparse
+import json
+import logging
+import numpy as np
+
+# Per-acquisition columns pulled out of simplified (and normalized) or extracted dose reports
+TEXT_FIELDS = ['ID', 'AccessionNumber', 'StationName', 'Protocol', 'TargetRegion']
+NUMERIC_FIELDS = ['CTDIvol', 'DLP', 'ScanLength']
+
+
+def as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+def first(value):
+    # Repeated concept names simplify into lists, keep the first
+    if isinstance(value, list):
+        return value[0] if value else None
+    return value
+
+
+def as_float(value):
+    try:
+        return float(first(value))
+    except (TypeError, ValueError):
+        return np.nan
+
+
+# Extracted dose records (StructuredTags.extract_dose_report) have one list per column instead
+EXTRACTED_FIELDS = {'Protocol': 'CT Acquisition/Acquisition Protocol',
+                    'TargetRegion': 'CT Acquisition/Target Region',
+                    'CTDIvol': 'CT Acquisition/CT Dose/Mean CTDIvol',
+                    'DLP': 'CT Acquisition/CT Dose/DLP',
+                    'ScanLength': 'CT Acquisition/CT Acquisition Parameters/Scanning Length'}
+
+
+def extracted_acquisitions(report):
+    columns = dict((field, as_list(report.get(key))) for field, key in EXTRACTED_FIELDS.items())
+    for i in range(max(len(values) for values in columns.values())):
+        record = {'ID': report.get('ID'),
+                  'AccessionNumber': report.get('AccessionNumber'),
+                  'StationName': report.get('StationName'),
+                  'Time': report.get('InstanceCreationDateTime')}
+        for field, values in columns.items():
+            record[field] = values[i] if i < len(values) else None
+        yield record
+
+
+def acquisitions(report):
+    '''Yield one flat record per CT Acquisition in a simplified or extracted dose report'''
+
+    if "X-Ray Radiation Dose Report" not in report:
+        for record in extracted_acquisitions(report):
+            yield record
+        return
+
+    dose_report = report.get("X-Ray Radiation Dose Report") or {}
+
+    for acquisition in as_list(dose_report.get("CT Acquisition")):
+        if not isinstance(acquisition, dict):
+            continue
+        dose = first(acquisition.get("CT Dose")) or {}
+        params = first(acquisition.get("CT Acquisition Parameters")) or {}
+        yield {'ID': report.get('ID'),
+               'AccessionNumber': report.get('AccessionNumber'),
+               'StationName': report.get('StationName'),
+               'Time': report.get('InstanceCreationDateTime'),
+               'Protocol': first(acquisition.get('Acquisition Protocol')),
+               'TargetRegion': first(acquisition.get('Target Region')),
+               'CTDIvol': dose.get('Mean CTDIvol'),
+               'DLP': dose.get('DLP'),
+               'ScanLength': params.get('Scanning Length')}
+
+
+def flatten_dose_reports(reports):
+    '''Convert a batch of simplified dose reports into a dict of per-acquisition column arrays'''
+
+    columns = dict((field, []) for field in TEXT_FIELDS + NUMERIC_FIELDS + ['Time'])
+    for report in reports:
+        for record in acquisitions(report):
+            for field in columns:
+                columns[field].append(record[field])
+
+    ret = {}
+    for field in TEXT_FIELDS:
+        ret[field] = np.array([u'' if v is None else u'{0}'.format(v) for v in columns[field]], dtype=np.str_)
+    for field in NUMERIC_FIELDS:
+        ret[field] = np.array([as_float(v) for v in columns[field]], dtype=np.float64)
+    ret['Time'] = np.array([v or 'NaT' for v in columns['Time']], dtype='datetime64[us]')
+    return ret
+
+
+def concat(batches):
+    batches = list(batches)
+    if not batches:
+        return flatten_dose_reports([])
+    return dict((field, np.concatenate([b[field] for b in batches])) for field in batches[0])
+
+
+def flatten_batches(reports, batch_size=10000):
+    '''Flatten an arbitrarily long stream of reports without holding them all in memory'''
+
+    batches = []
+    batch = []
+    for report in reports:
+        batch.append(report)
+        if len(batch) >= batch_size:
+            batches.append(flatten_dose_reports(batch))
+            batch = []
+    batches.append(flatten_dose_reports(batch))
+    return concat(batches)
+
+
+def group_stats(columns, by='Protocol', value='CTDIvol', percentiles=(50, 75, 95)):
+    '''
+    Count, sum, mean, min, max and percentiles of value for each distinct key in by,
+    computed with one sort for the whole table rather than a python loop per group
+    '''
+
+    values = columns[value]
+    valid = ~np.isnan(values)
+    keys, inverse = np.unique(columns[by][valid], return_inverse=True)
+    inverse = inverse.ravel()
+    values = values[valid]
+
+    count = np.bincount(inverse, minlength=len(keys))
+    total = np.bincount(inverse, weights=values, minlength=len(keys))
+
+    # Sort by group, then value, so each group is a contiguous sorted run
+    order = np.lexsort((values, inverse))
+    ordered = values[order]
+    start = np.concatenate([[0], np.cumsum(count)[:-1]]).astype(np.int64)
+    last = start + count - 1
+
+    ret = {by: keys,
+           'count': count,
+           'sum': total,
+           'mean': total / np.maximum(count, 1),
+           'min': ordered[start] if len(keys) else np.empty(0),
+           'max': ordered[last] if len(keys) else np.empty(0)}
+
+    # Linear interpolation between closest ranks, like np.percentile
+    for p in percentiles:
+        pos = start + (count - 1) * (p / 100.0)
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.ceil(pos).astype(np.int64)
+        frac = pos - lo
+        ret['p{0}'.format(p)] = ordered[lo] * (1 - frac) + ordered[hi] * frac if len(keys) else np.empty(0)
+
+    return ret
+
+
+def format_stats(stats, by):
+    fields = [by, 'count', 'mean', 'min', 'max'] + sorted(k for k in stats if k.startswith('p'))
+    lines = ['\t'.join(fields)]
+    for i in range(len(stats[by])):
+        row = [stats[by][i]] + ['{0:.2f}'.format(stats[f][i]) if f != 'count' else str(stats[f][i])
+                                for f in fields[1:]]
+        lines.append('\t'.join(row))
+    return '\n'.join(lines)
+
+
+def load_reports(fn):
+    '''Read simplified dose reports from a json array or newline-delimited json file'''
+    with open(fn) as fp:
+        head = fp.read(1)
+        fp.seek(0)
+        if head == '[':
+            for report in json.load(fp):
+                yield report
+        else:
+            for line in fp:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def reports_from_index(gateway, index_name='dose'):
+    '''Stream simplified dose reports back out of a local SQLiteGateway'''
+    table = gateway.index_names[index_name]
+    for row in gateway.Query('SELECT _raw FROM {0}'.format(gateway.quote(table))):
+        yield json.loads(row[0])
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(prog='DoseAnalytics')
+    parser.add_argument('reports', help='Simplified dose reports, as a json array or ndjson')
+    parser.add_argument('--by', default='Protocol', choices=['Protocol', 'StationName', 'TargetRegion'])
+    parser.add_argument('--value', default='CTDIvol', choices=NUMERIC_FIELDS)
+    opts = parser.parse_args()
+
+    columns = flatten_batches(load_reports(opts.reports))
+    logging.info('Flattened {0} acquisitions'.format(len(columns['ID'])))
+    print(format_stats(group_stats(columns, opts.by, opts.value), opts.by))
@@ -1,24 +1,115 @@
-
 # Splunk exports deformed JSON.  This script goes thorugh each line, grabs the _raw field,
 # converts it back into Python data structures and redumps whatever it can.
+#
+# The export is split into byte ranges on line boundaries that are parsed in a process
+# pool, and results are written out as each range finishes, so memory use stays flat
+# no matter how large the export is.
 
+import argparse
 import json
-import pprint
-
-# Extract and reformat raw JSON from Splunk dump
-with file("/Users/Derek/Downloads/xa_dose_reports.json") as fp:
-    l = fp.readline()
-    t = []
-    while l:
-        s = json.loads(l)
+import logging
+import os
+from multiprocessing import Pool, cpu_count
+
+CHUNK_SIZE = 32 * 1024 * 1024
+
+
+def chunk_ranges(fn, chunk_size=CHUNK_SIZE):
+    '''Split a file into (fn, start, end) byte ranges that each end on a line boundary'''
+
+    size = os.path.getsize(fn)
+    ranges = []
+    with open(fn, 'rb') as fp:
+        start = 0
+        while start < size:
+            end = start + chunk_size
+            if end < size:
+                fp.seek(end)
+                fp.readline()
+                end = fp.tell()
+            end = min(end, size)
+            ranges.append((fn, start, end))
+            start = end
+    return ranges
+
+
+def convert_range(args):
+    '''Parse one byte range, returns (json strings, lines read, malformed lines)'''
+
+    fn, start, end = args
+    with open(fn, 'rb') as fp:
+        fp.seek(start)
+        data = fp.read(end - start)
+
+    results = []
+    n_lines = 0
+    n_malformed = 0
+    for line in data.splitlines():
+        if not line.strip():
+            continue
+        n_lines = n_lines + 1
         try:
+            s = json.loads(line.decode('utf-8'))
             ss = json.loads(s["result"]["_raw"])
-            # pprint.pprint(ss)
-            t.append(ss)
-        except:
+        except (ValueError, KeyError, TypeError) as e:
             # Occassionally malformed raw?
-            pass
-        l = fp.readline()
+            logging.debug('Malformed line in bytes {0}-{1}: {2}'.format(start, end, e))
+            n_malformed = n_malformed + 1
+            continue
+        results.append(json.dumps(ss))
+
+    return results, n_lines, n_malformed
+
+
+def convert(src, dest, fmt='ndjson', workers=None, chunk_size=CHUNK_SIZE):
+
+    ranges = chunk_ranges(src, chunk_size)
+    pool = Pool(workers or cpu_count())
+
+    n_lines = 0
+    n_malformed = 0
+    n_written = 0
+
+    with open(dest, 'w') as fp:
+        if fmt == 'json':
+            fp.write('[')
+
+        # imap keeps ranges in file order while later ones are still being parsed
+        for results, _n_lines, _n_malformed in pool.imap(convert_range, ranges):
+            for s in results:
+                if fmt == 'json':
+                    fp.write(',\n' if n_written else '\n')
+                    fp.write(s)
+                else:
+                    fp.write(s)
+                    fp.write('\n')
+                n_written = n_written + 1
+            n_lines = n_lines + _n_lines
+            n_malformed = n_malformed + _n_malformed
+            logging.debug('Converted {0} events so far'.format(n_written))
+
+        if fmt == 'json':
+            fp.write('\n]\n')
+
+    pool.close()
+    pool.join()
+
+    logging.info('Read {0} lines, wrote {1} events, skipped {2} malformed lines'.format(
+        n_lines, n_written, n_malformed))
+    return n_written, n_malformed
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(prog='FixSplunkJSON')
+    parser.add_argument('src', help='Splunk json export')
+    parser.add_argument('dest', help='Output file')
+    parser.add_argument('--format', dest='fmt', default='ndjson', choices=['ndjson', 'json'],
+                        help='Newline-delimited events, or a single json array')
+    parser.add_argument('--workers', type=int, help='Parser processes (defaults to one per cpu)')
+    parser.add_argument('--chunk_size', type=int, default=CHUNK_SIZE, help='Bytes per parse job')
+    opts = parser.parse_args()
 
-with file("/Users/Derek/Desktop/xa_dose_reports_fixed.json", 'w') as fp:
-    json.dump(t, fp)
\ No newline at end of file
+    convert(opts.src, opts.dest, opts.fmt, opts.workers, opts.chunk_size)
@@ -1,19 +1,26 @@
-from SessionWrapper import Session
-from StructuredTags import simplify_tags, normalize_ctdi_tags
+from SessionWrapper import Session, is_error
+from StructuredTags import simplify_tags, extract_dose_report, get_projection, epoch
+from IDSet import IDSet, id_difference, id_intersection
+from HECPipeline import HECPipeline
+from SplunkQuery import DEFAULT_INDEX_NAMES, run_search, indexed_subset, time_terms, time_bounds
+from Trace import span
 import collections
+from datetime import datetime
 import logging
-from bs4 import BeautifulSoup
 import time
 import pprint
 import hashlib
+import json
+import os
+import sqlite3
 
-class Gateway(object):
+# Mapping between functions and index names
+class BaseGateway(object):
+    # Gateway interface, without a REST session for gateways to local files
 
     def __init__(self, *args, **kwargs):
-        super(Gateway, self).__init__()
-        # Create session wrapper
-        address = kwargs.get('address')
-        self.session = Session(address)
+        super(BaseGateway, self).__init__()
+        self.address = kwargs.get('address')
 
     def ListItems(self, condition=None, *args, **kwargs):
         raise NotImplementedError
@@ -21,9 +28,35 @@ class Gateway(object):
     def GetItem(self, *args, **kwargs):
         raise NotImplementedError
 
+    def GetItems(self, items, dtype='tags', projection=None):
+        # Yields (item, data); gateways that can fetch in bulk override this
+        for item in items:
+            yield item, self.GetItem(item, dtype, projection=projection)
+
     def AddItem(self, item, *args, **kwargs):
         raise NotImplementedError
 
+    def Flush(self):
+        # Gateways that buffer AddItem calls deliver anything outstanding here, and return
+        # the IDs of any items that could not be delivered
+        return []
+
+    def Projection(self):
+        # Tags to keep in items added to the active index (StructuredTags.Projection), None for all
+        return None
+
+    def IndexedSubset(self, candidates, field='ID', *args, **kwargs):
+        # Those candidates already present; gateways that can search for them override this
+        return id_intersection(candidates, self.ListItems(field=field))
+
+
+class Gateway(BaseGateway):
+
+    def __init__(self, *args, **kwargs):
+        super(Gateway, self).__init__(**kwargs)
+        # Create session wrapper
+        self.session = Session(self.address)
+
 
 class OrthancGateway(Gateway):
 
@@ -59,37 +92,80 @@ class OrthancGateway(Gateway):
         logging.info("Found {0} candidate {1}.".format(len(r), self.level))
         return r
 
-    def DropAll(self):
+    def DropAll(self, workers=8, bulk=False, dry_run=False):
+        from Retention import purge
         self.level = 'patients'
         items = self.ListItems()
-        for item in items:
-            self.DeleteItem(item)
+        return purge(self.session, self.level, items, workers=workers, bulk=bulk, dry_run=dry_run)
 
     def DeleteItem(self, item):
         self.session.do_delete('{0}/{1}'.format(self.level, item))
 
-    def GetItem(self, item, dtype="tags"):
+    def GetItem(self, item, dtype="tags", projection=None):
 
         r = None
         if dtype=="tags":
-            if self.level == 'instances':
-                r = self.session.do_get('{0}/{1}/tags?simplify'.format(self.level, item))
-            else:
-                r = self.session.do_get('{0}/{1}/shared-tags?simplify'.format(self.level, item))
-
-            r = simplify_tags(r)
+            with span('orthanc_get', id=item, dtype=dtype):
+                if self.level == 'instances':
+                    r = self.session.do_get('{0}/{1}/tags?simplify'.format(self.level, item))
+                else:
+                    r = self.session.do_get('{0}/{1}/shared-tags?simplify'.format(self.level, item))
+
+            with span('simplify_tags', id=item):
+                r = simplify_tags(r, projection)
             # Add item ID for later reference
             r['ID'] = item
 
             # logging.debug(pprint.pformat(r))
 
+        elif dtype=="dose":
+            # Only the configured dose report fields, see StructuredTags.DOSE_PROFILES
+            with span('orthanc_get', id=item, dtype=dtype):
+                r = self.session.do_get('{0}/{1}/tags?simplify'.format(self.level, item))
+
+            with span('extract_dose_report', id=item):
+                r = extract_dose_report(r, projection=projection)
+            r['ID'] = item
+
         elif dtype=="info":
-            r = self.session.do_get('{0}/{1}'.format(self.level, item))
+            with span('orthanc_get', id=item, dtype=dtype):
+                r = self.session.do_get('{0}/{1}'.format(self.level, item))
 
         elif dtype=="file":
-            r = self.session.do_get('{0}/{1}/file'.format(self.level, item))
+            with span('orthanc_get', id=item, dtype=dtype):
+                r = self.session.do_get('{0}/{1}/file'.format(self.level, item))
+
+        elif dtype=="frame":
+            # (simplified tags, first frame as an array) of an instance, without the rest of the file
+            from PixelData import raw_frame, read_pam, PAM
+            with span('orthanc_get', id=item, dtype=dtype):
+                tags = self.session.do_get('instances/{0}/tags?simplify'.format(item))
+                data = self.session.do_get('instances/{0}/frames/0/raw'.format(item))
+            pixels = raw_frame(data, tags) if not is_error(data) else None
+            if pixels is None:
+                # Compressed (or unreadable) pixel data, so have Orthanc decode it
+                with span('orthanc_get', id=item, dtype='image-uint16'):
+                    data = self.session.do_get('instances/{0}/frames/0/image-uint16'.format(item),
+                                               headers={'Accept': PAM})
+                pixels = read_pam(data)
+            r = (tags, pixels)
         return r
 
+    def GetItems(self, items, dtype="tags", projection=None):
+
+        if dtype != "tags" or self.level != "instances":
+            for item, r in super(OrthancGateway, self).GetItems(items, dtype, projection):
+                yield item, r
+            return
+
+        # Instance tags come a whole series at a time
+        for item, r in instance_tags_by_series(self.session, items):
+            with span('simplify_tags', id=item):
+                r = simplify_tags(r, projection)
+            # Add item ID for later reference
+            r['ID'] = item
+            yield item, r
+
     def AddItem(self, item, *args, **kwargs):
         if self.level != "instances":
             raise NotImplementedError
@@ -103,58 +179,54 @@ class SplunkGateway(Gateway):
         super(SplunkGateway, self).__init__(**kwargs)
         self.hec_address = kwargs.get('hec_address')
         if self.hec_address:
-            self.hec = Session(self.hec_address)
+            self.hec = Session(self.hec_address, gzip_min_size=kwargs.get('hec_gzip_min_size'))
+        # Batch events and confirm delivery with indexer acknowledgement
+        self.pipeline = None
+        if self.hec_address and kwargs.get('hec_ack'):
+            self.pipeline = HECPipeline(self.hec,
+                                        batch_size=kwargs.get('hec_batch_size', 100),
+                                        window=kwargs.get('hec_window', 8),
+                                        on_ack=kwargs.get('on_ack'))
         # Active index name
         self.index = kwargs.get('index')
         # Mapping between functions and index names
-        self.index_names = kwargs.get('index_names',
-                                      {'series': 'dicom_series',
-                                       'dose': 'dose_reports',
-                                       'remote_studies': 'pacs_studies',
-                                       'remote_series': 'pacs_series',
-                                       'patient_dims': 'patient_dims'})
-
-    def ListItems(self, condition=None, *args, **kwargs):
-
-        def poll_until_done(sid):
-            isDone = False
-            i = 0
-            r = None
-            while not isDone:
-                i = i + 1
-                time.sleep(1)
-                r = self.session.do_get('services/search/jobs/{0}'.format(sid), params={'output_mode': 'json'})
-                isDone = r['entry'][0]['content']['isDone']
-                status = r['entry'][0]['content']['dispatchState']
-                if i % 5 == 1:
-                    logging.debug('Waiting to finish {0} ({1})'.format(i, status))
-            return r['entry'][0]['content']['resultCount']
-
-        if not condition:
-            condition = "search index={0} | spath ID | dedup ID | table ID".format(self.index)
-
-        r = self.session.do_post('services/search/jobs', data="search={0}".format(condition))
-        soup = BeautifulSoup(r, 'xml')
-        sid = soup.find('sid').string
-        n = poll_until_done(sid)
-        offset = 0
-        instances = []
-        i = 0
-        while offset < n:
-            count = 50000
-            offset = 0 + count * i
-            r = self.session.do_get('services/search/jobs/{0}/results'.format(sid),
-                             params={'output_mode': 'csv', 'count': count, 'offset': offset})
-            instances = instances + r.replace('"', '').splitlines()[1:]
-            i = i + 1
-        return instances
+        self.index_names = kwargs.get('index_names', DEFAULT_INDEX_NAMES)
+        # Mapping between functions and projection profiles, e.g., {'series': 'series'}
+        self.projections = kwargs.get('projections', {})
+        # ID lookups can read tsidx files when IDs are indexed fields, or a summary index of IDs
+        self.tstats = kwargs.get('tstats', False)
+        self.summary_indices = kwargs.get('summary_indices', {})
+
+    def Projection(self):
+        for role, name in self.index_names.items():
+            if name == self.index and role in self.projections:
+                return get_projection(self.projections[role])
+
+    def ListItems(self, condition=None, field='ID', earliest=None, latest=None, *args, **kwargs):
+        '''
+        condition may be a complete SPL search string, or a dict of {field: value or [values]}
+        that is translated into a search on the active index returning unique values of field,
+        limited to events between earliest and latest if given
+        '''
+
+        if not condition or isinstance(condition, dict):
+            terms = [time_terms(earliest, latest)]
+            for key, values in (condition or {}).items():
+                if not isinstance(values, list):
+                    values = [values]
+                terms.append('(' + ' OR '.join('{0}="{1}"'.format(key, v) for v in values) + ')')
+            condition = "search index={0} {1} | spath {2} | dedup {2} | table {2}".format(
+                self.index, ' '.join(t for t in terms if t), field)
+
+        return run_search(self.session, condition)
+
+    def IndexedSubset(self, candidates, field='ID', earliest=None, latest=None, *args, **kwargs):
+        '''Those candidates already in the active index, without listing everything it holds'''
+        return indexed_subset(self.session, self.index, candidates, field, earliest, latest,
+                              tstats=self.tstats, summary_index=self.summary_indices.get(self.index))
 
     def AddItem(self, item, *args, **kwargs):
 
-        def epoch(dt):
-            tt = dt.timetuple()
-            return time.mktime(tt)
-
         src = kwargs.get('src')
         host = kwargs.get('host', '{0}:{1}'.format(src.session.hostname, src.session.port))
 
@@ -164,13 +236,282 @@ class SplunkGateway(Gateway):
                                         ('index', self.index),
                                         ('event', item)])
         # logging.debug(pformat(data))
-        self.hec.do_post('services/collector/event', data=data)
+        with span('hec_post', id=item.get('ID')):
+            if self.pipeline:
+                self.pipeline.add(data, item.get('ID'))
+            else:
+                self.hec.do_post('services/collector/event', data=data)
+
+    def Flush(self):
+        if not self.pipeline:
+            return []
+        failed = self.pipeline.flush()
+        if failed:
+            logging.error('{0} items were never acknowledged by {1}'.format(len(failed), self.index))
+        return failed
+
+
+class SQLiteGateway(BaseGateway):
+    '''
+    Local tag index as an alternative to Splunk.  Each index name is a table with
+    a typed column per top-level tag (REAL for numbers, TEXT otherwise, untyped if
+    only ever seen empty), plus the full event as JSON in _raw.  SQLite column names
+    are case-insensitive, so tags differing only in case share the first one's column.
+    Items are buffered and written in batches.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        # The address is the database file
+        super(SQLiteGateway, self).__init__(**kwargs)
+        self.db = sqlite3.connect(self.address)
+        # Active index (table) name
+        self.index = kwargs.get('index')
+        self.index_names = kwargs.get('index_names', DEFAULT_INDEX_NAMES)
+        self.batch_size = kwargs.get('batch_size', 1000)
+        self.pending = collections.defaultdict(list)
+        self.columns = {}
+
+    @staticmethod
+    def quote(name):
+        return '"{0}"'.format(name.replace('"', '""'))
+
+    @staticmethod
+    def column_type(value):
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return 'REAL'
+        return 'TEXT'
+
+    def table_columns(self, table):
+        # Lower-cased name to the column's name as created
+        if table not in self.columns:
+            r = self.db.execute('PRAGMA table_info({0})'.format(self.quote(table))).fetchall()
+            self.columns[table] = dict((row[1].lower(), row[1]) for row in r)
+        return self.columns[table]
+
+    def ensure_table(self, table, rows):
+        columns = self.table_columns(table)
+        if not columns:
+            self.db.execute('CREATE TABLE {0} (ID TEXT PRIMARY KEY, _time REAL, host TEXT, _raw TEXT)'.format(
+                self.quote(table)))
+            columns.update({'id': 'ID', '_time': '_time', 'host': 'host', '_raw': '_raw'})
+
+        # Type each new column by its first non-empty value in the batch
+        new = collections.OrderedDict()
+        for row in rows:
+            for key, value in row.items():
+                lower = key.lower()
+                if lower in columns:
+                    continue
+                if lower not in new or (new[lower][1] is None and value is not None):
+                    new[lower] = (key, value)
+
+        for lower, (key, value) in new.items():
+            self.db.execute('ALTER TABLE {0} ADD COLUMN {1} {2}'.format(
+                self.quote(table), self.quote(key), self.column_type(value) if value is not None else ''))
+            columns[lower] = key
+
+    @staticmethod
+    def time_value(t):
+        # Datetimes, iso strings or epoch seconds; relative Splunk times like "-7d" have no meaning here
+        if isinstance(t, (int, float)):
+            return t
+        try:
+            return epoch(t)
+        except (TypeError, ValueError):
+            raise ValueError('SQLiteGateway needs a datetime or epoch seconds, not {0!r}'.format(t))
+
+    def ListItems(self, condition=None, field='ID', earliest=None, latest=None, *args, **kwargs):
+        '''
+        condition is a dict of {field: value or [values]}, matched with bound parameters;
+        returns the distinct values of field in the active index, limited to items with
+        earliest <= _time < latest if given.  Use Query for anything else.
+        '''
+
+        if condition is not None and not isinstance(condition, dict):
+            raise TypeError('SQLiteGateway conditions are dicts of field values')
+
+        self.Flush()
+        columns = self.table_columns(self.index)
+        if field.lower() not in columns:
+            return []
+
+        terms = []
+        params = []
+        for key, values in (condition or {}).items():
+            if key.lower() not in columns:
+                return []
+            if not isinstance(values, list):
+                values = [values]
+            self.db.execute('CREATE INDEX IF NOT EXISTS {0} ON {1} ({2})'.format(
+                self.quote('{0}_{1}'.format(self.index, key)), self.quote(self.index), self.quote(key)))
+            terms.append('{0} IN ({1})'.format(self.quote(key), ','.join('?' * len(values))))
+            params.extend(values)
+
+        for op, bound in [('>=', earliest), ('<', latest)]:
+            if bound is not None:
+                terms.append('_time {0} ?'.format(op))
+                params.append(self.time_value(bound))
+
+        where = ' WHERE ' + ' AND '.join(terms) if terms else ''
+
+        r = self.db.execute('SELECT DISTINCT {0} FROM {1}{2}'.format(self.quote(field), self.quote(self.index), where),
+                            params)
+        return [row[0] for row in r if row[0] is not None]
+
+    def GetItem(self, item, *args, **kwargs):
+        self.Flush()
+        r = self.db.execute('SELECT _raw FROM {0} WHERE ID = ?'.format(self.quote(self.index)), (item,)).fetchone()
+        if r:
+            return json.loads(r[0])
+
+    def AddItem(self, item, *args, **kwargs):
+
+        src = kwargs.get('src')
+        host = kwargs.get('host', '{0}:{1}'.format(src.session.hostname, src.session.port))
+
+        row = {'_time': epoch(item['InstanceCreationDateTime']),
+               'host': host,
+               '_raw': json.dumps(item)}
+        seen = set(key.lower() for key in row)
+        for key, value in item.items():
+            # Nested values (e.g., structured reports), and later tags whose names only differ
+            # in case, only live in _raw
+            if not isinstance(value, (dict, list)) and key.lower() not in seen:
+                row[key] = value
+                seen.add(key.lower())
+
+        self.pending[self.index].append(row)
+        if len(self.pending[self.index]) >= self.batch_size:
+            self.Flush()
+
+    def Flush(self):
+        try:
+            with self.db, span('sqlite_flush'):
+                for table, rows in self.pending.items():
+                    if not rows:
+                        continue
+                    self.ensure_table(table, rows)
+                    columns = self.table_columns(table)
+                    rows = [dict((key.lower(), value) for key, value in row.items()) for row in rows]
+                    keys = sorted(set(key for row in rows for key in row))
+                    self.db.executemany('INSERT OR REPLACE INTO {0} ({1}) VALUES ({2})'.format(
+                                            self.quote(table),
+                                            ','.join(self.quote(columns[key]) for key in keys),
+                                            ','.join('?' * len(keys))),
+                                        [tuple(row.get(key) for key in keys) for row in rows])
+                    logging.debug('Wrote {0} items to {1}'.format(len(rows), table))
+        except sqlite3.Error:
+            # Re-read the schema next time, the failed batch may have added columns or not
+            self.columns.clear()
+            logging.error('Could not write {0} items, dropping them'.format(
+                sum(len(rows) for rows in self.pending.values())))
+            raise
+        finally:
+            # A bad batch must not block every later Flush
+            self.pending.clear()
+        return []
+
+    def Query(self, sql, params=()):
+        '''Run an arbitrary read query, e.g., for dashboards'''
+        self.Flush()
+        return self.db.execute(sql, params).fetchall()
+
+
+class FileGateway(BaseGateway):
+    '''
+    DICOM files under a directory tree, as instances.  ListItems parses just the start of
+    each (memory-mapped) file across a process pool to work out its Orthanc ID, so a tree
+    can be diffed against an Orthanc before any file is read in full.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        # The address is the root directory
+        super(FileGateway, self).__init__(**kwargs)
+        self.level = 'instances'
+        self.workers = kwargs.get('workers')
+        # Orthanc instance ID -> file name
+        self.files = {}
+        self.unparsed = []
+
+    def walk(self):
+        for root, dirs, fns in os.walk(self.address):
+            for fn in fns:
+                if not fn.startswith('.'):
+                    yield os.path.join(root, fn)
+
+    def ListItems(self, *args, **kwargs):
+        from multiprocessing import Pool
+        from DicomHeader import instance_id
+
+        self.files = {}
+        self.unparsed = []
+        tic = time.time()
+
+        pool = Pool(self.workers)
+        for fn, instance in pool.imap_unordered(instance_id, self.walk(), chunksize=256):
+            if instance:
+                self.files[instance] = fn
+            else:
+                self.unparsed.append(fn)
+        pool.close()
+        pool.join()
+
+        logging.info('Found {0} instances under {1} in {2:.1f}s, {3} files unread'.format(
+            len(self.files), self.address, time.time() - tic, len(self.unparsed)))
+        return IDSet(self.files.keys())
+
+    @staticmethod
+    def read(fn):
+        # The whole file is posted, so a plain read; only header parsing gains from mmap
+        with open(fn, 'rb') as fp:
+            return fp.read()
+
+    def GetItem(self, item, dtype="file", *args, **kwargs):
+        if dtype != "file":
+            raise NotImplementedError
+        if not self.files:
+            self.ListItems()
+        with span('read_file', id=item):
+            return self.read(self.files[item])
+
+
+def instance_tags_by_series(session, instances):
+    '''
+    Yield (instance, unsimplified tags) for each instance, fetched with one
+    series/{id}/instances-tags request per series rather than one per instance.
+    Only the series of the requested instances are read: the first instance of
+    each series found gives its ParentSeries, and the series' other requested
+    instances come with it.
+    '''
+
+    wanted = IDSet.coerce(instances)
+    done = set()
+
+    for instance in wanted:
+        if instance in done:
+            continue
+        info = session.do_get('instances/{0}'.format(instance))
+        if is_error(info):
+            logging.warn('Could not find instance {0}'.format(instance))
+            continue
+        series = info['ParentSeries']
+        with span('orthanc_get_series_tags', id=series):
+            tags = session.do_get('series/{0}/instances-tags?simplify'.format(series))
+        if is_error(tags) or instance not in tags:
+            # Fall back to the one instance
+            yield instance, session.do_get('instances/{0}/tags?simplify'.format(instance))
+            done.add(instance)
+            continue
+        # Only the requested instances in the series
+        for other in IDSet(tags.keys()) & wanted:
+            done.add(other)
+            yield other, tags[other]
 
 
 def SetDiff( items1, items2 ):
     if not items2:
         return items1
-    return set(items1) - set(items2)
+    return id_difference(items1, items2)
 
 
 def CopyItems( src, dest, items, dtype='tags' ):
@@ -182,13 +523,15 @@ def CopyItems( src, dest, items, dtype='tags' ):
     logging.debug('Items to copy:')
     logging.debug(pprint.pformat(items))
 
-    for item in items:
-        data = src.GetItem(item, dtype)
+    # Only fetch and simplify what the destination index keeps
+    for item, data in src.GetItems(items, dtype, dest.Projection()):
         dest.AddItem(data, src=src)
 
+    return dest.Flush()
+
 
 def CopyNewItems( src, dest, items, dtype='tags' ):
-    new_items = SetDiff(items, dest.ListItems() )
+    new_items = SetDiff(items, dest.IndexedSubset(items) )
 
     logging.debug('New items:')
     logging.debug(pprint.pformat(new_items))
@@ -252,9 +595,6 @@ def UpdateRemoteStudyIndex( orthanc, remote, splunk, **kwargs ):
     orthanc.level = 'study'
     splunk.index = splunk.index_names['remote_studies']
 
-    existing_items = splunk.ListItems()
-    # logging.debug(existing_items)
-
     study_date = kwargs.get('study_date')
     study_time = kwargs.get('study_time')
     modality = kwargs.get('modality', 'CT')
@@ -281,6 +621,7 @@ def UpdateRemoteStudyIndex( orthanc, remote, splunk, **kwargs ):
     host = '{0}:{1}/modalities/{2}'.format(orthanc.session.hostname, orthanc.session.port, remote)
     # accessions = []
 
+    studies = []
     for a in answers:
         r = orthanc.session.do_get('queries/{0}/answers/{1}/content?simplify'.format(q['ID'],a))
         r = simplify_tags(r)
@@ -289,7 +630,20 @@ def UpdateRemoteStudyIndex( orthanc, remote, splunk, **kwargs ):
         r['ID'] = '-'.join(s[i:i+8] for i in range(0, len(s), 8))
 
         logging.debug(pprint.pformat(r))
+        studies.append(r)
+
+    def _study_datetime(r):
+        # Study answers carry StudyDate and StudyTime, combined into StudyDateTime when both are there
+        if r.get('StudyDateTime'):
+            return r['StudyDateTime']
+        if r.get('StudyDate'):
+            return datetime.strptime(r['StudyDate'][:8], '%Y%m%d')
+
+    # Only look for these studies, and only around when they happened
+    earliest, latest = time_bounds(_study_datetime(r) for r in studies)
+    existing_items = splunk.IndexedSubset([str(r['ID']) for r in studies], earliest=earliest, latest=latest)
 
+    for r in studies:
         if not str(r['ID']) in existing_items:
             logging.debug('Adding item {0}'.format(r['ID']))
             splunk.AddItem(r, src=orthanc, host=host)
@@ -297,6 +651,8 @@ def UpdateRemoteStudyIndex( orthanc, remote, splunk, **kwargs ):
         else:
             logging.debug('Skipping item {0}'.format(r['ID']))
 
+    splunk.Flush()
+
     # logging.debug(accessions)
     # logging.debug("Found {0} studies to index".format(len(accessions)))
     #
@@ -424,18 +780,15 @@ def UpdateRemoteSeriesIndex( orthanc, remote, splunk, **kwargs ):
 
 
 
-def UpdateDoseReports( orthanc, splunk ):
+def UpdateDoseReports( orthanc, splunk, earliest=None ):
 
-    # List of candidate series out of Splunk/dicom_series
+    # List of candidate series out of Splunk/dicom_series, e.g., since earliest="-7d@d"
     splunk.index = splunk.index_names['series']
-    # Can limit the search with "earliest=-2d" for example
-    q = "search index={0} SeriesNumber = 997 OR SeriesNumber = 502 OR SeriesNumber = 9001 OR SeriesNumber = 65535 | table ID".format(splunk.index)
-    candidates = splunk.ListItems(q)
+    candidates = splunk.ListItems({'SeriesNumber': ['997', '502', '9001', '65535']}, earliest=earliest)
 
     # Which ones are already available in Splunk/dose_records (looking at ParentSeriesID)
     splunk.index = splunk.index_names['dose']
-    q = "search index={0} | table ParentSeriesID".format(splunk.index)
-    indexed = splunk.ListItems(q)
+    indexed = splunk.IndexedSubset(candidates, field='ParentSeriesID', earliest=earliest)
 
     items = SetDiff(candidates, indexed)
 
@@ -450,17 +803,16 @@ def UpdateDoseReports( orthanc, splunk ):
         instance = info['Instances'][0]
 
         orthanc.level = 'instances'
-        tags = orthanc.GetItem(instance, 'tags')
+        tags = orthanc.GetItem(instance, 'dose', splunk.Projection())
         # Add IDs
         tags['ParentSeriesID'] = item
 
-        # Normalize missing CTDIvol tags
-        tags = normalize_ctdi_tags(tags)
-
         logging.debug(pprint.pformat(tags))
 
         splunk.AddItem(tags, src=orthanc)
 
+    splunk.Flush()
+
     logging.debug('Candidate dose reports: {0}'.format(len(candidates)))
     logging.debug('Indexed dose reports: {0}'.format(len(indexed)))
     logging.debug('New dose reports: {0}'.format(len(items)))
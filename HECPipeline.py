@@ -0,0 +1,152 @@
+'''Batched Splunk HEC delivery with indexer acknowledgement and a bounded in-flight window'''
+
+import collections
+import logging
+import time
+import uuid
+from SessionWrapper import is_error
+from Trace import span
+
+
+class Batch(object):
+
+    def __init__(self, entries):
+        self.item_ids = [item_id for item_id, _ in entries]
+        self.events = [event for _, event in entries]
+        self.sent = None
+        self.retries = 0
+
+
+class HECPipeline(object):
+    '''
+    Events are grouped into batches and posted on a single HEC channel.  Each post
+    returns an ackId immediately, so up to `window` batches can be waiting on the
+    indexers at once.  `services/collector/ack` is polled for confirmations, and
+    only batches that were never acknowledged within `ack_timeout` are re-sent.
+
+    `on_ack(item_ids)` is called once per confirmed batch, so callers can keep
+    their indexed-ID bookkeeping (e.g., a job journal) in step with what Splunk has
+    actually committed.
+
+    Delivery is at-least-once: a batch whose ack timed out may still have been
+    indexed, so re-sending it can duplicate events.  Searches should dedup on ID.
+    flush() returns the item IDs of batches that were given up on.
+    '''
+
+    def __init__(self, hec, batch_size=100, window=8, ack_interval=1, ack_timeout=300,
+                 max_retries=3, on_ack=None, channel=None):
+        self.hec = hec
+        self.batch_size = batch_size
+        self.window = window
+        self.ack_interval = ack_interval
+        self.ack_timeout = ack_timeout
+        self.max_retries = max_retries
+        self.on_ack = on_ack
+        self.channel = channel or str(uuid.uuid4())
+        self.headers = {'X-Splunk-Request-Channel': self.channel,
+                        'content-type': 'application/json'}
+
+        self.pending = []
+        self.in_flight = collections.OrderedDict()
+        self.retry = []
+        self.failed = []
+        self.acked = 0
+
+    def add(self, event, item_id=None):
+        self.pending.append((item_id, event))
+        if len(self.pending) >= self.batch_size:
+            self._send_pending()
+        self._send_retries()
+
+    def flush(self):
+        '''Send everything outstanding and wait until it is acknowledged or given up on'''
+        self._send_pending()
+        while self.in_flight or self.retry:
+            self._send_retries()
+            if self.in_flight:
+                self.poll()
+        logging.info('HEC channel {0}: {1} events acknowledged, {2} failed.'.format(
+            self.channel, self.acked, len(self.failed)))
+        return self.failed
+
+    def poll(self):
+        if not self.in_flight:
+            return
+
+        with span('hec_ack_poll', in_flight=len(self.in_flight)):
+            r = self.hec.do_post('services/collector/ack',
+                                 data={'acks': list(self.in_flight.keys())},
+                                 headers={'X-Splunk-Request-Channel': self.channel})
+
+        n_acked = 0
+        if not is_error(r):
+            for ack_id, ok in r.get('acks', {}).items():
+                batch = self.in_flight.get(int(ack_id))
+                if ok and batch:
+                    del self.in_flight[int(ack_id)]
+                    self._acknowledged(batch)
+                    n_acked = n_acked + 1
+
+        # Anything unconfirmed for too long is presumed lost and re-sent
+        now = time.time()
+        for ack_id, batch in list(self.in_flight.items()):
+            if now - batch.sent > self.ack_timeout:
+                logging.warn('HEC ack {0} timed out, re-sending {1} events'.format(ack_id, len(batch.events)))
+                del self.in_flight[ack_id]
+                self._requeue(batch)
+
+        if not n_acked:
+            time.sleep(self.ack_interval)
+
+    def _send_pending(self):
+        if self.pending:
+            batch = Batch(self.pending)
+            self.pending = []
+            self._send(batch)
+
+    def _send_retries(self):
+        while self.retry:
+            self._send(self.retry.pop(0))
+
+    def _send(self, batch):
+
+        # Wait for the indexers to catch up before putting more on the wire
+        while len(self.in_flight) >= self.window:
+            self.poll()
+
+        # HEC accepts multiple events concatenated in one body
+        with span('json_encode', events=len(batch.events)):
+            body = b'\n'.join(self._encode(event) for event in batch.events)
+
+        batch.sent = time.time()
+        with span('hec_batch', events=len(batch.events), size=len(body)):
+            r = self.hec.do_post('services/collector/event', data=body, headers=self.headers)
+
+        if is_error(r):
+            logging.warn('HEC rejected a batch of {0} events ({1})'.format(len(batch.events), r.status_code))
+            time.sleep(self.ack_interval * (batch.retries + 1))
+            self._requeue(batch)
+        elif 'ackId' not in r:
+            # Token does not have indexer acknowledgement enabled, best we can do is the 200
+            self._acknowledged(batch)
+        else:
+            self.in_flight[r['ackId']] = batch
+
+    def _encode(self, event):
+        s = self.hec.serializer.dumps(event)
+        if not isinstance(s, bytes):
+            s = s.encode('utf-8')
+        return s
+
+    def _requeue(self, batch):
+        batch.retries = batch.retries + 1
+        if batch.retries > self.max_retries:
+            logging.error('Giving up on a batch of {0} events'.format(len(batch.events)))
+            self.failed.extend(batch.item_ids)
+        else:
+            self.retry.append(batch)
+
+    def _acknowledged(self, batch):
+        self.acked = self.acked + len(batch.events)
+        if self.on_ack:
+            self.on_ack([item_id for item_id in batch.item_ids if item_id is not None])
@@ -0,0 +1,295 @@
+'''Compact sorted ID collections for diffing millions of Orthanc IDs'''
+
+import binascii
+import logging
+import numpy as np
+from itertools import islice
+
+# Orthanc IDs are SHA-1 digests written as 5 dash-separated groups of 8 hex digits,
+# so each 44-char ID packs losslessly into 20 bytes
+ID_LENGTH = 44
+PACKED_LENGTH = 20
+PACKED_DTYPE = 'S{0}'.format(PACKED_LENGTH)
+
+_DASH_COLUMNS = np.arange(8, ID_LENGTH, 9)
+_HEX_COLUMNS = np.array([i for i in range(ID_LENGTH) if i % 9 != 8])
+
+# Lookup table from nibbles to ascii hex digits
+_HEX_DIGITS = np.frombuffer(b'0123456789abcdef', dtype=np.uint8)
+
+# Pack and unpack in chunks so we never hold millions of python strings at once
+ITER_CHUNK = 65536
+
+
+def _pack_chunk(chunk):
+    # One joined string per chunk, so there is never a wide per-ID array or a python object per digest
+    try:
+        if set(map(len, chunk)) != set([ID_LENGTH]):
+            raise ValueError('IDs must be {0} characters long'.format(ID_LENGTH))
+        joined = ''.join(chunk).encode('ascii')
+        chars = np.frombuffer(joined, dtype=np.uint8).reshape(-1, ID_LENGTH)
+        if np.any(chars[:, _DASH_COLUMNS] != ord('-')):
+            raise ValueError('IDs must be dash-separated groups of 8 hex digits')
+        raw = binascii.unhexlify(joined.translate(None, b'-'))
+    except (TypeError, UnicodeError, binascii.Error):
+        raise ValueError('IDs must be dash-separated groups of 8 hex digits')
+    if len(raw) != PACKED_LENGTH * len(chunk):
+        raise ValueError('IDs must be dash-separated groups of 8 hex digits')
+    return np.frombuffer(raw, dtype=PACKED_DTYPE)
+
+
+def pack_ids(ids):
+    '''Convert a sequence of Orthanc ID strings into a (unsorted) packed binary array'''
+
+    if isinstance(ids, IDSet):
+        return ids.ids
+
+    # Fill a preallocated array when the length is known, otherwise collect chunks
+    n = len(ids) if hasattr(ids, '__len__') else None
+    packed = np.empty(n, dtype=PACKED_DTYPE) if n is not None else []
+    filled = 0
+    it = iter(ids)
+    while True:
+        chunk = list(islice(it, ITER_CHUNK))
+        if not chunk:
+            break
+        block = _pack_chunk(chunk)
+        if n is None:
+            packed.append(block)
+        else:
+            packed[filled:filled + len(block)] = block
+        filled = filled + len(block)
+
+    if n is None:
+        return np.concatenate(packed) if packed else np.empty(0, dtype=PACKED_DTYPE)
+    return packed[:filled]
+
+
+def unpack_ids(packed):
+    '''Convert a packed binary array back into a list of Orthanc ID strings'''
+
+    if len(packed) == 0:
+        return []
+
+    octets = np.ascontiguousarray(packed, dtype=PACKED_DTYPE).view(np.uint8).reshape(-1, PACKED_LENGTH)
+    chars = np.full((len(octets), ID_LENGTH), ord('-'), dtype=np.uint8)
+    chars[:, _HEX_COLUMNS[0::2]] = _HEX_DIGITS[octets >> 4]
+    chars[:, _HEX_COLUMNS[1::2]] = _HEX_DIGITS[octets & 15]
+
+    return np.char.decode(chars.view('S{0}'.format(ID_LENGTH)).ravel(), 'ascii').tolist()
+
+
+def _prefixes(packed):
+    # First 8 bytes of each digest as an integer, which orders them as the full digests do
+    octets = np.ascontiguousarray(packed).view(np.uint8).reshape(-1, PACKED_LENGTH)
+    return np.ascontiguousarray(octets[:, :8]).view('>u8').ravel().astype(np.uint64)
+
+
+def sort_unique(packed):
+    '''
+    Sorted, unique copy of a packed array.  Sorting fixed-width integer prefixes is several
+    times faster than sorting the 20-byte strings, and distinct SHA-1 digests practically
+    never share 8 bytes; if two ever do, the strings are sorted instead.
+    '''
+
+    if len(packed) < 2:
+        return np.array(packed, dtype=PACKED_DTYPE)
+
+    keys = _prefixes(packed)
+    order = np.argsort(keys)
+    keys = keys[order]
+    packed = packed[order]
+    del order
+
+    same_key = np.flatnonzero(keys[1:] == keys[:-1])
+    del keys
+    if len(same_key) == 0:
+        return packed
+
+    # Duplicate IDs, or (practically never) distinct digests sharing a prefix
+    if np.any(packed[same_key + 1] != packed[same_key]):
+        packed.view('V{0}'.format(PACKED_LENGTH)).sort()
+    same_id = np.flatnonzero(packed[1:] == packed[:-1]) + 1
+    return np.delete(packed, same_id)
+
+
+class IDSet(object):
+    '''
+    Set of Orthanc IDs stored as a sorted, unique array of packed 20-byte digests.
+
+    Roughly 20 bytes per ID instead of ~100 for a python string in a set, and
+    differences/intersections are vectorized merge-joins over the sorted arrays.
+    Iterating yields the usual 44-char ID strings, so an IDSet can stand in for
+    set(a) - set(b) anywhere the result is only counted or looped over.
+    '''
+
+    def __init__(self, items=None):
+        if items is None:
+            self.ids = np.empty(0, dtype=PACKED_DTYPE)
+        elif isinstance(items, IDSet):
+            self.ids = items.ids
+        else:
+            self.ids = sort_unique(pack_ids(items))
+        self._prefix_cache = None
+
+    def prefixes(self):
+        # Cached, since a large set is typically probed by many small batches
+        if self._prefix_cache is None or self._prefix_cache[0] is not self.ids:
+            self._prefix_cache = (self.ids, _prefixes(self.ids))
+        return self._prefix_cache[1]
+
+    @classmethod
+    def from_packed(cls, packed):
+        # Caller guarantees packed is sorted and unique
+        s = cls()
+        s.ids = packed
+        return s
+
+    @classmethod
+    def coerce(cls, items):
+        if isinstance(items, IDSet):
+            return items
+        return cls(items)
+
+    def _lookup(self, keys, key_prefixes=None):
+        # Boolean mask, True where each packed key is in this set
+        b = self.ids
+        if len(keys) == 0 or len(b) == 0:
+            return np.zeros(len(keys), dtype=bool)
+        if key_prefixes is None:
+            key_prefixes = _prefixes(keys)
+        b_prefixes = self.prefixes()
+        idx = np.searchsorted(b_prefixes, key_prefixes)
+        idx[idx == len(b)] = 0
+        found = b[idx] == keys
+        # A digest sharing its prefix with another needs the full 20-byte search
+        shared = np.flatnonzero(~found & (b_prefixes[idx] == key_prefixes))
+        if len(shared):
+            exact = np.searchsorted(b, keys[shared])
+            exact[exact == len(b)] = 0
+            found[shared] = b[exact] == keys[shared]
+        return found
+
+    def _matches(self, other):
+        # Boolean mask of our IDs that also appear in other
+        return IDSet.coerce(other)._lookup(self.ids)
+
+    def contains(self, items):
+        '''
+        Boolean array, True where each of items is in the set: a vectorized `in` for a whole
+        batch, which is much cheaper than testing the items one at a time
+        '''
+        if isinstance(items, IDSet):
+            return self._lookup(items.ids, items.prefixes())
+        items = list(items)
+        try:
+            return self._lookup(pack_ids(items))
+        except ValueError:
+            return np.array([item in self for item in items], dtype=bool)
+
+    def difference(self, other):
+        return IDSet.from_packed(self.ids[~self._matches(other)])
+
+    def intersection(self, other):
+        return IDSet.from_packed(self.ids[self._matches(other)])
+
+    def union(self, other):
+        return IDSet.from_packed(sort_unique(np.concatenate([self.ids, IDSet.coerce(other).ids])))
+
+    @classmethod
+    def union_all(cls, sets):
+        arrays = [cls.coerce(s).ids for s in sets]
+        if not arrays:
+            return cls()
+        return cls.from_packed(sort_unique(np.concatenate(arrays)))
+
+    __sub__ = difference
+    __and__ = intersection
+    __or__ = union
+
+    def __contains__(self, item):
+        # One at a time, use contains() for batches
+        if len(item) != ID_LENGTH or item[8::9] != '----':
+            return False
+        try:
+            key = binascii.unhexlify(item.replace('-', ''))
+        except (TypeError, binascii.Error):
+            return False
+        i = self.ids.searchsorted(key)
+        # Indexing strips trailing null bytes from the digest
+        return i < len(self.ids) and self.ids[i].ljust(PACKED_LENGTH, b'\0') == key
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __nonzero__(self):
+        return len(self.ids) > 0
+
+    __bool__ = __nonzero__
+
+    def __iter__(self):
+        for i in range(0, len(self.ids), ITER_CHUNK):
+            for item in unpack_ids(self.ids[i:i + ITER_CHUNK]):
+                yield item
+
+    def __repr__(self):
+        return 'IDSet({0} items)'.format(len(self.ids))
+
+    def save(self, fn):
+        with open(fn, 'wb') as fp:
+            np.save(fp, self.ids)
+
+    @classmethod
+    def load(cls, fn, mmap=True):
+        # Memory-map by default so large stored sets don't have to be read up front
+        packed = np.load(fn, mmap_mode='r' if mmap else None)
+        return cls.from_packed(packed)
+
+
+def id_mask(collection, items):
+    '''`item in collection` for each of items, vectorized when collection is an IDSet'''
+    if isinstance(collection, IDSet):
+        return collection.contains(items)
+    return np.array([item in collection for item in items], dtype=bool)
+
+
+def id_batches(items, size=ITER_CHUNK):
+    '''Items in lists of up to size, or an IDSet in packed slices that needn't be re-packed'''
+    if isinstance(items, IDSet):
+        for i in range(0, len(items.ids), size):
+            yield IDSet.from_packed(items.ids[i:i + size])
+        return
+    it = iter(items)
+    while True:
+        batch = list(islice(it, size))
+        if not batch:
+            return
+        yield batch
+
+
+def id_intersection(items1, items2):
+    '''Return items1 & items2, packed when both are Orthanc IDs, as a plain set otherwise'''
+    try:
+        return IDSet.coerce(items1) & IDSet.coerce(items2)
+    except ValueError:
+        logging.debug('Non-Orthanc IDs in intersection, falling back to a python set')
+        return set(items1) & set(items2)
+
+
+def id_union(sets):
+    '''Return the union of sets, packed when all are Orthanc IDs, as a plain set otherwise'''
+    sets = list(sets)
+    try:
+        return IDSet.union_all(sets)
+    except ValueError:
+        logging.debug('Non-Orthanc IDs in union, falling back to a python set')
+        return set().union(*sets)
+
+
+def id_difference(items1, items2):
+    '''Return items1 - items2, packed when both are Orthanc IDs, as a plain set otherwise'''
+    try:
+        return IDSet.coerce(items1) - IDSet.coerce(items2)
+    except ValueError:
+        logging.debug('Non-Orthanc IDs in diff, falling back to a python set')
+        return set(items1) - set(items2)
@@ -1,15 +1,16 @@
 import logging
 from pprint import pformat
-from io import BytesIO
 import json
 import time
 import datetime
-
-from MeasureScout import MeasureScout
+from Trace import span
 
 def UpdatePatientDimensions( orthanc, splunk ):
     '''Queries Splunk for unsized localizers and measures them'''
 
+    # NumPy and sklearn are only worth loading when there is a scout to measure
+    from MeasureScout import MeasureFrame
+
     # List of candidate series out of Splunk/dicom_series
     splunk.index = splunk.index_names['series']
     # Can limit the search with "earliest=-2d" for example
@@ -33,17 +34,21 @@ def UpdatePatientDimensions( orthanc, splunk ):
         orthanc.level = 'instances'
         for instance in info['Instances']:
 
-            data = orthanc.GetItem(instance, 'file')
+            # Only the first frame and the tags, not the whole file
+            tags, pixels = orthanc.GetItem(instance, 'frame')
 
-            ret = MeasureScout(BytesIO(data))
+            with span('measure_scout', id=instance):
+                ret = MeasureFrame(tags, pixels)
 
             logging.debug(pformat(ret))
             ret["ID"] = instance
-            ret["InstanceCreationDateTime"] = datetime.datetime.now()
+            ret["InstanceCreationDateTime"] = datetime.datetime.now().isoformat()
 
             splunk.index = splunk.index_names['patient_dims']
             splunk.AddItem(ret, src=orthanc)
 
+    splunk.Flush()
+
     #         if not results.get(ret['AccessionNumber']):
     #             results[ret['AccessionNumber']] = ret
     #         else:
@@ -0,0 +1,132 @@
+'''Append-only progress journal so interrupted copy and index jobs can resume'''
+
+import logging
+import os
+import threading
+from IDSet import IDSet, ID_LENGTH
+
+
+class Journal(object):
+    '''
+    A job journal is a pair of files:
+
+    - `<fn>.todo.npy`, the packed work list, written once when the job is planned
+    - `<fn>`, an append-only log with one completed Orthanc ID per line
+    - `<fn>.files`, for jobs over local files, each instance's path ("ID<tab>path" per line,
+      with an empty ID for files whose header couldn't be read)
+
+    A restarted job reads back todo - done instead of re-listing and re-diffing
+    its source and destination.  Compaction folds the log into the work list.
+    '''
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.todo_fn = fn + '.todo.npy'
+        self.files_fn = fn + '.files'
+        self.fp = None
+        self.lock = threading.Lock()
+
+    def resuming(self):
+        return os.path.exists(self.todo_fn)
+
+    def plan(self, items):
+        items = IDSet.coerce(items)
+        self._save_todo(items)
+        # Start a fresh log for the new work list
+        self.close()
+        self.fp = open(self.fn, 'w')
+        logging.debug('Journal {0} planned {1} items'.format(self.fn, len(items)))
+        return items
+
+    def done(self):
+        if not os.path.exists(self.fn):
+            return IDSet()
+        with open(self.fn) as fp:
+            # A crash can leave a torn final line, so only keep complete IDs
+            items = [l.strip() for l in fp if len(l.strip()) == ID_LENGTH]
+        return IDSet(items)
+
+    def remaining(self):
+        if not self.resuming():
+            # Streamed jobs have no up-front work list, only the log
+            return IDSet()
+        return IDSet.load(self.todo_fn, mmap=False) - self.done()
+
+    def save_files(self, files, unparsed=()):
+        '''Keep the instance ID to path map, so a resumed job needn't parse every header again'''
+        tmp_fn = self.files_fn + '.tmp'
+        with open(tmp_fn, 'w') as fp:
+            for item, fn in files.items():
+                fp.write('{0}\t{1}\n'.format(item, fn))
+            for fn in unparsed:
+                fp.write('\t{0}\n'.format(fn))
+        os.rename(tmp_fn, self.files_fn)
+
+    def load_files(self):
+        '''(files, unparsed) as saved, or None if they never were'''
+        if not os.path.exists(self.files_fn):
+            return None
+        files = {}
+        unparsed = []
+        with open(self.files_fn) as fp:
+            for line in fp:
+                item, fn = line.rstrip('\n').split('\t', 1)
+                if item:
+                    files[item] = fn
+                else:
+                    unparsed.append(fn)
+        return files, unparsed
+
+    def record(self, item):
+        # Copy workers may finish items concurrently
+        with self.lock:
+            if not self.fp:
+                self.fp = open(self.fn, 'a')
+            self.fp.write('{0}\n'.format(item))
+            self.fp.flush()
+
+    def compact(self):
+        '''Fold completed items into the work list and truncate the log'''
+        items = self.remaining()
+        self._save_todo(items)
+        self.close()
+        self.fp = open(self.fn, 'w')
+        logging.debug('Journal {0} compacted to {1} items'.format(self.fn, len(items)))
+        return items
+
+    def finish(self):
+        '''Remove the journal once every planned item is done'''
+        self.close()
+        if len(self.remaining()) > 0:
+            logging.warn('Journal {0} still has unfinished items, keeping it'.format(self.fn))
+            return
+        for fn in [self.todo_fn, self.fn, self.files_fn]:
+            if os.path.exists(fn):
+                os.remove(fn)
+
+    def close(self):
+        if self.fp:
+            self.fp.flush()
+            os.fsync(self.fp.fileno())
+            self.fp.close()
+            self.fp = None
+
+    def _save_todo(self, items):
+        # Write then rename so a crash mid-save can't lose the work list
+        tmp_fn = self.todo_fn + '.tmp'
+        items.save(tmp_fn)
+        os.rename(tmp_fn, self.todo_fn)
+
+
+def resume_or_plan(journal, plan):
+    '''Return the outstanding work list from the journal if resuming, otherwise from plan()'''
+
+    if not journal:
+        return plan()
+
+    if journal.resuming():
+        items = journal.compact()
+        logging.info('Resuming from journal {0} with {1} items remaining.'.format(journal.fn, len(items)))
+        return items
+
+    return journal.plan(plan())
@@ -1,6 +1,5 @@
 '''Measure AP and Lateral dimensions from DICOM localizer images for SSDE calculations'''
 
-import dicom
 import logging
 import numpy as np
 # from matplotlib import pyplot as plt
@@ -9,38 +8,27 @@ from sklearn.mixture import GMM
 import json
 import glob
 
-def MeasureScout(fp):
 
-    # Read DICOM file and info
-    # Get ref file
-    dcm = dicom.read_file(fp)
-
-    # Load spacing values (in mm)
-    pixel_spacing = (float(dcm.PixelSpacing[0]), float(dcm.PixelSpacing[1]))
-
-    # Load study info
-    patient_name = dcm.PatientName
-    accession_number = dcm.AccessionNumber
-
-    # Determine measurement dimension
-    orientation = dcm.ImageOrientationPatient
+def measured_dimension(orientation):
 
     if orientation[0]*orientation[0] > 0.2:
         # This is a PA scout, which gives the lateral measurement
-        measured_dim = 'lateral_dim'
+        return 'lateral_dim'
     elif orientation[1]*orientation[1] > 0.2:
         # This is a lateral scout, which gives the AP measurement
-        measured_dim = 'AP_dim'
+        return 'AP_dim'
     else:
-        measured_dim = 'Unknown_dim'
+        return 'Unknown_dim'
+
+
+def measure_width(pixels, row_spacing):
+    '''Average width (in cm) of the patient across the rows of a localizer's pixel array'''
 
     # Setup pixel array data
-    dcm_px = np.array(dcm.pixel_array, dtype=np.float32)
+    dcm_px = np.array(pixels, dtype=np.float32)
 
     # Determine weighted threshold separating tissue/non-tissue attenuations
     # using a GMM
-    thresh = np.mean(dcm_px[dcm_px>0])
-
     gmm = GMM(2).fit(dcm_px[dcm_px>0].reshape(-1,1))
     thresh = np.sum(gmm.weights_[::-1]*gmm.means_.ravel())
 
@@ -52,21 +40,57 @@ def MeasureScout(fp):
     # Compute avg width based on unmasked pixels
     mask = dcm_px > thresh
 
+    # plt.imshow(mask)
+    # plt.show()
+
     px_counts = np.sum(mask,axis=1)
     avg_px_count = np.mean(px_counts[px_counts>0])
-    d_avg = avg_px_count * pixel_spacing[0] / 10;
+    return avg_px_count * row_spacing / 10
 
+
+def MeasureScout(fp):
+
+    # Only the file path needs a DICOM parser
+    import dicom
+
+    # Read DICOM file and info
+    # Get ref file
+    dcm = dicom.read_file(fp)
+
+    # Load spacing values (in mm)
+    pixel_spacing = (float(dcm.PixelSpacing[0]), float(dcm.PixelSpacing[1]))
+
+    # Determine measurement dimension
+    measured_dim = measured_dimension(dcm.ImageOrientationPatient)
+
+    d_avg = measure_width(dcm.pixel_array, pixel_spacing[0])
     logging.debug("Average {0} width: {1}".format(measured_dim, d_avg))
 
-    # plt.imshow(mask)
-    # plt.show()
+    ret = {'PatientName': dcm.PatientName,
+           'AccessionNumber': dcm.AccessionNumber,
+           measured_dim:  d_avg}
+
+    return ret
+
+
+def MeasureFrame(tags, pixels):
+    '''MeasureScout for simplified tags and a pixel array, e.g., from OrthancGateway.GetItem(..., 'frame')'''
 
-    ret = {'PatientName': patient_name,
-           'AccessionNumber': accession_number,
+    pixel_spacing = [float(v) for v in tags['PixelSpacing'].split('\\')]
+    orientation = [float(v) for v in tags['ImageOrientationPatient'].split('\\')]
+
+    measured_dim = measured_dimension(orientation)
+
+    d_avg = measure_width(pixels, pixel_spacing[0])
+    logging.debug("Average {0} width: {1}".format(measured_dim, d_avg))
+
+    ret = {'PatientName': tags.get('PatientName'),
+           'AccessionNumber': tags.get('AccessionNumber'),
            measured_dim:  d_avg}
 
     return ret
 
+
 if __name__=="__main__":
 
     logging.basicConfig(level=logging.DEBUG)
@@ -0,0 +1,49 @@
+'''Turn a single frame fetched from Orthanc into a NumPy array, without parsing any DICOM'''
+
+import numpy as np
+
+# Accept type for a rendered frame as PAM, a short text header followed by raw samples
+PAM = 'image/x-portable-arbitrarymap'
+
+
+def raw_frame(data, tags):
+    '''
+    Array for an uncompressed frame from instances/{id}/frames/0/raw, shaped by the instance's
+    simplified tags.  None if data isn't the size those tags describe, as for a compressed
+    transfer syntax, where Orthanc returns the encoded fragment instead.
+    '''
+
+    rows = int(tags['Rows'])
+    columns = int(tags['Columns'])
+    samples = int(tags.get('SamplesPerPixel', 1))
+    bits = int(tags.get('BitsAllocated', 16))
+    if bits not in [8, 16, 32]:
+        return None
+
+    signed = tags.get('PixelRepresentation') == '1'
+    dtype = np.dtype('<{0}{1}'.format('i' if signed else 'u', bits // 8))
+    if len(data) != rows * columns * samples * dtype.itemsize:
+        return None
+
+    pixels = np.frombuffer(data, dtype=dtype)
+    if samples > 1:
+        return pixels.reshape((rows, columns, samples))
+    return pixels.reshape((rows, columns))
+
+
+def read_pam(data):
+    '''Array for a PAM image, as Orthanc renders frames/0/image-uint16 when asked for one'''
+
+    # e.g., "P7\nWIDTH 512\nHEIGHT 512\nDEPTH 1\nMAXVAL 65535\nTUPLTYPE GRAYSCALE\nENDHDR\n"
+    end = data.index(b'ENDHDR\n') + len(b'ENDHDR\n')
+    header = dict(line.split(None, 1) for line in data[:end].decode('ascii').splitlines() if ' ' in line)
+
+    width = int(header['WIDTH'])
+    height = int(header['HEIGHT'])
+    depth = int(header.get('DEPTH', 1))
+    dtype = '>u2' if int(header.get('MAXVAL', 255)) > 255 else 'u1'
+
+    pixels = np.frombuffer(data, dtype=dtype, count=width * height * depth, offset=end)
+    if depth > 1:
+        return pixels.reshape((height, width, depth))
+    return pixels.reshape((height, width))
@@ -0,0 +1,156 @@
+'''Request/bandwidth limits, adaptive concurrency and time-of-day schedules per endpoint'''
+
+import logging
+import threading
+import time
+from datetime import datetime
+
+
+class TokenBucket(object):
+    '''Allows `rate` units per second on average, in bursts of up to `burst` units'''
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def reserve(self, n=1, scale=1.0):
+        '''Take n tokens, returning how long to wait before using them'''
+        # Going into debt and sleeping it off lets requests larger than the burst through
+        with self.lock:
+            now = time.time()
+            rate = self.rate * scale
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * rate)
+            self.last = now
+            self.tokens = self.tokens - n
+            return -self.tokens / rate if self.tokens < 0 else 0
+
+    def consume(self, n=1, scale=1.0):
+        wait = self.reserve(n, scale)
+        if wait > 0:
+            time.sleep(wait)
+
+
+class AIMDLimiter(object):
+    '''
+    Concurrency limit driven by observed latency: every `window` requests the p95 is
+    compared to `target_latency`, and the limit grows by one while under target
+    (additive increase) or is halved when over (multiplicative decrease).
+    '''
+
+    def __init__(self, target_latency, initial=4, minimum=1, maximum=32, window=50):
+        self.target_latency = target_latency
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window = window
+        self.in_use = 0
+        self.samples = []
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.in_use >= self.limit:
+                self.cond.wait()
+            self.in_use = self.in_use + 1
+
+    def release(self, latency):
+        with self.cond:
+            self.in_use = self.in_use - 1
+            self.samples.append(latency)
+            if len(self.samples) >= self.window:
+                self.samples.sort()
+                p95 = self.samples[int(0.95 * (len(self.samples) - 1))]
+                if p95 > self.target_latency:
+                    self.limit = max(self.minimum, self.limit // 2)
+                else:
+                    self.limit = min(self.maximum, self.limit + 1)
+                logging.debug('p95 latency {0:.3f}s, concurrency limit now {1}'.format(p95, self.limit))
+                self.samples = []
+            self.cond.notify_all()
+
+
+class Schedule(object):
+    '''
+    Time-of-day multipliers for the configured rates, e.g., "07:00-19:00=0.25,19:00-07:00=1"
+    runs at a quarter speed during clinical hours.  A multiplier of 0 pauses traffic.
+    '''
+
+    def __init__(self, spec):
+        self.windows = []
+        for part in spec.split(','):
+            span, factor = part.split('=')
+            start, end = [self.minutes(t) for t in span.split('-')]
+            self.windows.append((start, end, float(factor)))
+
+    @staticmethod
+    def minutes(s):
+        h, m = s.strip().split(':')
+        return int(h) * 60 + int(m)
+
+    def factor(self, now=None):
+        now = now or datetime.now()
+        t = now.hour * 60 + now.minute
+        for start, end, factor in self.windows:
+            # Windows may wrap around midnight
+            if (start <= end and start <= t < end) or (start > end and (t >= start or t < end)):
+                return factor
+        return 1.0
+
+
+class RateControl(object):
+
+    def __init__(self, requests_per_sec=None, bytes_per_sec=None, target_latency=None,
+                 max_concurrency=32, schedule=None):
+        self.requests = TokenBucket(requests_per_sec) if requests_per_sec else None
+        self.bandwidth = TokenBucket(bytes_per_sec) if bytes_per_sec else None
+        self.limiter = AIMDLimiter(target_latency, maximum=max_concurrency) if target_latency else None
+        self.schedule = Schedule(schedule) if schedule else None
+
+    def request(self, send, body_size=0):
+        '''Call send() once the limits allow it, returns its response'''
+
+        scale = self.schedule.factor() if self.schedule else 1.0
+        while scale <= 0:
+            logging.debug('Paused by schedule')
+            time.sleep(60)
+            scale = self.schedule.factor()
+
+        if self.requests:
+            self.requests.consume(1, scale)
+        if self.bandwidth and body_size:
+            self.bandwidth.consume(body_size, scale)
+
+        if self.limiter:
+            self.limiter.acquire()
+        tic = time.time()
+        try:
+            r = send()
+        finally:
+            if self.limiter:
+                self.limiter.release(time.time() - tic)
+
+        # Downloads count against the same bandwidth budget, paid after the fact
+        if self.bandwidth:
+            size = int(r.headers.get('content-length') or 0)
+            if size:
+                self.bandwidth.consume(size, scale)
+
+        return r
+
+
+# Every Session to the same host:port shares one controller
+_controls = {}
+
+
+def configure(endpoint, **kwargs):
+    '''Limit traffic to endpoint ("host:port", or "*" for any endpoint)'''
+    _controls[endpoint] = RateControl(**kwargs)
+    logging.info('Rate control for {0}: {1}'.format(endpoint, kwargs))
+    return _controls[endpoint]
+
+
+def get_rate_control(endpoint):
+    return _controls.get(endpoint) or _controls.get('*')
@@ -0,0 +1,178 @@
+'''Select and bulk-delete Orthanc resources so staging archives can be recycled'''
+
+import logging
+import time
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+from IDSet import IDSet
+from SessionWrapper import is_error
+from Trace import span
+
+# Orthanc's LastUpdate format, e.g., "20170322T115523"
+LAST_UPDATE_FORMAT = "%Y%m%dT%H%M%S"
+
+# REST resource names to tools/find levels
+FIND_LEVELS = {'patients': 'Patient',
+               'studies': 'Study',
+               'series': 'Series',
+               'instances': 'Instance'}
+
+# Log throughput every this many deletions
+REPORT_EVERY = 1000
+
+
+def select_by_age(src, level, days):
+    '''Resources at level that have not been updated for at least `days` days'''
+
+    cutoff = datetime.now() - timedelta(days=days)
+    items = []
+    for resource in src.do_get('{0}?expand'.format(level)):
+        try:
+            updated = datetime.strptime(resource['LastUpdate'], LAST_UPDATE_FORMAT)
+        except (KeyError, ValueError):
+            logging.debug('No LastUpdate for {0}, keeping it'.format(resource.get('ID')))
+            continue
+        if updated < cutoff:
+            items.append(resource['ID'])
+    logging.info('Found {0} {1} older than {2} days'.format(len(items), level, days))
+    return IDSet(items)
+
+
+def select_by_label(src, level, label):
+    '''Resources at level carrying an Orthanc label (Orthanc 1.12+)'''
+
+    items = src.do_post('tools/find', data={'Level': FIND_LEVELS[level],
+                                            'Query': {},
+                                            'Labels': [label],
+                                            'LabelsConstraint': 'All'})
+    if is_error(items):
+        logging.warn('Label query failed, does this Orthanc support labels?')
+        return IDSet()
+    logging.info('Found {0} {1} labelled {2}'.format(len(items), level, label))
+    return IDSet(items)
+
+
+def select_replicated(src, level, dests):
+    '''
+    Studies or series whose every instance is already stored on every destination.
+    Orthanc IDs are hashes of the DICOM UIDs, so the same instance has the same ID on
+    every server and the check is a packed set difference per series.
+    '''
+
+    if level not in ['studies', 'series']:
+        raise ValueError('Replication can only be checked for studies or series')
+
+    present = IDSet(src.do_get('instances'))
+    for dest in dests:
+        present = present & IDSet(dest.do_get('instances'))
+
+    items = complete(src.do_get('series?expand'), level,
+                     lambda series: len(IDSet(series['Instances']) - present) == 0)
+    logging.info('Found {0} {1} replicated to {2} destinations'.format(len(items), level, len(dests)))
+    return items
+
+
+def select_verified(src, level, dests, workers=8):
+    '''Studies or series whose every instance is on every destination with a matching stored MD5'''
+
+    from Verify import verify
+
+    if level not in ['studies', 'series']:
+        raise ValueError('Verification can only be checked for studies or series')
+
+    listing = src.do_get('series?expand')
+    # Deleting on the strength of a sample would be unsafe, so check everything
+    failed = verify(src, dests, rate=1.0, workers=workers, series=listing)['failed_series']
+
+    items = complete(listing, level, lambda series: series['ID'] not in failed)
+    logging.info('Found {0} {1} verified on {2} destinations'.format(len(items), level, len(dests)))
+    return items
+
+
+def complete(listing, level, ok):
+    # Series (or the studies they belong to) for which ok() holds for every series
+    passed = set()
+    failed = set()
+    for series in listing:
+        key = series['ID'] if level == 'series' else series['ParentStudy']
+        if ok(series):
+            passed.add(key)
+        else:
+            failed.add(key)
+    return IDSet(passed - failed)
+
+
+def select(src, level, older_than=None, label=None, replicated_to=None, verified_on=None, workers=8):
+    '''Intersection of every selector given, a resource has to match all of them'''
+
+    selected = None
+
+    def narrow(items):
+        return items if selected is None else selected & items
+
+    if older_than is not None:
+        selected = narrow(select_by_age(src, level, older_than))
+    if label:
+        selected = narrow(select_by_label(src, level, label))
+    if replicated_to:
+        selected = narrow(select_replicated(src, level, replicated_to))
+    if verified_on:
+        selected = narrow(select_verified(src, level, verified_on, workers))
+
+    if selected is None:
+        raise ValueError('No retention rule given, refusing to select everything')
+    return selected
+
+
+def purge(src, level, items, workers=8, bulk=False, batch_size=1000, dry_run=False):
+    '''
+    Delete items at level, either with `workers` concurrent DELETE requests or, with bulk,
+    batch_size resources at a time through tools/bulk-delete (Orthanc 1.9+).  Returns the
+    number deleted.
+    '''
+
+    items = list(items)
+    if dry_run:
+        logging.info('Dry run, would delete {0} {1}'.format(len(items), level))
+        for item in items[:10]:
+            logging.info('  {0}/{1}'.format(level, item))
+        return 0
+
+    tic = time.time()
+    deleted = 0
+    failed = 0
+
+    def report(deleted, failed):
+        elapsed = time.time() - tic
+        logging.info('Deleted {0} of {1} {2} in {3:.1f}s ({4:.1f}/s), {5} failed'.format(
+            deleted, len(items), level, elapsed, deleted / max(elapsed, 1e-6), failed))
+
+    if bulk:
+        for i in range(0, len(items), batch_size):
+            batch = items[i:i + batch_size]
+            with span('bulk_delete', count=len(batch)):
+                r = src.do_post('tools/bulk-delete', data={'Resources': batch})
+            if is_error(r):
+                failed = failed + len(batch)
+            else:
+                deleted = deleted + len(batch)
+            report(deleted, failed)
+        return deleted
+
+    def delete(item):
+        with span('delete', id=item):
+            return src.do_delete('{0}/{1}'.format(level, item))
+
+    pool = ThreadPool(workers)
+    for r in pool.imap_unordered(delete, items):
+        if is_error(r):
+            failed = failed + 1
+        else:
+            deleted = deleted + 1
+        if (deleted + failed) % REPORT_EVERY == 0:
+            report(deleted, failed)
+    pool.close()
+    pool.join()
+
+    report(deleted, failed)
+    return deleted
@@ -0,0 +1,55 @@
+'''Request body serializers, using the fastest JSON backend available'''
+
+import json
+import logging
+from datetime import datetime
+
+# Optional faster backends, in order of preference
+try:
+    import orjson as _fast_json
+except ImportError:
+    try:
+        import ujson as _fast_json
+    except ImportError:
+        _fast_json = None
+
+
+class DateTimeEncoder(json.JSONEncoder):
+    # Fallback only -- simplify_tags already writes datetimes as iso strings
+    def default(self, obj):
+        if isinstance(obj, datetime):
+            return obj.isoformat()
+        if hasattr(obj, 'hexdigest'):
+            return obj.hexdigest()
+        return json.JSONEncoder.default(self, obj)
+
+
+class JSONSerializer(object):
+
+    content_type = 'application/json'
+
+    def __init__(self, backend=_fast_json):
+        self.backend = backend
+        if self.backend:
+            logging.debug('Using {0} for json encoding'.format(self.backend.__name__))
+
+    def dumps(self, data):
+        if self.backend:
+            try:
+                return self.backend.dumps(data)
+            except (TypeError, OverflowError, ValueError):
+                # Something the fast backend can't encode, let the stdlib encoder handle it
+                pass
+        return json.dumps(data, cls=DateTimeEncoder)
+
+
+_serializers = {'json': JSONSerializer(),
+                'stdlib_json': JSONSerializer(backend=None)}
+
+
+def get_serializer(name='json'):
+    return _serializers[name]
+
+
+def register_serializer(name, serializer):
+    _serializers[name] = serializer
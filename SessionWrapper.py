@@ -1,18 +1,30 @@
 import logging
 import requests
-import json
+import zlib
 from posixpath import join as urljoin
 from urlparse import urlsplit
-from datetime import datetime
-import collections
 from hashlib import sha256
+from Serializers import get_serializer
+from RateControl import get_rate_control
+from Trace import span
 
 # from requests.packages.urllib3.util import Retry
 from requests.adapters import HTTPAdapter
 
+
+def get_endpoint(address):
+    p = urlsplit(address)
+    return "{0}:{1}".format(p.hostname, p.port)
+
+
+def is_error(r):
+    # do_return passes the raw response back when a request fails
+    return isinstance(r, requests.Response)
+
+
 class Session(requests.Session):
 
-    def __init__(self, address):
+    def __init__(self, address, serializer=None, gzip_min_size=None):
 
         super(Session, self).__init__()
 
@@ -28,11 +40,29 @@ class Session(requests.Session):
         else:
             self.auth = (p.username, p.password)
 
-        self.logger = logging.getLogger("{0}:{1} API".format(self.hostname, self.port))
+        self.endpoint = get_endpoint(self.address)
+        self.logger = logging.getLogger("{0} API".format(self.endpoint))
         self.logger.info('Created a session wrapper for %s' % address)
 
         self.mount('http://', HTTPAdapter(max_retries=5))
 
+        self.serializer = serializer or get_serializer()
+        # Gzip request bodies at least this many bytes long (None to never compress)
+        self.gzip_min_size = gzip_min_size
+
+    def request(self, method, url, *args, **kwargs):
+        # Every get/post/delete passes through here, so throttling applies to all callers
+        control = get_rate_control(self.endpoint)
+
+        def send():
+            return super(Session, self).request(method, url, *args, **kwargs)
+
+        if not control:
+            return send()
+        data = kwargs.get('data')
+        body_size = len(data) if hasattr(data, '__len__') else 0
+        return control.request(send, body_size)
+
     def get_url(self, *loc):
         return urljoin("{0}://{1}:{2}".format(self.scheme, self.hostname, self.port), self.path, *loc)
 
@@ -53,11 +83,28 @@ class Session(requests.Session):
             ret = r.content
         return ret
 
-    def do_get(self, loc, params={}):
+    def do_get(self, loc, params={}, headers=None):
         # self.logger.debug(self.get_url(loc))
-        r = self.get(self.get_url(loc), headers=self.headers, verify=False, params=params)
+        if headers:
+            headers = dict(self.headers, **headers)
+        r = self.get(self.get_url(loc), headers=headers or self.headers, verify=False, params=params)
+        return self.do_return(r)
+
+    def do_post_form(self, loc, fields):
+        # requests form-encodes a dict body
+        r = self.post(self.get_url(loc), data=fields, headers=self.headers, verify=False)
         return self.do_return(r)
 
+    def do_stream(self, loc, data=None, params=None):
+        # Yield lines of a long-running response (e.g., a Splunk export) as they arrive
+        r = self.post(self.get_url(loc), data=data, params=params, headers=self.headers, verify=False, stream=True)
+        if r.status_code != 200:
+            self.logger.warn('Session returned error %s', r.status_code)
+            return
+        for line in r.iter_lines():
+            if line:
+                yield line.decode('utf-8') if isinstance(line, bytes) else line
+
     def do_delete(self, loc, params={}):
         r = self.delete(self.get_url(loc), headers=self.headers, verify=False, params=params)
         return self.do_return(r)
@@ -65,22 +112,30 @@ class Session(requests.Session):
     def do_put(self, loc, data, headers={}):
         pass
 
-    def do_post(self, loc, data, headers={}):
+    def do_post(self, loc, data, headers=None):
 
-        class DateTimeEncoder(json.JSONEncoder):
-            def default(self, obj):
-                if isinstance(obj, datetime):
-                    return obj.isoformat()
-                if hasattr(obj, 'hexdigest'):
-                    return obj.hexdigest()
-                return json.JSONEncoder.default(self, obj)
+        headers = dict(headers or {})
 
-        if type(data) is dict or type(data) is collections.OrderedDict:
-            headers.update({'content-type': 'application/json'})
-            data = json.dumps(data, cls=DateTimeEncoder)
+        if isinstance(data, dict):
+            headers['content-type'] = self.serializer.content_type
+            with span('json_encode'):
+                data = self.serializer.dumps(data)
         elif isinstance(data, str):
-            headers.update({'content-type': 'text/plain'})
+            headers.setdefault('content-type', 'text/plain')
+
+        if self.gzip_min_size is not None and data and len(data) >= self.gzip_min_size:
+            with span('gzip', size=len(data)):
+                data = self.gzip(data)
+            headers['content-encoding'] = 'gzip'
 
         r = self.post(self.get_url(loc), data=data, headers=headers, verify=False)
 
         return self.do_return(r)
+
+    @staticmethod
+    def gzip(data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        # wbits=31 writes a gzip rather than a raw zlib stream
+        z = zlib.compressobj(6, zlib.DEFLATED, 31)
+        return z.compress(data) + z.flush()
@@ -0,0 +1,182 @@
+'''Split a job between CopyDICOM workers by hashing Orthanc IDs, with leases so live workers finish a dead one's shard'''
+
+import copy
+import hashlib
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import numpy as np
+from IDSet import IDSet, PACKED_LENGTH
+
+# Seconds without a heartbeat before another worker may take a shard over
+LEASE_TTL = 60
+
+
+def parse_shard(spec):
+    '''"i/N" to (i, N), with shards numbered from 0'''
+    i, n = [int(v) for v in spec.split('/')]
+    if n < 1 or not 0 <= i < n:
+        raise ValueError('Shard must be i/N with 0 <= i < N')
+    return i, n
+
+
+def shard_of(item, n):
+    # Orthanc IDs are SHA-1 digests, so their first 8 hex digits are already evenly spread
+    try:
+        return int(item[:8], 16) % n
+    except ValueError:
+        return int(hashlib.md5(item.encode('utf-8')).hexdigest()[:8], 16) % n
+
+
+def shard_subset(items, shard, n):
+    '''Those items in shard of n, computed over the packed digests for Orthanc IDs'''
+
+    if n == 1:
+        return items
+    try:
+        items = IDSet.coerce(items)
+    except ValueError:
+        return [item for item in items if shard_of(item, n) == shard]
+
+    # The first 4 packed bytes are the first 8 hex digits, as shard_of reads them
+    octets = items.ids.view(np.uint8).reshape(-1, PACKED_LENGTH)[:, :4].astype(np.uint32)
+    prefix = (octets[:, 0] << 24) | (octets[:, 1] << 16) | (octets[:, 2] << 8) | octets[:, 3]
+    return IDSet.from_packed(items.ids[prefix % n == shard])
+
+
+class Leases(object):
+    '''
+    Shard leases in a SQLite file shared by every worker.  A worker holds a shard for as long
+    as its heartbeat thread keeps renewing the lease.  Once a lease has gone `ttl` seconds
+    without renewal its worker is presumed dead, and the first worker to look claims it.
+    A worker that was only stalled may briefly overlap with the one that took over, which
+    is harmless since Orthanc ignores instances it already stores.
+    '''
+
+    def __init__(self, fn, n, ttl=LEASE_TTL, owner=None):
+        self.fn = fn
+        self.n = n
+        self.ttl = ttl
+        self.owner = owner or '{0}:{1}'.format(socket.gethostname(), os.getpid())
+        self.held = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.execute('CREATE TABLE IF NOT EXISTS leases '
+                     '(shard INTEGER PRIMARY KEY, owner TEXT, expires REAL, done INTEGER DEFAULT 0)')
+
+    def execute(self, sql, params=()):
+        # A connection per statement, so the heartbeat thread never shares one
+        db = sqlite3.connect(self.fn, timeout=30)
+        try:
+            with db:
+                cursor = db.execute(sql, params)
+                return cursor.fetchall() if sql.startswith('SELECT') else cursor.rowcount
+        finally:
+            db.close()
+
+    def acquire(self, shard):
+        '''Claim shard if it is free, finished, expired or already ours'''
+        now = time.time()
+        self.execute('INSERT OR IGNORE INTO leases (shard, owner, expires, done) VALUES (?, NULL, 0, 0)', (shard,))
+        claimed = self.execute('UPDATE leases SET owner = ?, expires = ?, done = 0 '
+                               'WHERE shard = ? AND (owner IS NULL OR owner = ? OR expires < ?)',
+                               (self.owner, now + self.ttl, shard, self.owner, now))
+        if claimed:
+            with self.lock:
+                self.held.add(shard)
+        return claimed == 1
+
+    def release(self, shard):
+        # Finished, so nobody takes it over
+        self.execute('UPDATE leases SET owner = NULL, expires = 0, done = 1 WHERE shard = ? AND owner = ?',
+                     (shard, self.owner))
+        with self.lock:
+            self.held.discard(shard)
+
+    def orphans(self):
+        # Unfinished shards whose worker stopped renewing
+        rows = self.execute('SELECT shard FROM leases WHERE shard < ? AND done = 0 AND owner IS NOT NULL '
+                            'AND owner != ? AND expires < ? ORDER BY shard',
+                            (self.n, self.owner, time.time()))
+        return [row[0] for row in rows]
+
+    def pending(self):
+        # Unfinished shards that other live workers still hold
+        rows = self.execute('SELECT shard FROM leases WHERE shard < ? AND done = 0 AND owner IS NOT NULL '
+                            'AND owner != ? AND expires >= ?',
+                            (self.n, self.owner, time.time()))
+        return [row[0] for row in rows]
+
+    def take_over(self):
+        '''Claim the first orphaned shard, None if there are none'''
+        for shard in self.orphans():
+            if self.acquire(shard):
+                return shard
+
+    def heartbeat(self):
+        while not self.stopped.wait(self.ttl / 3.0):
+            with self.lock:
+                held = list(self.held)
+            for shard in held:
+                renewed = self.execute('UPDATE leases SET expires = ? WHERE shard = ? AND owner = ?',
+                                       (time.time() + self.ttl, shard, self.owner))
+                if not renewed:
+                    logging.warn('Lost the lease on shard {0}/{1}'.format(shard, self.n))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.heartbeat, name='lease-heartbeat')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+
+
+def shard_opts(opts, shard, n):
+    # Each shard keeps its own journal, so whoever takes it over resumes it
+    ret = copy.copy(opts)
+    ret.shard = (shard, n)
+    if getattr(opts, 'journal', None):
+        ret.journal = '{0}.{1}of{2}'.format(opts.journal, shard, n)
+    return ret
+
+
+def run_sharded(opts, job):
+    '''
+    job(opts) for this worker's --shard and then, with --lease, for any shard whose worker
+    stops renewing its lease.  Returns once no other live worker holds an unfinished shard.
+    Shards whose workers never started are left alone.
+    '''
+
+    shard, n = opts.shard
+    if not getattr(opts, 'lease', None):
+        return job(shard_opts(opts, shard, n))
+
+    leases = Leases(opts.lease, n, ttl=opts.lease_ttl)
+    leases.start()
+    try:
+        if leases.acquire(shard):
+            logging.info('Running shard {0}/{1}'.format(shard, n))
+            job(shard_opts(opts, shard, n))
+            leases.release(shard)
+        else:
+            logging.warn('Shard {0}/{1} is leased to a live worker, skipping it'.format(shard, n))
+
+        while True:
+            orphan = leases.take_over()
+            if orphan is not None:
+                logging.info('Taking over shard {0}/{1} from a worker that stopped'.format(orphan, n))
+                job(shard_opts(opts, orphan, n))
+                leases.release(orphan)
+            elif leases.pending():
+                time.sleep(leases.ttl / 3.0)
+            else:
+                break
+    finally:
+        leases.stop()
@@ -0,0 +1,180 @@
+'''Searches for which Orthanc IDs a Splunk index already holds, bounded in time and by candidate set'''
+
+import collections
+import logging
+import time
+from datetime import datetime, timedelta
+from IDSet import IDSet, id_batches, id_intersection, id_union
+from StructuredTags import epoch, parse_isodatetime
+from Trace import span
+
+# Index for each role, unless a gateway is given index_names
+DEFAULT_INDEX_NAMES = {'series': 'dicom_series',
+                       'dose': 'dose_reports',
+                       'remote_studies': 'pacs_studies',
+                       'remote_series': 'pacs_series',
+                       'patient_dims': 'patient_dims'}
+
+# IDs per subset search; each becomes a term in the search string
+CHUNK_SIZE = 500
+
+# Past this many candidates, one (time-bounded) listing beats many subset searches
+SUBSET_THRESHOLD = 20000
+
+# Subset searches running at once; each mostly waits on Splunk
+SEARCH_WORKERS = 4
+
+# Results per page when reading back a finished search
+PAGE_SIZE = 50000
+
+
+def run_search(session, q):
+    '''Run a search job to completion and return the first column of its results'''
+
+    def poll_until_done(sid):
+        isDone = False
+        i = 0
+        r = None
+        while not isDone:
+            i = i + 1
+            time.sleep(1)
+            r = session.do_get('services/search/jobs/{0}'.format(sid), params={'output_mode': 'json'})
+            isDone = r['entry'][0]['content']['isDone']
+            status = r['entry'][0]['content']['dispatchState']
+            if i % 5 == 1:
+                logging.debug('Waiting to finish {0} ({1})'.format(i, status))
+        return r['entry'][0]['content']['resultCount']
+
+    # Ask for json so the sid can be read without an xml parser
+    r = session.do_post_form('services/search/jobs', {'search': q, 'output_mode': 'json'})
+    sid = r['sid']
+
+    with span('splunk_search', sid=sid):
+        n = poll_until_done(sid)
+
+    results = []
+    for offset in range(0, n, PAGE_SIZE):
+        r = session.do_get('services/search/jobs/{0}/results'.format(sid),
+                           params={'output_mode': 'csv', 'count': PAGE_SIZE, 'offset': offset})
+        results = results + r.replace('"', '').splitlines()[1:]
+    return results
+
+
+def time_terms(earliest=None, latest=None):
+    # Datetimes become epoch seconds, anything else (e.g., "-7d@d") is passed through
+    terms = []
+    for key, value in [('earliest', earliest), ('latest', latest)]:
+        if value is None:
+            continue
+        if isinstance(value, datetime):
+            value = int(epoch(value))
+        terms.append('{0}={1}'.format(key, value))
+    return ' '.join(terms)
+
+
+def time_bounds(times, slack=timedelta(days=1)):
+    '''(earliest, latest) around a set of datetimes or iso strings, None if there are none'''
+    times = [t if isinstance(t, datetime) else parse_isodatetime(t) for t in times if t]
+    if not times:
+        return None, None
+    return min(times) - slack, max(times) + slack
+
+
+def date_range_bounds(dates, slack=timedelta(days=1)):
+    '''(earliest, latest) for a DICOM date range query such as "20170101-20170131"'''
+    if not dates:
+        return None, None
+    start, dash, end = dates.partition('-')
+    if not dash:
+        # A single day
+        end = start
+    earliest = datetime.strptime(start, '%Y%m%d') - slack if start else None
+    latest = datetime.strptime(end, '%Y%m%d') + timedelta(days=1) + slack if end else None
+    return earliest, latest
+
+
+def id_query(index, field='ID', ids=None, earliest=None, latest=None, tstats=False, summary_index=None):
+    '''
+    Search returning the distinct values of field in index, optionally limited to ids and a
+    time range.  With tstats, field must be an indexed field (e.g., INDEXED_EXTRACTIONS = json),
+    and the search only reads tsidx files.  A summary_index is searched instead of raw events
+    when one is kept with the IDs.
+    '''
+
+    bounds = time_terms(earliest, latest)
+    match = ''
+    if ids:
+        match = '(' + ' OR '.join('{0}="{1}"'.format(field, i) for i in ids) + ')'
+
+    if tstats:
+        where = ' '.join(t for t in ['index={0}'.format(index), bounds, match] if t)
+        return '| tstats count where {0} by {1} | fields {1}'.format(where, field)
+
+    if summary_index:
+        return 'search index={0} {1} {2} | dedup {3} | table {3}'.format(summary_index, bounds, match, field)
+
+    # Raw events: use the index lexicon to find events mentioning the ids before extracting json
+    terms = ''
+    if ids:
+        terms = '(' + ' OR '.join('TERM({0})'.format(i) for i in ids) + ')'
+    q = 'search index={0} {1} {2} | spath {3}'.format(index, bounds, terms, field)
+    if ids:
+        q = q + ' | search {0}'.format(match)
+    return q + ' | dedup {0} | table {0}'.format(field)
+
+
+def listed_values(session, index, field='ID', **kwargs):
+    # Every value of field in index (within the time bounds), packed if they are Orthanc IDs
+    found = run_search(session, id_query(index, field, **kwargs))
+    logging.debug('Listed {0} indexed values of {1} in {2}'.format(len(found), field, index))
+    try:
+        return IDSet(found)
+    except ValueError:
+        return set(found)
+
+
+def indexed_subset(session, index, candidates, field='ID', earliest=None, latest=None,
+                   tstats=False, summary_index=None, chunk_size=CHUNK_SIZE, workers=SEARCH_WORKERS,
+                   threshold=SUBSET_THRESHOLD):
+    '''
+    Those candidates that index already holds (as field).  Up to threshold candidates are
+    found with searches limited to chunks of them, workers at a time.  Past that, one
+    (time-bounded) listing is searched instead and the rest are intersected with it locally.
+    Candidates are read a chunk at a time, so they may be a generator or an IDSet.
+    '''
+
+    from multiprocessing.pool import ThreadPool
+
+    kwargs = {'earliest': earliest, 'latest': latest, 'tstats': tstats, 'summary_index': summary_index}
+
+    def search(chunk):
+        return id_intersection(chunk, run_search(session, id_query(index, field, chunk, **kwargs)))
+
+    listed = None
+    if hasattr(candidates, '__len__') and len(candidates) > threshold:
+        listed = listed_values(session, index, field, **kwargs)
+
+    pool = ThreadPool(workers)
+    found = []
+    searching = collections.deque()
+    n = 0
+    try:
+        for chunk in id_batches(candidates, chunk_size):
+            n = n + len(chunk)
+            if listed is None and n > threshold:
+                # More candidates than it was worth searching for one by one
+                listed = listed_values(session, index, field, **kwargs)
+            if listed is not None:
+                found.append(id_intersection(chunk, listed))
+                continue
+            searching.append(pool.apply_async(search, (chunk,)))
+            # Don't read further ahead of the searches than they can use
+            if len(searching) >= 2 * workers:
+                found.append(searching.popleft().get())
+        found.extend(r.get() for r in searching)
+    finally:
+        pool.close()
+
+    found = id_union(found)
+    logging.debug('Found {0} of {1} candidates indexed in {2}'.format(len(found), n, index))
+    return found
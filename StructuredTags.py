@@ -1,9 +1,15 @@
 import logging
 # import requests
 import json
+import time
 from datetime import datetime
 from pprint import pprint, pformat
 
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
 
 class DateTimeEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -30,6 +36,28 @@ def get_datetime(s):
     return ts
 
 
+# Simplified tags carry datetimes as iso strings, converted once here so that
+# request bodies serialize without an encoder fallback for every event
+def get_isodatetime(s):
+    return get_datetime(s).isoformat()
+
+
+def parse_isodatetime(s):
+    # isoformat() only writes microseconds when they are non-zero
+    try:
+        return datetime.strptime(s, "%Y-%m-%dT%H:%M:%S")
+    except ValueError:
+        return datetime.strptime(s, "%Y-%m-%dT%H:%M:%S.%f")
+
+
+# Time has to be absent, or passed in as epoch to be a valid HEC request
+def epoch(dt):
+    if not isinstance(dt, datetime):
+        dt = parse_isodatetime(dt)
+    tt = dt.timetuple()
+    return time.mktime(tt)
+
+
 # def get_tags(item):
 #
 #     ORTHANC_HOST = "http://localhost:8042"
@@ -83,7 +111,7 @@ def simplify_structured_tags(tags):
             value = item['UID']
             # logging.debug('Found uid value')
         elif type_ == 'DATETIME':
-            value = get_datetime(item['DateTime'])
+            value = get_isodatetime(item['DateTime'])
             # logging.debug('Found date/time value')
         elif type_ == 'CODE':
             try:
@@ -111,47 +139,60 @@ def simplify_structured_tags(tags):
     return data
 
 
-def simplify_tags(tags):
+def simplify_tags(tags, projection=None):
 
     # Parse any structured data into simplified tag structure
     if tags.get('ConceptNameCodeSequence'):
         # There is structured data in here
         key = tags['ConceptNameCodeSequence'][0]['CodeMeaning']
-        value = simplify_structured_tags(tags)
+        value = None
 
-        t = get_datetime(tags['ContentDate'] + tags['ContentTime'])
-        value['ContentDateTime'] = t
+        # Not worth walking a report the projection would throw away
+        if not projection or projection.keep(key):
+            value = simplify_structured_tags(tags)
+
+            t = get_isodatetime(tags['ContentDate'] + tags['ContentTime'])
+            value['ContentDateTime'] = t
 
         del(tags['ConceptNameCodeSequence'])
         del(tags['ContentSequence'])
         del(tags['ContentDate'])
         del(tags['ContentTime'])
 
-        tags[key] = value
+        if value is not None:
+            tags[key] = value
+
+    tags = simplify_datetimes(tags)
+    if projection:
+        tags = projection.apply(tags)
+    return tags
+
+
+def simplify_datetimes(tags):
 
     # Convert DICOM DateTimes into ISO DateTimes
     try:
-        t = get_datetime(tags['StudyDate'] + tags['StudyTime'])
+        t = get_isodatetime(tags['StudyDate'] + tags['StudyTime'])
         tags['StudyDateTime'] = t
     except KeyError:
         pass
 
     try:
-        t = get_datetime(tags['SeriesDate'] + tags['SeriesTime'])
+        t = get_isodatetime(tags['SeriesDate'] + tags['SeriesTime'])
         tags['SeriesDateTime'] = t
     except KeyError:
         pass
 
     # Not all instances have ObservationDateTime
     try:
-        t = get_datetime(tags['ObservationDateTime'])
+        t = get_isodatetime(tags['ObservationDateTime'])
         tags['ObservationDateTime'] = t
     except KeyError:
         pass
 
     # Not all instances have an InstanceCreationDate
     try:
-        t = get_datetime(tags['InstanceCreationDate'] + tags['InstanceCreationTime'])
+        t = get_isodatetime(tags['InstanceCreationDate'] + tags['InstanceCreationTime'])
         tags['InstanceCreationDateTime'] = t
     except KeyError:
         pass
@@ -173,6 +214,260 @@ def simplify_tags(tags):
     return tags
 
 
+def concept_value(item):
+    # Value of a single non-container content item
+    type_ = item.get('ValueType')
+    try:
+        if type_ == "TEXT" or type_ == "IMAGE":
+            return item['TextValue']
+        elif type_ == "NUM":
+            return float(item['MeasuredValueSequence'][0]['NumericValue'])
+        elif type_ == 'UIDREF':
+            return item['UID']
+        elif type_ == 'DATETIME':
+            return get_isodatetime(item['DateTime'])
+        elif type_ == 'CODE':
+            return item['ConceptCodeSequence'][0]['CodeMeaning']
+    except (KeyError, IndexError, ValueError):
+        logging.debug('No value for {0} item'.format(type_))
+        return None
+    logging.debug("Unknown ValueType ({0})".format(type_))
+
+
+def add_value(record, key, value, repeated=False):
+    if repeated:
+        record.setdefault(key, []).append(value)
+    elif key in record:
+        # Repeated concept names collect into a list, as in simplify_structured_tags
+        if isinstance(record[key], list):
+            record[key] = record[key] + [value]
+        else:
+            record[key] = [record[key], value]
+    else:
+        record[key] = value
+
+
+class ConceptSelector(object):
+    '''
+    A set of concept name paths, e.g., "CT Acquisition/CT Dose/Mean CTDIvol", compiled into
+    a tree so a structured report's ContentSequence can be walked once, skipping any
+    subtree that has no selected path below it.  Values land in a flat record keyed by path.
+
+    Containers listed in `each` repeat (one per acquisition, say), so every path below
+    them gets a list with exactly one entry per occurrence, `defaults` (or None) filling in
+    for missing concepts, which keeps the lists aligned as columns.
+    '''
+
+    def __init__(self, paths, each=(), defaults=None):
+        self.paths = list(paths)
+        self.defaults = defaults or {}
+        self.tree = {}
+        for path in self.paths:
+            node = self.tree
+            parts = path.split('/')
+            for part in parts[:-1]:
+                node = node.setdefault(part, {})
+                if not isinstance(node, dict):
+                    raise ValueError('{0} selects below a value'.format(path))
+            if isinstance(node.get(parts[-1]), dict):
+                raise ValueError('{0} selects a container'.format(path))
+            node[parts[-1]] = path
+        self.columns = dict((prefix, [p for p in self.paths if p.startswith(prefix + '/')])
+                            for prefix in each)
+
+    def extend(self, paths=(), defaults=None):
+        _defaults = dict(self.defaults)
+        _defaults.update(defaults or {})
+        return ConceptSelector(self.paths + list(paths), self.columns.keys(), _defaults)
+
+    def narrow(self, keep):
+        # Only the paths keep(path) accepts, so the rest are never walked
+        return ConceptSelector([p for p in self.paths if keep(p)], self.columns.keys(), self.defaults)
+
+    def extract(self, content, record=None):
+        if record is None:
+            record = {}
+        self._walk(content, self.tree, '', record)
+        return record
+
+    def _walk(self, items, node, prefix, record):
+        for item in items:
+            try:
+                name = item['ConceptNameCodeSequence'][0]['CodeMeaning']
+            except (KeyError, IndexError):
+                continue
+            selected = node.get(name)
+            if selected is None:
+                continue
+
+            if not isinstance(selected, dict):
+                add_value(record, selected, concept_value(item))
+                continue
+
+            path = prefix + name
+            children = item.get('ContentSequence') or []
+            if path in self.columns:
+                found = {}
+                self._walk(children, selected, path + '/', found)
+                for key in self.columns[path]:
+                    add_value(record, key, found.get(key, self.defaults.get(key)), repeated=True)
+            else:
+                self._walk(children, selected, path + '/', record)
+
+
+# Header tags kept on extracted dose records; the datetimes are combined by simplify_datetimes
+DOSE_HEADER_TAGS = ['AccessionNumber', 'PatientID', 'StudyInstanceUID', 'SeriesInstanceUID',
+                    'SOPInstanceUID', 'SeriesNumber', 'StationName', 'DeviceSerialNumber',
+                    'Manufacturer', 'ManufacturerModelName', 'InstitutionName', 'StudyDescription',
+                    'StudyDate', 'StudyTime', 'SeriesDate', 'SeriesTime',
+                    'InstanceCreationDate', 'InstanceCreationTime', 'ObservationDateTime']
+
+DOSE_REPORT = ConceptSelector([
+    'Device Observer UID',
+    'CT Accumulated Dose Data/Total Number of Irradiation Events',
+    'CT Accumulated Dose Data/CT Dose Length Product Total',
+    'CT Acquisition/Acquisition Protocol',
+    'CT Acquisition/Target Region',
+    'CT Acquisition/CT Acquisition Type',
+    'CT Acquisition/CT Acquisition Parameters/Exposure Time',
+    'CT Acquisition/CT Acquisition Parameters/Scanning Length',
+    'CT Acquisition/CT Acquisition Parameters/CT X-Ray Source Parameters/KVP',
+    'CT Acquisition/CT Acquisition Parameters/CT X-Ray Source Parameters/X-Ray Tube Current',
+    'CT Acquisition/CT Dose/Mean CTDIvol',
+    'CT Acquisition/CT Dose/DLP',
+    'CT Acquisition/CT Dose/CTDIw Phantom Type'],
+    each=['CT Acquisition'],
+    # Same rule as normalize_ctdi_tags, localizers may have no CT Dose at all
+    defaults={'CT Acquisition/CT Dose/Mean CTDIvol': 0})
+
+# Vendor profiles, matched against the Manufacturer tag.  Any other vendor, GE included, gets
+# DOSE_REPORT, whose defaults cover GE localizers that leave out CT Dose altogether.
+DOSE_PROFILES = {
+    # Siemens puts the scan mode and kernel in a per-acquisition comment
+    'SIEMENS': DOSE_REPORT.extend(['CT Acquisition/Comment'])
+}
+
+
+def dose_profile(tags):
+    manufacturer = (tags.get('Manufacturer') or '').upper()
+    for vendor, selector in DOSE_PROFILES.items():
+        if manufacturer.startswith(vendor):
+            return selector
+    return DOSE_REPORT
+
+
+# (selector, projection) -> selector narrowed to the projection's fields
+_narrowed = {}
+
+
+def extract_dose_report(tags, selector=None, projection=None):
+    '''
+    Flat dose record from raw (Orthanc "?simplify") tags: the DOSE_HEADER_TAGS plus only the
+    selected concept paths, instead of simplifying the whole structured report.  As for
+    simplify_tags, paths a projection would drop are never extracted.
+    '''
+
+    record = dict((k, tags[k]) for k in DOSE_HEADER_TAGS if k in tags)
+
+    try:
+        record['ConceptName'] = tags['ConceptNameCodeSequence'][0]['CodeMeaning']
+    except (KeyError, IndexError):
+        pass
+    try:
+        record['ContentDateTime'] = get_isodatetime(tags['ContentDate'] + tags['ContentTime'])
+    except KeyError:
+        pass
+
+    selector = selector or dose_profile(tags)
+    if projection:
+        key = (id(selector), id(projection))
+        if key not in _narrowed:
+            _narrowed[key] = selector.narrow(projection.keep)
+        selector = _narrowed[key]
+    selector.extract(tags.get('ContentSequence') or [], record)
+
+    # Make sure that a StationName is present
+    if "StationName" not in record:
+        station = record.get("DeviceSerialNumber") or record.get("Device Observer UID")
+        if station:
+            record["StationName"] = station
+        else:
+            logging.debug('No station name identifed')
+
+    record = simplify_datetimes(record)
+    if projection:
+        record = projection.apply(record)
+    return record
+
+
+class Projection(object):
+    '''
+    Which simplified tags go into an index event: only `fields` (every tag when None,
+    a trailing "*" matches a prefix), never empty values or private tags that Orthanc
+    couldn't name ("0019,10a3"), and strings cut down to `max_length` characters
+    '''
+
+    def __init__(self, fields=None, drop_empty=True, drop_private=True, max_length=1024):
+        self.fields = None
+        self.prefixes = ()
+        if fields is not None:
+            self.fields = set(f for f in fields if not f.endswith('*'))
+            self.prefixes = tuple(f[:-1] for f in fields if f.endswith('*'))
+        self.drop_empty = drop_empty
+        self.drop_private = drop_private
+        self.max_length = max_length
+
+    def keep(self, key):
+        if self.drop_private and len(key) == 9 and key[4] == ',':
+            return False
+        return self.fields is None or key in self.fields or key.startswith(self.prefixes)
+
+    def apply(self, tags):
+        ret = {}
+        for key, value in tags.items():
+            if not self.keep(key):
+                continue
+            if self.drop_empty and (value is None or value == '' or value == [] or value == {}):
+                continue
+            if self.max_length and isinstance(value, string_types) and len(value) > self.max_length:
+                value = value[:self.max_length]
+            ret[key] = value
+        return ret
+
+
+# Event time and date fields every profile keeps
+_TIME_FIELDS = ['InstanceCreationDateTime', 'StudyDateTime', 'SeriesDateTime']
+
+_SERIES_FIELDS = ['PatientID', 'PatientSex', 'PatientAge', 'AccessionNumber',
+                  'StudyInstanceUID', 'StudyDescription', 'SeriesInstanceUID', 'SeriesDescription',
+                  'SeriesNumber', 'Modality', 'BodyPartExamined', 'ProtocolName', 'StationName',
+                  'DeviceSerialNumber', 'Manufacturer', 'ManufacturerModelName', 'InstitutionName',
+                  'ReferringPhysicianName', 'OperatorsName'] + _TIME_FIELDS
+
+# Projection profiles by index role, as in SplunkQuery.DEFAULT_INDEX_NAMES
+PROJECTIONS = {
+    # Every named tag, just without the empties, private tags and oversized strings
+    'full': Projection(),
+    'series': Projection(_SERIES_FIELDS),
+    'instances': Projection(_SERIES_FIELDS + ['SOPInstanceUID', 'SOPClassUID', 'InstanceNumber',
+                                              'ImageType', 'SliceThickness', 'KVP', 'XRayTubeCurrent',
+                                              'ExposureTime', 'Exposure', 'CTDIvol', 'ConvolutionKernel',
+                                              'ObservationDateTime']),
+    'dose': Projection(DOSE_HEADER_TAGS + _TIME_FIELDS +
+                       ['ConceptName', 'ContentDateTime', 'Device Observer UID', 'X-Ray Radiation Dose Report',
+                        'CT Acquisition/*', 'CT Accumulated Dose Data/*'])
+}
+
+
+def get_projection(name):
+    # None or "none" sends every tag as is
+    if not name or name == 'none':
+        return None
+    if isinstance(name, Projection):
+        return name
+    return PROJECTIONS[name]
+
+
 # This allows us to standardize how ctdi keys are included in dose reports, they exist in Siemens reports
 # but are _not_ present on GE machines, which makes the data difficult to parse with Splunk
 def normalize_ctdi_tags(tags):
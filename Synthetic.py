@@ -0,0 +1,640 @@
+'''Deterministic synthetic CT studies and dose reports for load testing without patient data'''
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import zlib
+from copy import deepcopy
+from datetime import datetime, timedelta
+from struct import pack
+import numpy as np
+import requests
+from DicomHeader import orthanc_id, read_ids
+
+EXPLICIT_VR_LE = '1.2.840.10008.1.2.1'
+CT_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.2'
+DOSE_SR_STORAGE = '1.2.840.10008.5.1.4.1.1.88.67'
+IMPLEMENTATION_CLASS_UID = '2.25.330186012117409812437302146105541530411'
+
+UNDEFINED_LENGTH = 0xFFFFFFFF
+ITEM = pack('<HHI', 0xFFFE, 0xE000, UNDEFINED_LENGTH)
+ITEM_END = pack('<HHI', 0xFFFE, 0xE00D, 0)
+SEQUENCE_END = pack('<HHI', 0xFFFE, 0xE0DD, 0)
+LONG_VRS = ['OB', 'OW', 'SQ', 'UN', 'UT']
+
+# Keyword -> (tag, VR) for everything the generator writes
+TAGS = {'FileMetaInformationGroupLength': (0x00020000, 'UL'),
+        'FileMetaInformationVersion': (0x00020001, 'OB'),
+        'MediaStorageSOPClassUID': (0x00020002, 'UI'),
+        'MediaStorageSOPInstanceUID': (0x00020003, 'UI'),
+        'TransferSyntaxUID': (0x00020010, 'UI'),
+        'ImplementationClassUID': (0x00020012, 'UI'),
+        'ImageType': (0x00080008, 'CS'),
+        'InstanceCreationDate': (0x00080012, 'DA'),
+        'InstanceCreationTime': (0x00080013, 'TM'),
+        'SOPClassUID': (0x00080016, 'UI'),
+        'SOPInstanceUID': (0x00080018, 'UI'),
+        'StudyDate': (0x00080020, 'DA'),
+        'SeriesDate': (0x00080021, 'DA'),
+        'ContentDate': (0x00080023, 'DA'),
+        'StudyTime': (0x00080030, 'TM'),
+        'SeriesTime': (0x00080031, 'TM'),
+        'ContentTime': (0x00080033, 'TM'),
+        'AccessionNumber': (0x00080050, 'SH'),
+        'Modality': (0x00080060, 'CS'),
+        'Manufacturer': (0x00080070, 'LO'),
+        'InstitutionName': (0x00080080, 'LO'),
+        'CodeValue': (0x00080100, 'SH'),
+        'CodingSchemeDesignator': (0x00080102, 'SH'),
+        'CodeMeaning': (0x00080104, 'LO'),
+        'StationName': (0x00081010, 'SH'),
+        'StudyDescription': (0x00081030, 'LO'),
+        'SeriesDescription': (0x0008103E, 'LO'),
+        'ManufacturerModelName': (0x00081090, 'LO'),
+        'PatientName': (0x00100010, 'PN'),
+        'PatientID': (0x00100020, 'LO'),
+        'PatientSex': (0x00100040, 'CS'),
+        'PatientAge': (0x00101010, 'AS'),
+        'BodyPartExamined': (0x00180015, 'CS'),
+        'SliceThickness': (0x00180050, 'DS'),
+        'KVP': (0x00180060, 'DS'),
+        'DeviceSerialNumber': (0x00181000, 'LO'),
+        'ProtocolName': (0x00181030, 'LO'),
+        'ExposureTime': (0x00181150, 'IS'),
+        'XRayTubeCurrent': (0x00181151, 'IS'),
+        'CTDIvol': (0x00189345, 'FD'),
+        'StudyInstanceUID': (0x0020000D, 'UI'),
+        'SeriesInstanceUID': (0x0020000E, 'UI'),
+        'StudyID': (0x00200010, 'SH'),
+        'SeriesNumber': (0x00200011, 'IS'),
+        'InstanceNumber': (0x00200013, 'IS'),
+        'ImagePositionPatient': (0x00200032, 'DS'),
+        'ImageOrientationPatient': (0x00200037, 'DS'),
+        'SamplesPerPixel': (0x00280002, 'US'),
+        'PhotometricInterpretation': (0x00280004, 'CS'),
+        'Rows': (0x00280010, 'US'),
+        'Columns': (0x00280011, 'US'),
+        'PixelSpacing': (0x00280030, 'DS'),
+        'BitsAllocated': (0x00280100, 'US'),
+        'BitsStored': (0x00280101, 'US'),
+        'HighBit': (0x00280102, 'US'),
+        'PixelRepresentation': (0x00280103, 'US'),
+        'MeasurementUnitsCodeSequence': (0x004008EA, 'SQ'),
+        'RelationshipType': (0x0040A010, 'CS'),
+        'ValueType': (0x0040A040, 'CS'),
+        'ConceptNameCodeSequence': (0x0040A043, 'SQ'),
+        'UID': (0x0040A124, 'UI'),
+        'TextValue': (0x0040A160, 'UT'),
+        'ConceptCodeSequence': (0x0040A168, 'SQ'),
+        'MeasuredValueSequence': (0x0040A300, 'SQ'),
+        'NumericValue': (0x0040A30A, 'DS'),
+        'CompletionFlag': (0x0040A491, 'CS'),
+        'VerificationFlag': (0x0040A493, 'CS'),
+        'ContentSequence': (0x0040A730, 'SQ'),
+        'PixelData': (0x7FE00010, 'OW')}
+
+# Scanner profiles, dose report series numbers as in the README
+VENDORS = {'GE': {'Manufacturer': 'GE MEDICAL SYSTEMS',
+                  'ManufacturerModelName': 'LightSpeed VCT',
+                  'DoseSeriesNumber': '997'},
+           'SIEMENS': {'Manufacturer': 'SIEMENS',
+                       'ManufacturerModelName': 'SOMATOM Definition AS',
+                       'DoseSeriesNumber': '502'}}
+
+PROTOCOLS = [('CT CHEST W CONTRAST', 'Chest', 'CHEST', 12.0),
+             ('CT ABD PELVIS W CONTRAST', 'Abdomen and Pelvis', 'ABDOMEN', 15.0),
+             ('CT HEAD WO CONTRAST', 'Head', 'HEAD', 55.0),
+             ('CT CHEST ABD PELVIS', 'Chest, Abdomen and Pelvis', 'CHEST', 14.0)]
+
+
+# Encoding
+
+def encode_value(vr, value):
+    if vr == 'US':
+        return pack('<H', value)
+    if vr == 'UL':
+        return pack('<I', value)
+    if vr == 'FD':
+        return pack('<d', value)
+    if vr in ['OB', 'OW']:
+        data = value
+    else:
+        if isinstance(value, (list, tuple)):
+            value = '\\'.join(str(v) for v in value)
+        data = str(value).encode('ascii')
+    if len(data) % 2:
+        data = data + (b'\0' if vr in ['UI', 'OB'] else b' ')
+    return data
+
+
+def encode(elements):
+    '''Explicit VR little endian encoding of a {keyword: value} data set, sequences as lists of dicts'''
+
+    out = []
+    for keyword in sorted(elements, key=lambda k: TAGS[k][0]):
+        tag, vr = TAGS[keyword]
+        value = elements[keyword]
+        header = pack('<HH', tag >> 16, tag & 0xFFFF) + vr.encode('ascii')
+        if vr == 'SQ':
+            out.append(header + b'\0\0' + pack('<I', UNDEFINED_LENGTH))
+            for item in value:
+                out.append(ITEM + encode(item) + ITEM_END)
+            out.append(SEQUENCE_END)
+            continue
+        data = encode_value(vr, value)
+        if vr in LONG_VRS:
+            out.append(header + b'\0\0' + pack('<I', len(data)) + data)
+        else:
+            out.append(header + pack('<H', len(data)) + data)
+    return b''.join(out)
+
+
+def part10(elements):
+    '''A complete DICOM file for the data set'''
+
+    meta = encode({'FileMetaInformationVersion': b'\0\1',
+                   'MediaStorageSOPClassUID': elements['SOPClassUID'],
+                   'MediaStorageSOPInstanceUID': elements['SOPInstanceUID'],
+                   'TransferSyntaxUID': EXPLICIT_VR_LE,
+                   'ImplementationClassUID': IMPLEMENTATION_CLASS_UID})
+    meta = encode({'FileMetaInformationGroupLength': len(meta)}) + meta
+    return b'\0' * 128 + b'DICM' + meta + encode(elements)
+
+
+def simplified(elements):
+    '''The data set as Orthanc's "?simplify" json presents it: strings, lists for sequences, no pixels'''
+
+    ret = {}
+    for keyword, value in elements.items():
+        vr = TAGS[keyword][1]
+        if vr in ['OB', 'OW']:
+            continue
+        if vr == 'SQ':
+            ret[keyword] = [simplified(item) for item in value]
+        elif isinstance(value, (list, tuple)):
+            ret[keyword] = '\\'.join(str(v) for v in value)
+        else:
+            ret[keyword] = str(value)
+    return ret
+
+
+def instance_id(elements):
+    return orthanc_id(elements['PatientID'], elements['StudyInstanceUID'],
+                      elements['SeriesInstanceUID'], elements['SOPInstanceUID'])
+
+
+# Structured report content items
+
+def code(meaning, value='0', scheme='DCM'):
+    return [{'CodeValue': value, 'CodingSchemeDesignator': scheme, 'CodeMeaning': meaning}]
+
+
+def container(meaning, items):
+    return {'RelationshipType': 'CONTAINS', 'ValueType': 'CONTAINER',
+            'ConceptNameCodeSequence': code(meaning), 'ContentSequence': items}
+
+
+def num(meaning, value, units):
+    return {'RelationshipType': 'CONTAINS', 'ValueType': 'NUM', 'ConceptNameCodeSequence': code(meaning),
+            'MeasuredValueSequence': [{'NumericValue': '{0:.2f}'.format(value),
+                                       'MeasurementUnitsCodeSequence': code(units, units, 'UCUM')}]}
+
+
+def text(meaning, value):
+    return {'RelationshipType': 'CONTAINS', 'ValueType': 'TEXT', 'ConceptNameCodeSequence': code(meaning),
+            'TextValue': value}
+
+
+def coded(meaning, value):
+    return {'RelationshipType': 'CONTAINS', 'ValueType': 'CODE', 'ConceptNameCodeSequence': code(meaning),
+            'ConceptCodeSequence': code(value)}
+
+
+def uidref(meaning, value):
+    return {'RelationshipType': 'HAS OBS CONTEXT', 'ValueType': 'UIDREF', 'ConceptNameCodeSequence': code(meaning),
+            'UID': value}
+
+
+class Corpus(object):
+    '''
+    Synthetic CT studies.  Each has a PA and a lateral localizer (with the tags and contrast
+    MeasureScout expects), an axial series, and a GE- or Siemens-style X-Ray Radiation Dose SR
+    with one CT Acquisition per scan plus the scouts.  Study i depends only on (seed, i),
+    so any slice of a corpus can be regenerated on its own.
+    '''
+
+    def __init__(self, seed=0, studies=10, slices=20, acquisitions=2, vendors=('GE', 'SIEMENS'),
+                 scout_size=128, slice_size=64, start=datetime(2017, 1, 1)):
+        self.seed = seed
+        self.n_studies = studies
+        self.slices = slices
+        self.acquisitions = acquisitions
+        self.vendors = list(vendors)
+        self.scout_size = scout_size
+        self.slice_size = slice_size
+        self.start = start
+
+    def uid(self, rng):
+        return '2.25.{0}'.format(rng.getrandbits(128))
+
+    def studies(self):
+        for i in range(self.n_studies):
+            yield self.study(i)
+
+    def instances(self):
+        '''Yield (Orthanc ID, data set) for every instance in the corpus'''
+        for study in self.studies():
+            for elements in study:
+                yield instance_id(elements), elements
+
+    def study(self, i):
+        rng = random.Random(self.seed * 1000003 + i)
+        nprng = np.random.RandomState(rng.randint(0, 2 ** 31 - 1))
+
+        vendor = self.vendors[i % len(self.vendors)]
+        when = self.start + timedelta(minutes=rng.randint(0, 365 * 24 * 60))
+        protocol, region, body_part, ctdi = rng.choice(PROTOCOLS)
+        station = '{0}CT{1}'.format(vendor[:2], rng.randint(1, 4))
+
+        study = {'PatientID': 'SYN{0:08d}'.format(rng.randint(0, 99999999)),
+                 'PatientName': 'SYNTHETIC^{0}'.format(i),
+                 'PatientSex': rng.choice(['M', 'F']),
+                 'PatientAge': '{0:03d}Y'.format(rng.randint(18, 90)),
+                 'AccessionNumber': '{0:010d}'.format(rng.randint(0, 9999999999)),
+                 'StudyInstanceUID': self.uid(rng),
+                 'StudyID': str(i),
+                 'StudyDescription': protocol,
+                 'StudyDate': when.strftime('%Y%m%d'),
+                 'StudyTime': when.strftime('%H%M%S'),
+                 'Manufacturer': VENDORS[vendor]['Manufacturer'],
+                 'ManufacturerModelName': VENDORS[vendor]['ManufacturerModelName'],
+                 'InstitutionName': 'Synthetic Hospital',
+                 'StationName': station,
+                 'DeviceSerialNumber': '{0}{1:05d}'.format(vendor[:2], rng.randint(0, 99999))}
+
+        # Patient size in mm, for the localizers
+        lateral = rng.uniform(280, 420)
+        ap = rng.uniform(180, 300)
+
+        def series(number, description, modality, moment):
+            ret = dict(study)
+            ret.update({'SeriesInstanceUID': self.uid(rng),
+                        'SeriesNumber': str(number),
+                        'SeriesDescription': description,
+                        'Modality': modality,
+                        'SeriesDate': moment.strftime('%Y%m%d'),
+                        'SeriesTime': moment.strftime('%H%M%S'),
+                        'InstanceCreationDate': moment.strftime('%Y%m%d'),
+                        'InstanceCreationTime': moment.strftime('%H%M%S'),
+                        'BodyPartExamined': body_part,
+                        'ProtocolName': protocol})
+            return ret
+
+        ret = []
+
+        # Localizers: ImageOrientationPatient (1,0,0,...) is a PA scout measuring lateral width
+        scouts = series(1, 'Topogram', 'CT', when)
+        for n, (orientation, width) in enumerate([((1, 0, 0, 0, 0, -1), lateral), ((0, 1, 0, 0, 0, -1), ap)]):
+            elements = dict(scouts)
+            elements.update(self.image(rng, n + 1, self.scout_size, 500.0 / self.scout_size, 2.0, 120, 40))
+            elements.update({'ImageType': ['ORIGINAL', 'PRIMARY', 'LOCALIZER'],
+                             'ImageOrientationPatient': orientation,
+                             'PixelData': self.body(nprng, self.scout_size, width / (500.0 / self.scout_size))})
+            ret.append(elements)
+
+        # Axial images
+        kvp = rng.choice([100, 120, 140])
+        ma = rng.randint(100, 400)
+        volume_ctdi = ctdi * rng.uniform(0.6, 1.4)
+        axials = series(2, protocol, 'CT', when + timedelta(minutes=2))
+        pixels = self.body(nprng, self.slice_size, self.slice_size * 0.7)
+        for n in range(self.slices):
+            elements = dict(axials)
+            elements.update(self.image(rng, n + 1, self.slice_size, 500.0 / self.slice_size, 5.0, kvp, ma))
+            elements.update({'ImageType': ['ORIGINAL', 'PRIMARY', 'AXIAL'],
+                             'ImageOrientationPatient': (1, 0, 0, 0, 1, 0),
+                             'ImagePositionPatient': (-250, -250, -5.0 * n),
+                             'CTDIvol': volume_ctdi,
+                             'PixelData': pixels})
+            ret.append(elements)
+
+        # Dose report
+        done = when + timedelta(minutes=5)
+        dose = series(VENDORS[vendor]['DoseSeriesNumber'], 'Dose Record', 'SR', done)
+        dose.update({'SOPClassUID': DOSE_SR_STORAGE,
+                     'SOPInstanceUID': self.uid(rng),
+                     'InstanceNumber': '1',
+                     'ContentDate': done.strftime('%Y%m%d'),
+                     'ContentTime': done.strftime('%H%M%S'),
+                     'CompletionFlag': 'COMPLETE',
+                     'VerificationFlag': 'UNVERIFIED',
+                     'ValueType': 'CONTAINER',
+                     'ConceptNameCodeSequence': code('X-Ray Radiation Dose Report', '113701'),
+                     'ContentSequence': self.dose_items(rng, vendor, study, protocol, region,
+                                                        volume_ctdi, kvp, ma)})
+        ret.append(dose)
+
+        return ret
+
+    def image(self, rng, number, size, spacing, thickness, kvp, ma):
+        return {'SOPClassUID': CT_IMAGE_STORAGE,
+                'SOPInstanceUID': self.uid(rng),
+                'InstanceNumber': str(number),
+                'SliceThickness': thickness,
+                'KVP': kvp,
+                'XRayTubeCurrent': ma,
+                'ExposureTime': 500,
+                'SamplesPerPixel': 1,
+                'PhotometricInterpretation': 'MONOCHROME2',
+                'Rows': size,
+                'Columns': size,
+                'PixelSpacing': ('{0:.4f}'.format(spacing), '{0:.4f}'.format(spacing)),
+                'BitsAllocated': 16,
+                'BitsStored': 12,
+                'HighBit': 11,
+                'PixelRepresentation': 0}
+
+    @staticmethod
+    def body(nprng, size, width):
+        # Bright body of the given width (in pixels) over dim, noisy air
+        x = np.abs(np.arange(size) - size / 2.0)
+        px = 20 + nprng.randint(0, 10, (size, size))
+        rows = slice(int(size * 0.1), int(size * 0.9))
+        px[rows, x < width / 2.0] = px[rows, x < width / 2.0] + 1000
+        return px.astype('<u2').tobytes()
+
+    def dose_items(self, rng, vendor, study, protocol, region, ctdi, kvp, ma):
+
+        acquisitions = []
+        total_dlp = 0
+
+        # The scouts come first, GE leaves CT Dose out of them altogether
+        for n in range(2):
+            items = [text('Acquisition Protocol', protocol),
+                     coded('Target Region', region),
+                     coded('CT Acquisition Type', 'Constant Angle Acquisition'),
+                     container('CT Acquisition Parameters', [
+                         num('Exposure Time', rng.uniform(2, 6), 's'),
+                         num('Scanning Length', rng.uniform(300, 600), 'mm'),
+                         container('CT X-Ray Source Parameters', [num('KVP', 120, 'kV'),
+                                                                  num('X-Ray Tube Current', 40, 'mA')])])]
+            if vendor != 'GE':
+                items.append(container('CT Dose', [num('Mean CTDIvol', 0.1, 'mGy'), num('DLP', 2.0, 'mGy.cm')]))
+            acquisitions.append(items)
+
+        for n in range(self.acquisitions):
+            length = rng.uniform(200, 500)
+            _ctdi = ctdi * rng.uniform(0.9, 1.1)
+            dlp = _ctdi * length / 10.0
+            total_dlp = total_dlp + dlp
+            acquisitions.append([
+                text('Acquisition Protocol', protocol),
+                coded('Target Region', region),
+                coded('CT Acquisition Type', 'Spiral Acquisition'),
+                container('CT Acquisition Parameters', [
+                    num('Exposure Time', length / 40.0, 's'),
+                    num('Scanning Length', length, 'mm'),
+                    container('CT X-Ray Source Parameters', [num('KVP', kvp, 'kV'),
+                                                             num('X-Ray Tube Current', ma, 'mA')])]),
+                container('CT Dose', [num('Mean CTDIvol', _ctdi, 'mGy'),
+                                      num('DLP', dlp, 'mGy.cm'),
+                                      coded('CTDIw Phantom Type', 'IEC Body Dosimetry Phantom')])])
+
+        if vendor == 'SIEMENS':
+            # Siemens notes the scan mode and kernel per acquisition
+            for items in acquisitions:
+                items.append(text('Comment', 'Internal technical scan parameters: Kernel B30f'))
+
+        return [uidref('Device Observer UID', self.uid(rng)),
+                container('CT Accumulated Dose Data', [
+                    num('Total Number of Irradiation Events', len(acquisitions), '{events}'),
+                    num('CT Dose Length Product Total', total_dlp, 'mGy.cm')])] + \
+               [container('CT Acquisition', items) for items in acquisitions]
+
+
+class MemoryOrthanc(object):
+    '''
+    In-memory stand-in for a Session to an Orthanc, answering the REST calls CopyDICOM
+    and the gateways make, so pipelines can be exercised at scale without a server
+    '''
+
+    def __init__(self, name='synthetic'):
+        self.hostname = name
+        self.port = 0
+        self.endpoint = name
+        self.files = {}
+        self.tags = {}
+        self.frames = {}
+        self.levels = {}
+        self.parents = {}
+        self.children = {}
+        # Copy and purge workers post and delete concurrently
+        self.lock = threading.Lock()
+        self.updated = datetime.now().strftime('%Y%m%dT%H%M%S')
+
+    def store(self, elements, dicom=None):
+        instance = instance_id(elements)
+        with self.lock:
+            self.files[instance] = dicom if dicom is not None else part10(elements)
+            self.tags[instance] = simplified(elements)
+            if 'PixelData' in elements:
+                self.frames[instance] = elements['PixelData']
+            self.link(elements['PatientID'], elements['StudyInstanceUID'],
+                      elements['SeriesInstanceUID'], elements['SOPInstanceUID'])
+        return instance
+
+    def load(self, corpus):
+        for instance, elements in corpus.instances():
+            self.store(elements)
+        logging.info('Loaded {0} instances'.format(len(self.files)))
+        return self
+
+    def link(self, *uids):
+        ids = [orthanc_id(*uids[:i + 1]) for i in range(4)]
+        for parent, child in zip(ids, ids[1:]):
+            self.parents[child] = parent
+            self.children.setdefault(parent, [])
+            if child not in self.children[parent]:
+                self.children[parent].append(child)
+        for resource, level in zip(ids, ['patients', 'studies', 'series', 'instances']):
+            self.levels[resource] = level
+
+    def resources(self, level):
+        return [r for r, l in self.levels.items() if l == level]
+
+    def instances_of(self, resource):
+        if self.levels.get(resource) == 'instances':
+            return [resource]
+        return [i for child in self.children.get(resource, []) for i in self.instances_of(child)]
+
+    def info(self, resource):
+        level = self.levels[resource]
+        ret = {'ID': resource, 'LastUpdate': self.updated, 'Type': level.rstrip('s').capitalize()}
+        if level != 'instances':
+            key = {'patients': 'Studies', 'studies': 'Series', 'series': 'Instances'}[level]
+            ret[key] = list(self.children[resource])
+        parent_key = {'studies': 'ParentPatient', 'series': 'ParentStudy', 'instances': 'ParentSeries'}
+        if level in parent_key:
+            ret[parent_key[level]] = self.parents[resource]
+        ret['MainDicomTags'] = self.shared_tags(resource)
+        return ret
+
+    def shared_tags(self, resource):
+        instances = self.instances_of(resource)
+        first = self.tags[instances[0]]
+        return dict((k, v) for k, v in first.items()
+                    if not isinstance(v, list) and all(self.tags[i].get(k) == v for i in instances[1:]))
+
+    def not_found(self):
+        r = requests.Response()
+        r.status_code = 404
+        return r
+
+    def do_get(self, loc, params=None, headers=None):
+        parts = loc.split('?')[0].split('/')
+        expand = loc.endswith('?expand')
+        if len(parts) == 1:
+            items = self.resources(parts[0])
+            return [self.info(r) for r in items] if expand else items
+
+        resource = parts[1]
+        if resource not in self.levels:
+            return self.not_found()
+        rest = '/'.join(parts[2:])
+        if not rest:
+            return self.info(resource)
+        if rest in ['tags', 'simplified-tags']:
+            return deepcopy(self.tags[resource])
+        if rest == 'shared-tags':
+            return self.shared_tags(resource)
+        if rest == 'instances-tags':
+            return dict((i, deepcopy(self.tags[i])) for i in self.instances_of(resource))
+        if rest == 'file':
+            return self.files[resource]
+        if rest == 'frames/0/raw' and resource in self.frames:
+            return self.frames[resource]
+        if rest == 'attachments/dicom/size':
+            return str(len(self.files[resource])).encode('ascii')
+        if rest == 'attachments/dicom/md5':
+            return hashlib.md5(self.files[resource]).hexdigest().encode('ascii')
+        return self.not_found()
+
+    def do_post(self, loc, data, headers=None):
+        if loc == 'instances':
+            if (headers or {}).get('content-encoding') == 'gzip':
+                data = zlib.decompress(data, 31)
+            # Only the header is parsed, which is all the ID needs
+            ids = read_ids(data)
+            if not ids:
+                return self.not_found()
+            instance = orthanc_id(*ids)
+            with self.lock:
+                self.files[instance] = data
+                self.tags.setdefault(instance, {'PatientID': ids[0], 'StudyInstanceUID': ids[1],
+                                                'SeriesInstanceUID': ids[2], 'SOPInstanceUID': ids[3]})
+                self.link(*ids)
+            return {'ID': instance, 'Status': 'Success'}
+        if loc == 'tools/find':
+            level = {'Patient': 'patients', 'Study': 'studies', 'Series': 'series', 'Instance': 'instances'}
+            items = self.resources(level[data['Level']])
+            return [r for r in items if self.matches(r, data.get('Query') or {})]
+        return self.not_found()
+
+    def matches(self, resource, query):
+        tags = self.shared_tags(resource)
+        for key, value in query.items():
+            if not value or value == '*':
+                continue
+            if '-' in value and key.endswith('Date'):
+                lo, hi = value.split('-')
+                if not (lo or '0') <= tags.get(key, '') <= (hi or '9'):
+                    return False
+            elif tags.get(key) != value:
+                return False
+        return True
+
+    def do_delete(self, loc, params=None):
+        resource = loc.split('/')[1]
+        with self.lock:
+            if resource not in self.levels:
+                return self.not_found()
+            for instance in self.instances_of(resource):
+                del self.files[instance]
+                del self.tags[instance]
+                self.frames.pop(instance, None)
+            self.prune(resource)
+        return {}
+
+    def prune(self, resource):
+        for child in self.children.pop(resource, []):
+            self.prune(child)
+        del self.levels[resource]
+        parent = self.parents.pop(resource, None)
+        # Already gone when the parent itself is being pruned
+        siblings = self.children.get(parent)
+        if siblings is not None:
+            siblings.remove(resource)
+            if not siblings:
+                self.prune(parent)
+
+
+def write_files(corpus, path):
+    n = 0
+    for instance, elements in corpus.instances():
+        series_dir = os.path.join(path, elements['PatientID'], elements['AccessionNumber'],
+                                  elements['SeriesNumber'])
+        if not os.path.exists(series_dir):
+            os.makedirs(series_dir)
+        with open(os.path.join(series_dir, '{0}.dcm'.format(instance)), 'wb') as fp:
+            fp.write(part10(elements))
+        n = n + 1
+    logging.info('Wrote {0} instances under {1}'.format(n, path))
+
+
+def write_json(corpus, fn):
+    # Newline-delimited simplified tags with their Orthanc IDs
+    with open(fn, 'w') as fp:
+        for instance, elements in corpus.instances():
+            tags = simplified(elements)
+            tags['ID'] = instance
+            fp.write(json.dumps(tags))
+            fp.write('\n')
+
+
+def post_files(corpus, session):
+    headers = {'content-type': 'application/dicom'}
+    n = 0
+    for instance, elements in corpus.instances():
+        session.do_post('instances', data=part10(elements), headers=headers)
+        n = n + 1
+    logging.info('Posted {0} instances'.format(n))
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(prog='Synthetic')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--studies', type=int, default=10)
+    parser.add_argument('--slices', type=int, default=20, help="Axial images per study")
+    parser.add_argument('--acquisitions', type=int, default=2, help="Scanned CT Acquisitions per dose report")
+    parser.add_argument('--vendor', action='append', choices=sorted(VENDORS), help="Repeat to alternate vendors")
+    parser.add_argument('--out', help="Write DICOM files under this directory")
+    parser.add_argument('--json', help="Write simplified tags as ndjson to this file")
+    parser.add_argument('--orthanc', help="Post DICOM files to this Orthanc address")
+    opts = parser.parse_args()
+
+    corpus = Corpus(seed=opts.seed, studies=opts.studies, slices=opts.slices,
+                    acquisitions=opts.acquisitions, vendors=opts.vendor or sorted(VENDORS))
+    if opts.out:
+        write_files(corpus, opts.out)
+    if opts.json:
+        write_json(corpus, opts.json)
+    if opts.orthanc:
+        from SessionWrapper import Session
+        post_files(corpus, Session(opts.orthanc))
@@ -0,0 +1,112 @@
+'''Per-item pipeline stage tracing, written out as Chrome trace-event json'''
+
+import json
+import logging
+import os
+import threading
+import time
+
+
+class NullSpan(object):
+    # Shared do-nothing span, so disabled tracing costs one global lookup per stage
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+# Events held in memory before they are appended to the trace file
+FLUSH_EVERY = 10000
+
+
+class Span(object):
+
+    __slots__ = ['tracer', 'name', 'args', 'start']
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.add(self.name, self.start, time.time(), self.args)
+        return False
+
+
+class Tracer(object):
+    '''
+    Events are appended to the file every FLUSH_EVERY, in the trace-event "JSON array" format,
+    so memory stays flat over long runs.  The viewers accept the array without its closing
+    bracket, so a run that dies before save() still leaves a readable trace.
+    '''
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.pid = os.getpid()
+        self.events = []
+        self.threads = {}
+        self.written = 0
+        self.lock = threading.Lock()
+        self.fp = open(fn, 'w')
+        self.fp.write('[')
+
+    def add(self, name, start, end, args):
+        thread = threading.current_thread()
+        self.threads.setdefault(thread.ident, thread.name)
+        event = {'name': name,
+                 'ph': 'X',
+                 'ts': start * 1e6,
+                 'dur': (end - start) * 1e6,
+                 'pid': self.pid,
+                 'tid': thread.ident,
+                 'args': args}
+        with self.lock:
+            self.events.append(event)
+            if len(self.events) >= FLUSH_EVERY:
+                self.flush()
+
+    def flush(self):
+        # Caller holds the lock
+        for event in self.events:
+            self.fp.write((',\n' if self.written else '\n') + json.dumps(event))
+            self.written = self.written + 1
+        self.events = []
+        self.fp.flush()
+
+    def save(self):
+        with self.lock:
+            self.events.extend({'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid, 'args': {'name': name}}
+                               for tid, name in self.threads.items())
+            self.flush()
+            self.fp.write('\n]\n')
+            self.fp.close()
+        logging.info('Wrote {0} trace events to {1}'.format(self.written, self.fn))
+
+
+_tracer = None
+
+
+def enable(fn):
+    global _tracer
+    _tracer = Tracer(fn)
+
+
+def span(name, **args):
+    '''Time a stage, e.g., `with span('simplify_tags', id=instance): ...`'''
+    if _tracer is None:
+        return NULL_SPAN
+    return Span(_tracer, name, args)
+
+
+def save():
+    if _tracer is not None:
+        _tracer.save()
@@ -0,0 +1,126 @@
+'''Send DICOM over slow links losslessly compressed, and keep count of what that saved'''
+
+import logging
+import threading
+import time
+from SessionWrapper import Session, is_error
+
+# Lossless transfer syntaxes the source Orthanc can be asked to transcode to
+SYNTAXES = {'jpeg-ls': '1.2.840.10008.1.2.4.80',
+            'jpeg2000': '1.2.840.10008.1.2.4.90',
+            'jpeg-lossless': '1.2.840.10008.1.2.4.70',
+            'deflate': '1.2.840.10008.1.2.1.99'}
+
+# Log running totals every this many instances
+REPORT_EVERY = 1000
+
+# Responses meaning the source can't transcode at all (bad request, unsupported media type),
+# rather than that one instance couldn't be
+UNSUPPORTED = [400, 415]
+
+
+class TransferStats(object):
+    '''
+    Bytes as stored on the source against bytes actually sent, with throughput for the run.
+    An instance added without its stored size (None) leaves the ratio out of the report.
+    '''
+
+    def __init__(self):
+        self.instances = 0
+        self.unmeasured = 0
+        self.stored = 0
+        self.sent = 0
+        self.start = time.time()
+        self.lock = threading.Lock()
+
+    def add(self, stored, sent):
+        with self.lock:
+            self.instances = self.instances + 1
+            if stored is None:
+                self.unmeasured = self.unmeasured + 1
+            else:
+                self.stored = self.stored + stored
+            self.sent = self.sent + sent
+            if self.instances % REPORT_EVERY == 0:
+                self.report()
+
+    def ratio(self):
+        return float(self.stored) / self.sent if self.sent else 1.0
+
+    def report(self):
+        elapsed = max(time.time() - self.start, 1e-6)
+        if self.unmeasured:
+            logging.info('Sent {0} instances, {1:.1f} MB in {2:.1f}s: {3:.2f} MB/s on the wire '
+                         '({4} without a stored size, see --measure_stored)'.format(
+                             self.instances, self.sent / 1e6, elapsed, self.sent / 1e6 / elapsed,
+                             self.unmeasured))
+            return
+        logging.info('Sent {0} instances, {1:.1f} MB for {2:.1f} MB stored ({3:.2f}x) in {4:.1f}s: '
+                     '{5:.2f} MB/s on the wire, {6:.2f} MB/s effective'.format(
+                         self.instances, self.sent / 1e6, self.stored / 1e6, self.ratio(), elapsed,
+                         self.sent / 1e6 / elapsed, self.stored / 1e6 / elapsed))
+
+
+def stored_size(session, instance):
+    # Size of the DICOM file as Orthanc stores it, without downloading it
+    r = session.do_get('instances/{0}/attachments/dicom/size'.format(instance))
+    if is_error(r):
+        return None
+    return int(r)
+
+
+class Fetcher(object):
+    '''
+    fetch(instance) for transfer_instances.  With a syntax (see SYNTAXES) the source transcodes
+    each file before sending it, which needs an Orthanc recent enough to take "?transcode=" on
+    instances/{id}/file.  An instance that fails to transcode is sent as stored; transcoding is
+    only given up for the run if the source rejects the request outright (see UNSUPPORTED).
+    With gzip the file is compressed once here, however many destinations it goes to, and must
+    be posted with content-encoding gzip (see encoding).
+
+    Transcoded files arrive without their stored size, so by default the stats report no ratio
+    for them.  measure_stored looks each one up, at the cost of an extra request per instance.
+    '''
+
+    def __init__(self, src, syntax=None, gzip=False, stats=None, measure_stored=False):
+        self.src = src
+        self.syntax = SYNTAXES.get(syntax, syntax)
+        self.gzip = gzip
+        self.stats = stats or TransferStats()
+        self.measure_stored = measure_stored
+
+    @property
+    def encoding(self):
+        return 'gzip' if self.gzip else None
+
+    def __call__(self, instance):
+
+        data = None
+        stored = None
+        transcoded = False
+        if self.syntax:
+            data = self.src.do_get('instances/{0}/file'.format(instance), params={'transcode': self.syntax})
+            if is_error(data):
+                if data.status_code in UNSUPPORTED:
+                    logging.warn('Source cannot transcode to {0}, sending files as stored'.format(self.syntax))
+                    self.syntax = None
+                else:
+                    logging.warn('Could not transcode {0}, sending it as stored'.format(instance))
+                data = None
+            else:
+                transcoded = True
+                if self.measure_stored:
+                    stored = stored_size(self.src, instance)
+
+        if data is None:
+            data = self.src.do_get('instances/{0}/file'.format(instance))
+            if is_error(data):
+                return data
+
+        if not transcoded:
+            stored = len(data)
+        if self.gzip:
+            data = Session.gzip(data)
+
+        self.stats.add(stored, len(data))
+        return data
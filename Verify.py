@@ -0,0 +1,120 @@
+'''Check replicas against their source with the MD5s Orthanc stores, without downloading any DICOM'''
+
+import hashlib
+import logging
+import time
+from multiprocessing.pool import ThreadPool
+from SessionWrapper import is_error
+from Trace import span
+
+# Log progress every this many series
+REPORT_EVERY = 100
+
+
+def stored_md5(session, instance):
+    '''The MD5 Orthanc recorded when it stored the instance, None if missing or not recorded'''
+    r = session.do_get('instances/{0}/attachments/dicom/md5'.format(instance))
+    if is_error(r):
+        return None
+    if isinstance(r, bytes):
+        r = r.decode('ascii')
+    return r.strip()
+
+
+def sampled(instance, rate, salt=''):
+    '''
+    Deterministic sample of about `rate` of all instances.  A fixed salt checks the same
+    instances every run, a changing salt (e.g., the date) audits a different slice each night.
+    '''
+    if rate >= 1:
+        return True
+    h = hashlib.md5('{0}{1}'.format(salt, instance).encode('ascii')).hexdigest()
+    return int(h[:8], 16) < rate * 0x100000000
+
+
+def verify_series(src, dests, series, instances):
+    '''
+    Compare the stored MD5 of each instance in one series on src and every dest.  One
+    request per destination lists what it holds of the series, so only instances that are
+    present get their hash fetched.
+    '''
+
+    ret = {'checked': 0, 'missing': set(), 'mismatched': set(), 'unhashed': set()}
+
+    with span('source_md5', id=series, count=len(instances)):
+        hashes = dict((instance, stored_md5(src, instance)) for instance in instances)
+
+    for dest in dests:
+        r = dest.do_get('series/{0}'.format(series))
+        present = set() if is_error(r) else set(r['Instances'])
+
+        with span('dest_md5', id=series, count=len(instances)):
+            for instance in instances:
+                if instance not in present:
+                    ret['missing'].add(instance)
+                    continue
+                if hashes[instance] is None:
+                    # Orthanc's StoreMD5 was off when the source copy was stored
+                    ret['unhashed'].add(instance)
+                    continue
+                ret['checked'] = ret['checked'] + 1
+                if stored_md5(dest, instance) != hashes[instance]:
+                    ret['mismatched'].add(instance)
+
+    return ret
+
+
+def verify(src, dests, rate=1.0, salt='', workers=8, series=None):
+    '''
+    Verify a sample of src's instances on every dest, a series per task across `workers`
+    threads.  series may be a `series?expand` listing to check, otherwise src is listed.
+    Returns counts plus the instances to re-copy and the series that failed.
+    '''
+
+    if not isinstance(dests, list):
+        dests = [dests]
+    if series is None:
+        series = src.do_get('series?expand')
+
+    tasks = []
+    for s in series:
+        instances = [instance for instance in s['Instances'] if sampled(instance, rate, salt)]
+        if instances:
+            tasks.append((s['ID'], instances))
+    logging.info('Verifying {0} instances in {1} series on {2} destinations'.format(
+        sum(len(t[1]) for t in tasks), len(tasks), len(dests)))
+
+    def check(task):
+        return task[0], verify_series(src, dests, task[0], task[1])
+
+    ret = {'series': 0, 'checked': 0, 'missing': set(), 'mismatched': set(), 'unhashed': set(),
+           'failed_series': set()}
+    tic = time.time()
+
+    pool = ThreadPool(workers)
+    for series_id, r in pool.imap_unordered(check, tasks):
+        ret['series'] = ret['series'] + 1
+        ret['checked'] = ret['checked'] + r['checked']
+        for key in ['missing', 'mismatched', 'unhashed']:
+            ret[key] |= r[key]
+        if r['missing'] or r['mismatched'] or r['unhashed']:
+            ret['failed_series'].add(series_id)
+        if ret['series'] % REPORT_EVERY == 0:
+            logging.info('Verified {0} of {1} series ({2:.1f}/s)'.format(
+                ret['series'], len(tasks), ret['series'] / max(time.time() - tic, 1e-6)))
+    pool.close()
+    pool.join()
+
+    ret['recopy'] = ret['missing'] | ret['mismatched']
+    logging.info('Checked {0} copies in {1} series in {2:.1f}s: {3} missing, {4} mismatched, {5} without a stored MD5'.format(
+        ret['checked'], ret['series'], time.time() - tic,
+        len(ret['missing']), len(ret['mismatched']), len(ret['unhashed'])))
+    return ret
+
+
+def write_recopy(fn, instances):
+    # One ID per line, like a journal log
+    with open(fn, 'w') as fp:
+        for instance in sorted(instances):
+            fp.write('{0}\n'.format(instance))
+    logging.info('Wrote {0} instances to re-copy to {1}'.format(len(instances), fn))